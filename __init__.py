@@ -25,14 +25,23 @@ See http://www.freebase.com/docs/web_services for more information
 __author__ = "rtp@google.com (Tyler Pirtle)"
 
 import collections
-import copy
 import logging
+import Queue
+import sys
+import threading
 import time
 
+from absl import flags
 from mql import error as mql_error
+from mql import sharedcache
+from mql import snapshot
+from mql.env import PrivateScopedDict
 from mql.graph import TcpGraphConnector
 from mql.hijson import HighQuery
 from mql.lojson import LowQuery
+from scan import Scan
+
+FLAGS = flags.FLAGS
 
 
 class InvalidGraphAddr(Exception):
@@ -55,7 +64,7 @@ class MQLService(object):
   MQLResult = collections.namedtuple("MQLResult", "result cost dateline cursor")
 
   def _fix_varenv(self, env):
-    """Make a copy of self.varenv, update it with env."""
+    """Make a scope over self.varenv, updated with env."""
     dollared_env = dict([
         ("$" + k, v) for k, v in env.items() if k in self.dollar_keys
     ])
@@ -74,7 +83,7 @@ class MQLService(object):
       not_dollared["tid"] = not_dollared["debug_token"]
       del not_dollared["debug_token"]
 
-    varenv = copy.deepcopy(self.varenv)
+    varenv = PrivateScopedDict(self.varenv)
     varenv.update(dollared_env)
     varenv.update(not_dollared)
     # convert 'deadline' to an absolute
@@ -84,8 +93,26 @@ class MQLService(object):
       varenv["epoch_deadline"] = time.time() + deadline
     return varenv
 
-  def __init__(self, connector=None, graphd_addrs=None):
-    """Initialize a MQLService with a connector."""
+  def __init__(self,
+               connector=None,
+               graphd_addrs=None,
+               schema_snapshot=None,
+               shared_schema_cache=None,
+               plan_cache_size=0,
+               schema_snapshots=False):
+    """Initialize a MQLService with a connector.
+
+    schema_snapshot is a file from save_schema_snapshot() to warm the
+    caches from; it defaults to --mql_schema_snapshot.
+    shared_schema_cache is a file from build_shared_schema_cache() to
+    map; it defaults to --mql_shared_schema_cache.
+    plan_cache_size is the number of compiled mqlread plans to keep, by
+    query shape; 0, the default, compiles every read.
+    schema_snapshots keeps the graph results the schema is loaded from,
+    for save_schema_snapshot() and build_shared_schema_cache(), and for
+    scan() to start its workers from; they take about as much memory
+    again as the schema.
+    """
     self.varenv = {}
 
     if connector is not None:
@@ -100,7 +127,20 @@ class MQLService(object):
     self.gc.open()
 
     low_querier = LowQuery(self.gc)
-    self.high_querier = HighQuery(low_querier)
+    self.high_querier = HighQuery(
+        low_querier,
+        plan_cache_size=plan_cache_size,
+        schema_snapshots=schema_snapshots)
+
+    if shared_schema_cache is None:
+      shared_schema_cache = FLAGS.mql_shared_schema_cache
+    if shared_schema_cache:
+      self.attach_shared_schema_cache(shared_schema_cache)
+
+    if schema_snapshot is None:
+      schema_snapshot = FLAGS.mql_schema_snapshot
+    if schema_snapshot:
+      self.load_schema_snapshot(schema_snapshot)
 
   def _parse_graphaddr(self, addrs):
     for g in addrs:
@@ -117,9 +157,78 @@ class MQLService(object):
       else:
         raise InvalidGraphAddr(g)
 
+  def close(self):
+    """Close the graph connector."""
+    self.gc.close()
+
   def get_cost(self):
     return self.gc.totalcost
 
+  def get_plan_cache_stats(self):
+    """Hits, misses and size of the mqlread plan cache, or None if off."""
+    if self.high_querier.plan_cache is None:
+      return None
+    return self.high_querier.plan_cache.stats()
+
+  def get_lookup_cache_stats(self):
+    """Sizes, hits, misses and evictions of the id and namespace caches."""
+    return self.high_querier.querier.lookup.cache_stats()
+
+  def preload_schema(self, domains=(), types=(), **varenv):
+    """Load the schema of whole domains, and of types, ahead of use.
+
+    The domains are read in one graph read and the types in another,
+    rather than a read per type as queries first use them.
+    """
+    varenv = self._fix_varenv(varenv)
+    schema_factory = self.high_querier.schema_factory
+    schema_factory.preload_domains(domains, varenv)
+    schema_factory.preload_types(types, varenv)
+
+  def save_schema_snapshot(self, path):
+    """Save the schema and namespace caches to path.
+
+    The service must have been made with schema_snapshots.
+    """
+    snapshot.write(path, self.high_querier.snapshot())
+
+  def load_schema_snapshot(self, path, **varenv):
+    """Warm the schema and namespace caches from save_schema_snapshot().
+
+    Returns False, and leaves the caches as they were, if there is no
+    usable snapshot at path.
+    """
+    saved = snapshot.read(path)
+    if saved is None:
+      return False
+
+    self.high_querier.restore_snapshot(saved, self._fix_varenv(varenv))
+    return True
+
+  def build_shared_schema_cache(self, path):
+    """Write the schema, namespace and id caches to path, for workers to map.
+
+    See mql/sharedcache.py. The service must have been made with
+    schema_snapshots.
+    """
+    sharedcache.build(path, self.high_querier)
+
+  def attach_shared_schema_cache(self, path, **varenv):
+    """Look in the shared cache at path when the caches miss.
+
+    Returns False, and goes on without one, if there is no usable
+    cache at path, or none that can be caught up with the graph.
+    """
+    shared = sharedcache.open_cache(path)
+    if shared is None:
+      return False
+
+    if not self.high_querier.attach_shared_cache(shared,
+                                                 self._fix_varenv(varenv)):
+      shared.close()
+      return False
+    return True
+
   def reset_costs(self):
     self.gc.reset_cost()
     self.high_querier.reset_cost()
@@ -195,6 +304,169 @@ class MQLService(object):
     result = self.MQLResult(r, cost, env.get("dateline"), env.get("cursor"))
     return result
 
+  def read_many(self, queries, **varenv):
+    """Read several independent queries in shared round trips.
+
+    This is read() of each of queries, but the id lookups of the whole
+    batch are done together and the graph reads are sent together, so
+    the batch costs about as many graph round trips as one read.
+
+    Args:
+      queries: dict of key -> mql query
+      varenv: as for read, applied to every query
+
+    Returns:
+      dict of key -> MQLResult, or the MQLError that query raised.
+      The cost of each MQLResult is that of the whole batch.
+
+    Raises: various exceptions, for errors that are not in any one query
+    """
+
+    self.reset_costs()
+    envs = {}
+    queries = dict(queries)
+    for key, query in queries.iteritems():
+      envs[key] = self._fix_varenv(varenv)
+      if envs[key].get("cursor"):
+        queries[key] = sort_query_keys(query)
+    logging.debug("pymql.read_many.start env: %s queries: %s", varenv,
+                  queries)
+
+    rs = self.high_querier.read_many(queries, envs)
+
+    cost = self.get_cost()
+    logging.debug("pymql.read_many.end env: %s cost: %s", varenv,
+                  cost.items())
+    results = {}
+    for key, r in rs.iteritems():
+      if isinstance(r, mql_error.MQLError):
+        results[key] = r
+      else:
+        env = envs[key]
+        results[key] = self.MQLResult(r, cost, env.get("dateline"),
+                                      env.get("cursor"))
+    return results
+
+  def iter_read(self, query, page_size=100, prefetch=1, **varenv):
+    """Iterate over all the results of a list query, a page at a time.
+
+    The query is read with a cursor, page_size results per page, and
+    the results are yielded one by one. While they are, the next pages
+    are already being read on a background thread, but never more than
+    prefetch pages ahead, so a read of millions of results runs in
+    constant memory.
+
+    The service does one read at a time, so it is busy with the pages
+    until the iterator is exhausted or closed; don't use it for other
+    queries meanwhile. Use prefetch=0 to read each page only when it is
+    needed, with no thread.
+
+    Args:
+      query: dict/json obj, mql query of the form [{...}]. Its "limit",
+        if any, is replaced by page_size.
+      page_size: int, number of results per read
+      prefetch: int, number of pages to read ahead
+      varenv: as for read. A cursor starts the read part way through.
+
+    The cost of every page read so far, on whichever thread, is added
+    up in get_cost() of the thread iterating.
+
+    Returns:
+      an iterator over each of the results of the query, as for read
+
+    Raises:
+      MQLParseError: at once, if query is not of the form [{...}]
+      various exceptions, as for read, when the page is reached.
+    """
+
+    if (not isinstance(query, list) or len(query) != 1 or
+        not isinstance(query[0], dict)):
+      raise mql_error.MQLParseError(
+          None, "iter_read() needs a query of the form [{...}]")
+
+    query = [dict(query[0], limit=page_size)]
+    cursor = varenv.pop("cursor", True)
+
+    pages = self._read_pages(query, cursor, varenv)
+    if prefetch > 0:
+      pages = prefetch_pages(pages, prefetch)
+    return self._iter_rows(pages)
+
+  def _read_pages(self, query, cursor, varenv):
+    """Yield the MQLResult of each page of query, from cursor on."""
+    while cursor:
+      r = self.read(query, cursor=cursor, **varenv)
+      yield r
+      cursor = r.cursor
+
+  def _iter_rows(self, pages):
+    """Yield the rows of pages, adding up their costs for this thread."""
+    cost = collections.defaultdict(float)
+    for r in pages:
+      for k, v in r.cost.iteritems():
+        cost[k] += v
+      # read() of the next page on this thread starts a new totalcost
+      self.gc.totalcost = cost
+      for row in r.result:
+        yield row
+
+  def scan(self, query, boundaries=None, workers=4, page_size=100,
+           checkpoint=None, **varenv):
+    """Read a very large list query, in parallel timestamp windows.
+
+    See pymql.scan. The workers get their own connectors, with the
+    settings of this one but a graphd address each, spread over the
+    addresses of this service. They start from this service's schema
+    and namespace caches if it keeps schema_snapshots, and from its
+    shared schema cache if it has one, and are closed when the scan
+    finishes.
+
+    Args:
+      query: dict/json obj, mql query of the form [{...}]
+      boundaries: list of timestamps to split the query at, at least
+        workers - 1 of them unless resuming from checkpoint
+      workers: int, number of windows to read at once
+      page_size: int, number of results per read
+      checkpoint: the checkpoint() of an earlier Scan to resume
+      varenv: as for read
+
+    Returns:
+      Scan, an iterable over the results of the query.
+    """
+    addrs = getattr(self.gc, "addr_list", None)
+    if not addrs:
+      raise InvalidGraphAddr("scan() needs the graphd addresses")
+
+    saved = None
+    if self.high_querier.schema_snapshots:
+      saved = self.high_querier.snapshot()
+    shared = self.high_querier.shared_cache
+    plan_cache = self.high_querier.plan_cache
+
+    services = []
+    try:
+      for i in range(workers):
+        gc = self.gc.clone([addrs[i % len(addrs)]])
+        service = MQLService(
+            connector=gc,
+            schema_snapshot="",
+            shared_schema_cache="",
+            plan_cache_size=plan_cache.size if plan_cache else 0)
+        services.append(service)
+        if shared is not None:
+          service.high_querier.attach_shared_cache(shared,
+                                                   self._fix_varenv(varenv))
+        if saved is not None:
+          service.high_querier.restore_snapshot(saved,
+                                                self._fix_varenv(varenv))
+
+      return Scan(services, query, boundaries, page_size, checkpoint,
+                  close_services=True, **varenv)
+    except Exception:
+      for service in services:
+        service.close()
+      raise
+
   def write(self, query, **varenv):
     """Initiate a write of the specified query using the GraphConnector.
 
@@ -257,6 +529,25 @@ class MQLService(object):
                             env.get("cursor"))
     return result
 
+  def prepare(self, query):
+    """Prepare a mqlread to be run many times with different values.
+
+    Any string value in query of the form "$name" is a placeholder, to be
+    bound by the params of each PreparedQuery.read(). The query is only
+    resolved against the schema again when the params can't be bound
+    into what was resolved before: placeholders for "id" and "mid", and
+    for text values, are bound without resolving the query again, while
+    each new value for any other placeholder is resolved once.
+
+    Args:
+      query: dict/json obj, mql query with "$name" placeholders
+
+    Returns:
+      PreparedQuery
+    """
+    return PreparedQuery(self,
+                         self.high_querier.prepare(sort_query_keys(query)))
+
   def normalize(self, query):
     """Normalize the specified query.  TODO(rtp) What does this actually do?"""
     self.reset_costs()
@@ -265,6 +556,39 @@ class MQLService(object):
     return result
 
 
+class PreparedQuery(object):
+  """A mqlread prepared by MQLService.prepare()."""
+
+  def __init__(self, service, template):
+    self.service = service
+    self.template = template
+
+  def read(self, params, **varenv):
+    """Read the query with its placeholders bound to params.
+
+    Args:
+      params: dict, placeholder name (without the "$") to value. Every
+        placeholder in the query must be bound.
+      varenv: as for MQLService.read
+
+    Returns:
+      MQLResult, as for MQLService.read
+
+    Raises: various exceptions
+    """
+    service = self.service
+    service.reset_costs()
+    env = service._fix_varenv(varenv)
+    logging.debug("pymql.read_prepared.start env: %s params: %s", env, params)
+
+    r = service.high_querier.read_prepared(self.template, params, env)
+
+    cost = service.get_cost()
+    logging.debug("pymql.read_prepared.end env: %s cost: %s", env,
+                  cost.items())
+    return service.MQLResult(r, cost, env.get("dateline"), env.get("cursor"))
+
+
 def sort_query_keys(part):
   """sort keys in place.
 
@@ -296,3 +620,58 @@ def sort_query_keys(part):
     return new_d
   else:
     return part
+
+
+def prefetch_pages(pages, size):
+  """Iterate over pages, running it up to size pages ahead on a thread.
+
+  pages is only ever run on the one thread, and at most size pages
+  wait for the caller. An exception from pages is raised when its
+  place is reached. When this is closed early, it waits for the page
+  being read before returning, so pages is never left running.
+
+  Args:
+    pages: iterable of pages
+    size: int, the number of pages to read ahead
+
+  Yields:
+    each of pages
+  """
+
+  buf = Queue.Queue(size)
+  stop = threading.Event()
+
+  def put(item):
+    while not stop.is_set():
+      try:
+        buf.put(item, timeout=0.1)
+        return True
+      except Queue.Full:
+        pass
+    return False
+
+  def produce():
+    try:
+      for page in pages:
+        if not put(("page", page)):
+          return
+    except Exception:
+      put(("error", sys.exc_info()))
+    else:
+      put(("end", None))
+
+  thread = threading.Thread(target=produce, name="pymql-prefetch")
+  thread.daemon = True
+  thread.start()
+
+  try:
+    while True:
+      kind, item = buf.get()
+      if kind == "end":
+        return
+      if kind == "error":
+        raise item[0], item[1], item[2]
+      yield item
+  finally:
+    stop.set()
+    thread.join()
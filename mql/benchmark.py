@@ -18,6 +18,10 @@ if __name__ == "__main__":
 
 from pymql.log import LOG
 from pymql import json
+from pymql.mql.env import Varenv
+from pymql.mql.qprim import QueryPrimitive
+from pymql.mql.readqp import ReadQP
+from pymql.mql.utils import dict_recurse
 import time
 
 try:
@@ -218,6 +222,31 @@ def get_wildcard_query():
   }]
 
 
+def query_primitives(query):
+  """The query primitives hanging off the clauses of a compiled query."""
+  primitives = []
+  for clause in dict_recurse(query):
+    for name in ("node", "link", "ordered", "unique_ns_check"):
+      qp = getattr(clause, name, None)
+      if isinstance(qp, (QueryPrimitive, ReadQP)):
+        primitives.append(qp)
+  return primitives
+
+
+def primitive_footprint(primitives):
+  """Bytes held by the primitives themselves.
+
+  That is each object and its __dict__, if it has one, but not the values
+  it refers to.
+  """
+  total = 0
+  for qp in primitives:
+    total += sys.getsizeof(qp)
+    if hasattr(qp, "__dict__"):
+      total += sys.getsizeof(qp.__dict__)
+  return total
+
+
 def test_run(ctx, varenv, options, query):
   graphq = ctx.gc
   ctx.gc.reset_cost()
@@ -234,6 +263,10 @@ def test_run(ctx, varenv, options, query):
     if options.type == "graph":
       result = ctx.gc.read(
           query, transaction_id=varenv["tid"], policy=varenv["policy"])
+    elif options.type == "footprint":
+      # compile the query, but don't run it
+      result = ctx.high_querier.compile_graph_query(
+          query, Varenv(varenv, ctx.high_querier.querier.lookup))
     else:
       result = ctx.high_querier.read(query, varenv)
 
@@ -241,6 +274,11 @@ def test_run(ctx, varenv, options, query):
 
   ctx.gc.totalcost["dt"] = stop_time - start_time
 
+  if options.type == "footprint":
+    primitives = query_primitives(result)
+    ctx.gc.totalcost["qp_count"] = len(primitives)
+    ctx.gc.totalcost["qp_bytes"] = primitive_footprint(primitives)
+
   return result
 
 
@@ -271,7 +309,12 @@ def cmdline_main():
       default=None,
       help="flush cache between every request")
 
-  op.add_option("-t", dest="type", default="mql", help="graph or MQL query")
+  op.add_option(
+      "-t",
+      dest="type",
+      default="mql",
+      help="graph or MQL query, or footprint for the size of the MQL "
+      "query's primitives")
 
   options, args = op.parse_args()
 
@@ -299,13 +342,13 @@ def cmdline_main():
   else:
     op.error("Must specify a query argument")
 
-  if options.type == "mql":
+  if options.type in ("mql", "footprint"):
     # XXX should eventually use unicode, for now utf8
     query = json.loads(query, encoding="utf-8", result_encoding="utf-8")
   elif options.type == "graph":
     pass
   else:
-    op.error("-t must be 'mql' or 'graph'")
+    op.error("-t must be 'mql', 'graph' or 'footprint'")
 
   if options.profile:
     if profiler == "hotshot":
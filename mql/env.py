@@ -14,10 +14,146 @@
 
 from grquoting import quote, unquote
 import cgi
+import copy
 from utils import Missing, valid_mid, valid_mql_key
 
 
-class Varenv(dict):
+class ScopedDict(dict):
+  """
+    A dict layered copy-on-write over another mapping, its parent.
+
+    Keys set here are kept here. Keys that are not are read through
+    from the parent (only those in keys, if given), so making one costs
+    the same however big the parent is, and scopes can be chained.
+    Deleting a key that is only in the parent hides it here.
+
+    The C level dict functions (dict(x), json dumps, **x) only see
+    the keys set here; use iteritems() to see them all.
+    """
+
+  def __init__(self, parent=None, keys=None):
+    dict.__init__(self)
+    if parent is None:
+      parent = {}
+    self.parent = parent
+    self.visible = None if keys is None else frozenset(keys)
+    self.hidden = set()
+
+  def in_parent(self, key):
+    return (key not in self.hidden and
+            (self.visible is None or key in self.visible) and
+            key in self.parent)
+
+  def inherit(self, value):
+    """The value of a key read through from the parent."""
+    return value
+
+  def read_through(self, key):
+    """The value of key, which is only in the parent."""
+    return self.inherit(self.parent[key])
+
+  def __missing__(self, key):
+    if self.in_parent(key):
+      return self.read_through(key)
+    raise KeyError(key)
+
+  def __contains__(self, key):
+    return dict.__contains__(self, key) or self.in_parent(key)
+
+  has_key = __contains__
+
+  def get(self, key, default=None):
+    if dict.__contains__(self, key):
+      return dict.__getitem__(self, key)
+    if self.in_parent(key):
+      return self.read_through(key)
+    return default
+
+  def __setitem__(self, key, value):
+    self.hidden.discard(key)
+    dict.__setitem__(self, key, value)
+
+  def __delitem__(self, key):
+    if key not in self:
+      raise KeyError(key)
+    if dict.__contains__(self, key):
+      dict.__delitem__(self, key)
+    if self.in_parent(key):
+      self.hidden.add(key)
+
+  def pop(self, key, *default):
+    if key not in self:
+      if default:
+        return default[0]
+      raise KeyError(key)
+    value = self[key]
+    del self[key]
+    return value
+
+  def setdefault(self, key, default=None):
+    if key not in self:
+      self[key] = default
+    return self[key]
+
+  def update(self, *args, **kwargs):
+    for key, value in dict(*args, **kwargs).iteritems():
+      self[key] = value
+
+  def __iter__(self):
+    for key in dict.__iter__(self):
+      yield key
+    for key in self.parent:
+      if not dict.__contains__(self, key) and self.in_parent(key):
+        yield key
+
+  iterkeys = __iter__
+
+  def keys(self):
+    return list(self)
+
+  def iteritems(self):
+    for key in self:
+      yield key, self[key]
+
+  def items(self):
+    return list(self.iteritems())
+
+  def itervalues(self):
+    for key in self:
+      yield self[key]
+
+  def values(self):
+    return list(self.itervalues())
+
+  def __len__(self):
+    return sum(1 for key in self)
+
+  def __repr__(self):
+    return repr(dict(self.iteritems()))
+
+  def copy(self):
+    return dict(self.iteritems())
+
+
+class PrivateScopedDict(ScopedDict):
+  """
+    A ScopedDict that never shares a mutable value with its parent.
+
+    A value that isn't a string, number or None is deep copied the
+    first time it is read through, and the copy kept here, so changing
+    it in place (say, setdefault() of a dict) leaves the parent as it
+    was. Only the values read are copied.
+    """
+
+  def read_through(self, key):
+    value = ScopedDict.read_through(self, key)
+    if not isinstance(value, (basestring, int, long, float, type(None))):
+      value = copy.deepcopy(value)
+      dict.__setitem__(self, key, value)
+    return value
+
+
+class Varenv(ScopedDict):
   """
     A varenv is a container for per query MQL state
     It contains the following variables:
@@ -36,25 +172,17 @@ class Varenv(dict):
 
     sort_number - the current variable count in this query
 
+    A varenv is a scope over the varenv or dictionary it was made from,
+    so values set on it don't change that; export() copies them back.
+
     This is all subject to change as we get a better sense of what is really
     required...
     """
 
   def __init__(self, underlying_dict, lookup, keys=None):
-    self.lookup_manager = LookupManager(lookup, self)
-
-    if keys is None:
-      keys = underlying_dict.iterkeys()
-
-    for key in keys:
-      if key in underlying_dict:
-        val = underlying_dict[key]
-        if isinstance(val, unicode):
-          val = val.encode('utf-8')
+    ScopedDict.__init__(self, underlying_dict, keys)
 
-        self[key] = val
-
-    self.parent = underlying_dict
+    self.lookup_manager = LookupManager(lookup, self)
 
     self.sort_number = 0
 
@@ -72,6 +200,11 @@ class Varenv(dict):
     if 'vars_used' not in self:
       self['vars_used'] = set()
 
+  def inherit(self, value):
+    if isinstance(value, unicode):
+      return value.encode('utf-8')
+    return value
+
   def get_lang_id(self):
     return self['$lang']
 
@@ -131,7 +264,7 @@ class Varenv(dict):
     cls = type(self)
     return cls(
         self,
-        lookup=self.lookup,
+        lookup=self.lookup_manager.lookup,
         keys=['tid', 'policy', '$lang', '$permission', '$user'])
 
   def copy(self):
@@ -139,7 +272,7 @@ class Varenv(dict):
         This produces a duplicate but independent varenv
         """
     cls = type(self)
-    return cls(self, lookup=self.lookup)
+    return cls(dict(self.iteritems()), lookup=self.lookup_manager.lookup)
 
 
 class LookupManager(object):
@@ -166,6 +299,9 @@ class LookupManager(object):
     self.guid_to_mid_lookups = []
     self.mid_to_guid_lookups = []
 
+    # (container, key, lookup) for each lookup in a read result
+    self.result_slots = []
+
   # they're just like ids.
   # but below, "do_id_lookups" means
   # "turn guids into ids" and "do_guid_lookups"
@@ -191,6 +327,31 @@ class LookupManager(object):
     self.guid_to_mid_lookups = []
     self.mid_to_guid_lookups = []
 
+  def do_mid_and_id_lookups(self):
+    """do_guid_to_mid_lookups() and do_id_lookups() in one graph read."""
+    guids = [defer.guid for defer in self.guid_to_mid_lookups]
+    id_guids = [defer.guid for defer in self.id_lookups]
+    if not guids or not id_guids:
+      self.do_guid_to_mid_lookups()
+      self.do_id_lookups()
+      return
+
+    id_result, mid_result = self.lookup.lookup_ids_and_mids(
+        id_guids, guids, self.varenv)
+    for defer in self.guid_to_mid_lookups:
+      if defer.guid in mid_result:
+        defer.mid = mid_result[defer.guid]
+      else:
+        defer.mid = defer.guid
+    for defer in self.id_lookups:
+      if defer.guid in id_result:
+        defer.id = id_result[defer.guid]
+      else:
+        defer.id = defer.guid
+
+    self.guid_to_mid_lookups = []
+    self.mid_to_guid_lookups = []
+
   # they're just like ids.
   # but below, "do_id_lookups" means
   # "turn guids into ids" and "do_guid_lookups"
@@ -210,6 +371,28 @@ class LookupManager(object):
         if defer.mid in result:
           defer.guid = result[defer.mid]
 
+  def do_mid_and_guid_lookups(self):
+    """do_mid_to_guid_lookups() and do_guid_lookups() in one round trip."""
+    mids = [
+        defer.mid
+        for defer in self.mid_to_guid_lookups
+        if isinstance(defer, DeferredGuidOfMidLookup)
+    ]
+    ids = [defer.id for defer in self.guid_lookups]
+    if not mids or not ids:
+      self.do_mid_to_guid_lookups()
+      self.do_guid_lookups()
+      return
+
+    id_result, mid_result = self.lookup.lookup_guids_and_mids(
+        ids, mids, self.varenv)
+    for defer in self.mid_to_guid_lookups:
+      if defer.mid in mid_result:
+        defer.guid = mid_result[defer.mid]
+    for defer in self.guid_lookups:
+      if defer.id in id_result:
+        defer.guid = id_result[defer.id]
+
   def do_id_lookups(self):
     guids = [defer.guid for defer in self.id_lookups]
     result = self.lookup.lookup_ids(guids, self.varenv)
@@ -226,6 +409,20 @@ class LookupManager(object):
       if defer.id in result:
         defer.guid = result[defer.id]
 
+  def add_result_slot(self, container, key, defer):
+    """Have fill_result_slots() put defer's result in container[key]."""
+    self.result_slots.append((container, key, defer))
+
+  def fill_result_slots(self):
+    """Put the looked up ids and mids into the read result, in place.
+
+    Only the slots noted as the result was parsed are touched, where
+    substitute_ids() and substitute_mids() copy the whole result.
+    """
+    for container, key, defer in self.result_slots:
+      container[key] = defer.result()
+    self.result_slots = []
+
   def substitute_ids(self, result):
     if isinstance(result, DeferredIdLookup):
       return result.id
@@ -434,6 +631,9 @@ class DeferredMidOfGuidLookup(Guid):
     # highest up the chain (lookup takes care of that) if we said mid: null
     return self.mid[0]
 
+  def result(self):
+    return self.mid[0]
+
 
 class DeferredMidsOfGuidLookup(Guid):
 
@@ -452,6 +652,9 @@ class DeferredMidsOfGuidLookup(Guid):
     # this shouldn't happen
     return self.guid
 
+  def result(self):
+    return self.mid
+
 
 class DeferredGuidOfMidOrGuidLookups(Guid):
 
@@ -501,6 +704,9 @@ class DeferredIdLookup(Guid):
   def __str__(self):
     return self.id
 
+  def result(self):
+    return self.id
+
   def __eq__(self, other):
     try:
       if isinstance(other, str) or isinstance(other, unicode):
@@ -19,6 +19,9 @@ __author__ = 'nicholasv@google.com (Nicholas Veeser)'
 
 __all__ = ['TcpGraphConnector', 'MockRecordConnector', 'MockReplayConnector']
 
+# AsyncTcpGraphConnector is not imported here, so that the connectors
+# above don't drag in trollius; import it from conn_async.
+
 from conn_tcp import TcpGraphConnector
 from conn_mock import MockRecordConnector
 from conn_mock import MockReplayConnector
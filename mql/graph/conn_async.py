@@ -0,0 +1,532 @@
+#!/usr/bin/python2.6
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+"""Event loop TCP GraphConnector.
+
+AsyncTcpGraphConnector talks the same protocol as TcpGraphConnector and
+honours the same timeout policies (connect, timeout, retry,
+down_interval and the query deadline), but every network operation is
+a coroutine on an asyncio event loop, so one process can keep many
+graphd requests in flight without a thread per request.
+
+transmit_query(), transmit_queries(), read_varenv(),
+read_varenv_multiple() and write_varenv() are coroutines here, to be
+driven with 'yield From(...)' or loop.run_until_complete(). Since this
+tree is python 2, the event loop comes from trollius, the asyncio
+backport; it is optional and only needed to instantiate the connector.
+
+Every coroutine on the loop runs on the same thread, so the cost and
+dateline of a request can't be kept per thread as TcpGraphConnector
+keeps them. Instead each of those coroutines takes a RequestCost as its
+request argument, and charges that alone; gc.totalcost and gc.dateline
+are left alone.
+"""
+
+__author__ = 'nicholasv@google.com (Nicholas Veeser)'
+
+# None of these method names are standard
+# pylint: disable-msg=C6409
+
+from collections import deque
+import socket
+import time
+
+try:
+  import trollius as asyncio
+  from trollius import From
+  from trollius import Return
+except ImportError:
+  asyncio = None
+
+from pymql.error import GraphConnectionError
+from pymql.log import LOG
+from pymql.mql.error import GraphIsSnapshottingError
+from pymql.mql.error import MQLConnectionError
+from pymql.mql.error import MQLDatelineInvalidError
+from pymql.mql.error import MQLError
+from pymql.mql.error import MQLReadWriteError
+from pymql.mql.error import MQLTimeoutError
+from pymql.mql.graph.conn_tcp import TcpConnectionPool
+from pymql.mql.graph.conn_tcp import TcpGraphConnector
+from pymql.mql.graph.connector import ReadMode
+from pymql.mql.graph.connector import RequestCost
+from pymql.mql.graph.connector import WriteMode
+from pymql.mql.grparse import coststr_to_dict
+from pymql.mql.grparse import ReplyParser
+
+
+def coroutine(func):
+  """asyncio.coroutine, or a no-op if trollius is not installed."""
+  if asyncio is None:
+    return func
+  return asyncio.coroutine(func)
+
+
+class AsyncTcpGraphConnector(TcpGraphConnector):
+  """TCP connection to the graph driven by an asyncio event loop.
+
+  Policies are honoured as in TcpGraphConnector, except that 'hedge' is
+  ignored: reads are not raced against a second graph here.
+
+  Connections are always pooled, pool_size of them at most per graphd
+  address, with the idle timeout and lifetime of TcpConnectionPool.
+  """
+
+  def __init__(self,
+               addrs=None,
+               loop=None,
+               pool_size=8,
+               pool_idle_timeout=60.0,
+               pool_max_lifetime=600.0,
+               **kwargs):
+    if asyncio is None:
+      raise GraphConnectionError(
+          'AsyncTcpGraphConnector needs the trollius module.',
+          http_code=500,
+          app_code='/mql/backend/no_event_loop')
+
+    self.loop = loop
+
+    # coalescing waits on threads, which would block the event loop,
+    # and the reply cache would be handed transmit_queries' coroutine
+    # instead of its replies.
+    kwargs['coalesce_reads'] = False
+    kwargs['reply_cache_bytes'] = 0
+
+    TcpGraphConnector.__init__(self, addrs, **kwargs)
+
+    self.pool = AsyncTcpConnectionPool(pool_size, pool_idle_timeout,
+                                       pool_max_lifetime, loop)
+
+  def open(self, policy=None):
+    """Connections are made lazily, on the event loop."""
+
+    self.addr = self._pick_addr(self.timeout_policies[policy or
+                                                      self.default_policy])
+    self.dbretries = 0
+    self.totalcost['gcr'] = self.dbretries
+
+  @coroutine
+  def _checkout(self, policy, deadline, request):
+    """Get a connected AsyncTcpConnection for the next request attempt.
+
+    The graph picked is left in request.addr, for the caller to charge
+    a failure to connect to it.
+    """
+
+    request.addr = self._pick_addr(policy)
+    conn, stats = yield From(
+        self.pool.checkout(request.addr,
+                           self._connect_timeout(policy, deadline)))
+    self._add_pool_costs(stats, request)
+    raise Return(conn)
+
+  @coroutine
+  def transmit_query(self, msg, policy, deadline, request=None, **kwargs):
+    """Transmit the query over TCP."""
+
+    results = yield From(self.transmit_queries([msg], policy, deadline,
+                                               request, **kwargs))
+    raise Return(results[0])
+
+  @coroutine
+  def transmit_queries(self, msgs, policy, deadline, request=None, **kwargs):
+    """Transmit several queries over a single TCP connection.
+
+    Same retry and cost handling as TcpGraphConnector.transmit_queries,
+    but waiting on the event loop instead of blocking, and charging
+    request (a RequestCost, or None to drop the costs).
+    """
+
+    if request is None:
+      request = RequestCost()
+
+    costs = []
+
+    request.qretries = -1
+
+    for retry_interval in self._retry_schedule(policy, deadline, request):
+      conn = None
+      addr = request.addr
+      results = []
+      start_time = None
+      try:
+        if retry_interval:
+          yield From(asyncio.sleep(retry_interval, loop=self.loop))
+
+        conn = yield From(self._checkout(policy, deadline, request))
+        addr = conn.addr
+
+        request.qretries += 1
+
+        # Keep close to the connection.send
+        LOG.notice(
+            'graph.request.start',
+            '',
+            policy=policy,
+            addr=addr,
+            count=len(msgs))
+
+        self._replica_begin(addr)
+        start_time = time.time()
+
+        timeout = self._make_timeout(policy['timeout'], deadline)
+
+        yield From(conn.send(''.join(msg + '\n' for msg in msgs), timeout))
+
+        for msg in msgs:
+          timeout = self._make_timeout(policy['timeout'], deadline)
+
+          result = yield From(conn.wait_response(timeout))
+          results.append(result)
+
+          # on success, the cost will be in req
+          costs.append(self._request_cost(result, start_time, time.time()))
+
+        LOG.notice('graph.request.end', '')
+
+        break
+
+      except GraphIsSnapshottingError, e:
+        # The connection is OK, but we need to break it
+        # so that when we try again we'll reconnect somewhere else.
+        conn.disconnect()
+        self._record_failure(addr)
+        cost = coststr_to_dict(e.cost)
+        costs.append(cost)
+
+      except MQLConnectionError, e:
+        # only trap MQLConnectionError, not MQLTimeoutError.
+        if conn is None:
+          # _checkout could not connect to the graph it picked
+          addr = request.addr
+        self._record_failure(addr)
+        cost = coststr_to_dict(e.cost)
+        costs.append(cost)
+
+      except MQLError, e:
+        # all other errors, collect the cost and reraise
+        cost = coststr_to_dict(e.cost)
+        costs.append(cost)
+        raise
+
+      finally:
+        if start_time is not None:
+          self._replica_end(addr, start_time, costs and costs[0],
+                            len(results) < len(msgs))
+
+        if conn is not None:
+          if len(results) + 1 < len(msgs):
+            conn.disconnect()
+          self._checkin(conn)
+
+        # accumulate all the costs from successes *and* failures
+        self._add_costs(costs, request)
+
+    else:
+      LOG.warning('graph.request.error', str(e))
+      raise e
+
+    self._count_requests(results, request)
+
+    raise Return(results)
+
+  def _transmit(self, gqls, varenv, mode, request):
+    """Wrap gqls in their envelopes, and send them on request's behalf."""
+
+    policy, epoch_deadline, kwargs = self._get_transmit_args(varenv)
+    full_queries = [self._generate_query(gql, varenv, mode) for gql in gqls]
+    return self.transmit_queries(full_queries, policy, epoch_deadline,
+                                 request, **kwargs)
+
+  @coroutine
+  def read_varenv(self, qs, varenv, request=None):
+    """Read from the graph the specified query."""
+
+    rs = yield From(self.read_varenv_multiple([qs], varenv, request))
+    raise Return(rs[0])
+
+  @coroutine
+  def read_varenv_multiple(self, qs_list, varenv, request=None):
+    """Read several queries in one round trip; see GraphConnector."""
+
+    dateline_in = varenv.get('write_dateline', None)
+
+    try:
+      rs = yield From(self._transmit(qs_list, varenv, ReadMode, request))
+    except MQLDatelineInvalidError:
+      LOG.info('mqlread.dateline.invalid', dateline=dateline_in)
+      varenv['write_dateline'] = ''
+      rs = yield From(self._transmit(qs_list, varenv, ReadMode, request))
+
+    raise Return(self._finish_read(qs_list, rs, varenv, dateline_in))
+
+  @coroutine
+  def write_varenv(self, qs, varenv, request=None):
+    """Write to the graph the specified query."""
+
+    self._check_writable()
+
+    dateline_in = varenv.get('write_dateline', None)
+
+    try:
+      rs = yield From(self._transmit([qs], varenv, WriteMode, request))
+    except MQLDatelineInvalidError:
+      LOG.info('mqlwrite.dateline.invalid', dateline=dateline_in)
+      varenv['write_dateline'] = ''
+      rs = yield From(self._transmit([qs], varenv, WriteMode, request))
+
+    raise Return(self._finish_write(rs[0], varenv, dateline_in))
+
+
+class AsyncTcpConnectionPool(TcpConnectionPool):
+  """TcpConnectionPool of AsyncTcpConnections, for one event loop.
+
+  The limits are those of TcpConnectionPool, but callers wait for a
+  free slot on the event loop; self.cond is only held briefly, and by
+  the loop's thread alone.
+  """
+
+  def __init__(self,
+               size,
+               idle_timeout=60.0,
+               max_lifetime=600.0,
+               loop=None):
+    TcpConnectionPool.__init__(self, size, idle_timeout, max_lifetime)
+    self.loop = loop
+    # futures of the callers waiting for a slot, longest waiting first
+    self.waiting = deque()
+
+  @coroutine
+  def checkout(self, addr, timeout):
+    """Take a connection to addr out of the pool; see TcpConnectionPool."""
+
+    start_time = time.time()
+
+    while True:
+      with self.cond:
+        conn = self._take(addr)
+        if conn is not None:
+          stats = self._checked_out(addr, start_time)
+          break
+
+        remaining = self._remaining(addr, start_time, timeout)
+        waiter = asyncio.Future(loop=self.loop)
+        self.waiting.append(waiter)
+        self.waiters += 1
+
+      try:
+        yield From(asyncio.wait_for(waiter, remaining, loop=self.loop))
+      except asyncio.TimeoutError:
+        # _remaining() raises on the next time round
+        pass
+      finally:
+        with self.cond:
+          self.waiters -= 1
+          if waiter in self.waiting:
+            self.waiting.remove(waiter)
+
+    if conn is True:
+      conn = AsyncTcpConnection(addr, self.loop)
+      try:
+        yield From(conn.connect(timeout))
+      except:
+        self._release(addr)
+        raise
+
+      with self.cond:
+        self.connects += 1
+
+    raise Return((conn, stats))
+
+  def _notify(self):
+    while self.waiting:
+      waiter = self.waiting.popleft()
+      if not waiter.done():
+        waiter.set_result(None)
+        return
+
+
+class AsyncTcpConnection(object):
+  """Pair of asyncio streams to one graphd."""
+
+  def __init__(self, addr, loop=None):
+    self.addr = addr
+    self.host, self.port = addr
+    self.loop = loop
+    self.reader = None
+    self.writer = None
+    self.created = self.last_used = time.time()
+
+    self.pending = None
+    self.reply_parser = ReplyParser()
+
+  @coroutine
+  def connect(self, timeout):
+    """Open the streams, in at most timeout seconds."""
+
+    if timeout == 0:
+      raise MQLTimeoutError(
+          None,
+          'No more time left to run queries in this request',
+          host=self.host,
+          port=self.port)
+
+    try:
+      self.reader, self.writer = yield From(
+          asyncio.wait_for(
+              asyncio.open_connection(self.host, self.port, loop=self.loop),
+              timeout,
+              loop=self.loop))
+
+    except asyncio.TimeoutError, e:
+      raise MQLConnectionError(
+          None,
+          'Timeout connecting to %(host)s:%(port)s',
+          host=self.host,
+          port=self.port)
+    except socket.gaierror, e:
+      raise MQLConnectionError(
+          None,
+          'Cannot resolve %(host)s:%(port)s',
+          host=self.host,
+          port=self.port,
+          detail=list(e.args))
+    except EnvironmentError, e:
+      raise MQLConnectionError(
+          None,
+          'Cannot connect to %(host)s:%(port)s',
+          host=self.host,
+          port=self.port,
+          detail=list(e.args))
+
+    # turn off Nagle's algorithm (talk to Jutta)
+    sock = self.socket
+    if sock is not None:
+      sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    self.created = self.last_used = time.time()
+
+  @property
+  def socket(self):
+    """The socket under the streams, or None once disconnected."""
+
+    if self.writer is None:
+      return None
+    return self.writer.get_extra_info('socket')
+
+  def disconnect(self):
+    """Close the streams."""
+
+    if self.writer is None:
+      return
+    self.writer.close()
+    self.reader = None
+    self.writer = None
+
+  @coroutine
+  def send(self, s, timeout):
+    """Send data s, waiting at most timeout seconds for it to drain."""
+
+    if self.writer is None:
+      raise MQLConnectionError(
+          None, 'Send on disconnected socket', host=self.host, port=self.port)
+
+    if timeout == 0:
+      raise MQLTimeoutError(
+          self.pending,
+          'No more time in deadline to run queries',
+          host=self.host,
+          port=self.port)
+
+    try:
+      self.pending = s
+      self.writer.write(s)
+      yield From(
+          asyncio.wait_for(self.writer.drain(), timeout, loop=self.loop))
+
+    except asyncio.TimeoutError, e:
+      self.disconnect()
+      raise MQLConnectionError(
+          self.pending,
+          'Timeout sending query',
+          host=self.host,
+          port=self.port)
+    except EnvironmentError, e:
+      self.disconnect()
+      raise MQLConnectionError(
+          self.pending,
+          'Error sending query',
+          host=self.host,
+          port=self.port,
+          detail=list(e.args))
+
+  @coroutine
+  def wait_response(self, timeout):
+    """Wait for the next complete response from graphd.
+
+    Args:
+      timeout: timeout for each read
+
+    Returns:
+      GRparser result.  See grparse.ReplyParser
+    """
+    if self.reader is None:
+      raise MQLConnectionError(
+          None, 'Read on disconnected socket', host=self.host, port=self.port)
+
+    try:
+      # a pipelined reply may have arrived with the previous one.
+      last_parse_time = time.time()
+
+      while not self.reply_parser.isready():
+        try:
+          b = yield From(
+              asyncio.wait_for(
+                  self.reader.read(8192), timeout, loop=self.loop))
+        except asyncio.TimeoutError, e:
+          # disconnect so graphd stops working on our behalf and the
+          # late reply is not taken as the answer to the next query.
+          self.disconnect()
+          raise MQLTimeoutError(
+              self.pending, 'Query timeout', host=self.host, port=self.port)
+        except EnvironmentError, e:
+          self.disconnect()
+          raise MQLConnectionError(
+              self.pending,
+              'Error receiving response',
+              host=self.host,
+              port=self.port,
+              detail=list(e.args))
+
+        if not b:
+          self.disconnect()
+          raise MQLReadWriteError(
+              self.pending,
+              'Connection closed by graphd',
+              host=self.host,
+              port=self.port)
+
+        # we may have got a \n -- record the time
+        last_parse_time = time.time()
+        self.reply_parser.parsestr(b)
+
+      reply = self.reply_parser.get_reply()
+      reply.end_time = last_parse_time
+      raise Return(reply)
+
+    finally:
+      self.pending = None
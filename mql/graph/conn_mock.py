@@ -25,6 +25,7 @@ import re
 import time
 from pymql.mql import error
 from pymql.mql.graph.connector import GraphConnector
+from pymql.mql.graph.connector import RequestState
 from pymql.mql.grparse import ReplyParser
 from absl import logging
 
@@ -113,9 +114,13 @@ class MockReplayConnector(GraphConnector):
   def __init__(self, mockdata):
     # don't connect to a graph, do not call __init__
     self.no_timeouts = False
+    self.request_state = RequestState()
     self.totalcost = {}
     self.mockdata = mockdata
     self._mocked = {}
+    # replayed reads must each reach transmit_query
+    self.inflight_reads = None
+    self.reply_cache = None
 
   def open(self, policy=None):
     pass
@@ -18,6 +18,10 @@
 
 This is a rewrite of the original GraphContext
 which used TCP sockets to connect to graphd
+
+By default a TcpGraphConnector owns a single TcpConnection. Passing
+pool_size=N instead keeps up to N connections per graphd address in a
+TcpConnectionPool, so one connector can be shared by many threads.
 """
 
 __author__ = 'nicholasv@google.com (Nicholas Veeser)'
@@ -25,10 +29,15 @@ __author__ = 'nicholasv@google.com (Nicholas Veeser)'
 # None of these method names are standard
 # pylint: disable-msg=C6409
 
+from collections import defaultdict
+from collections import deque
 import random
+import select
 import socket
+import threading
 import time
 
+from absl import flags
 from pymql.error import GraphConnectionError
 from pymql.log import LOG
 from pymql.mql.error import GraphIsSnapshottingError
@@ -39,6 +48,13 @@ from pymql.mql.error import MQLTimeoutError
 from pymql.mql.graph.connector import GraphConnector
 from pymql.mql.grparse import coststr_to_dict
 from pymql.mql.grparse import ReplyParser
+from pymql.mql.utils import ReadMode
+
+FLAGS = flags.FLAGS
+flags.DEFINE_float('graphd_retry_budget_rate', 10.0,
+                   'graph request retries allowed per second, per process')
+flags.DEFINE_integer('graphd_retry_budget_burst', 100,
+                     'graph request retries allowed in a burst, per process')
 
 
 class TcpGraphConnector(GraphConnector):
@@ -51,6 +67,7 @@ class TcpGraphConnector(GraphConnector):
           'timeout': 8.0,
           'down_interval': 300.0,
           'retry': [0.0, 0.0, 0.1],
+          'backoff': 0.05,
           'dateline_retry': 5.0
       },
       'bootstrap': {
@@ -58,6 +75,7 @@ class TcpGraphConnector(GraphConnector):
           'timeout': 4.0,
           'down_interval': 10.0,
           'retry': [0.0, 0.1],
+          'backoff': 0.1,
           'dateline_retry': 0.1
       },
 
@@ -79,6 +97,7 @@ class TcpGraphConnector(GraphConnector):
           'timeout': 15.0,
           'down_interval': 300.0,
           'retry': [0.0, 0.0],
+          'backoff': 0.05,
           'dateline_retry': 2.0
       },
       # batch -- don't break or timeout on regular looking queries
@@ -87,6 +106,8 @@ class TcpGraphConnector(GraphConnector):
           'timeout': 60.0,
           'down_interval': 300.0,
           'retry': [0.0, 0.1, 0.3, 1.0, 3.0, 10.0, 30.0],
+          'backoff': 0.1,
+          'backoff_max': 30.0,
           'dateline_retry': 5.0
       },
       # crawl -- really spend a long time on queries
@@ -95,14 +116,60 @@ class TcpGraphConnector(GraphConnector):
           'timeout': 500.0,
           'down_interval': 300.0,
           'retry': [0.0, 0.1, 0.3, 1.0, 3.0, 10.0, 30.0, 90.0, 200.0, 600.0],
+          'backoff': 0.3,
+          'backoff_max': 600.0,
           'dateline_retry': 10.0,
       }
   }
 
-  def __init__(self, addrs=None, **kwargs):
+  # how _pick_addr chooses among the graphs that are not marked down:
+  #   'p2c': the better of two random picks, by latency * (in flight + 1)
+  #   'least_latency': the best of them all, by the same measure
+  #   'random': any of them
+  REPLICA_SELECTION_MODES = ('p2c', 'least_latency', 'random')
+
+  # weight of the newest sample in the per graph latency averages
+  LATENCY_EWMA_ALPHA = 0.3
+  # seconds after which a latency average is too old to go by, so that
+  # a graph that was slow once gets another chance.
+  LATENCY_STALE_TIME = 30.0
+
+  # Retries sleep for policy['retry'][n] before attempt n. If the policy
+  # has a 'backoff' key, the retries after the first (which is usually
+  # for a stale connection, and immediate) sleep for backoff * 2**(n-2)
+  # seconds instead, up to 'backoff_max' (RETRY_BACKOFF_MAX if the
+  # policy has none). The length of 'retry' still sets the number of
+  # attempts. Either way the sleep is cut by up to RETRY_JITTER at
+  # random, and to at most half of the time left to the deadline.
+  RETRY_JITTER = 0.5
+  RETRY_BACKOFF_MAX = 10.0
+
+  # A policy with a 'hedge' key (a percentile, say 95) sends a read to a
+  # second graph when the first has not started to answer within that
+  # percentile of recent read latencies (but at least 'hedge_min'
+  # seconds), and takes whichever reply comes first. These bound the
+  # latency window the percentile is taken from.
+  HEDGE_SAMPLES = 200
+  HEDGE_MIN_SAMPLES = 20
+
+  def __init__(self,
+               addrs=None,
+               pool_size=None,
+               pool_idle_timeout=60.0,
+               pool_max_lifetime=600.0,
+               replica_selection='p2c',
+               **kwargs):
     if 'policy_map' not in kwargs:
       kwargs['policy_map'] = self.BUILTIN_TIMEOUT_POLICIES
 
+    # for clone()
+    self.settings = dict(
+        kwargs,
+        pool_size=pool_size,
+        pool_idle_timeout=pool_idle_timeout,
+        pool_max_lifetime=pool_max_lifetime,
+        replica_selection=replica_selection)
+
     GraphConnector.__init__(self, **kwargs)
 
     if isinstance(addrs, (tuple, list)):
@@ -114,6 +181,32 @@ class TcpGraphConnector(GraphConnector):
           app_code='/mql/backend/address_not_given')
 
     self.failures = {}
+    self.tcp_conn = None
+
+    if replica_selection not in self.REPLICA_SELECTION_MODES:
+      raise GraphConnectionError(
+          'Unknown replica selection %s' % replica_selection,
+          http_code=500,
+          app_code='/mql/backend/bad_replica_selection')
+    self.replica_selection = replica_selection
+
+    # addr -> latency averages and request counts, see replica_stats()
+    self.replicas = {}
+    # guards self.replicas, self.failures and self.read_latencies, which
+    # all the threads using the connector share.
+    self.replica_lock = threading.Lock()
+
+    # latencies of recent reads, for the hedging threshold
+    self.read_latencies = deque(maxlen=self.HEDGE_SAMPLES)
+
+    # pool_size is per graphd address. None means the legacy single
+    # connection mode, where all traffic shares self.tcp_conn.
+    if pool_size:
+      self.pool = TcpConnectionPool(pool_size, pool_idle_timeout,
+                                    pool_max_lifetime)
+    else:
+      self.pool = None
+
     self.open(policy=self.default_policy)
 
   def open(self, policy=None):
@@ -125,7 +218,7 @@ class TcpGraphConnector(GraphConnector):
     policy = self.timeout_policies[policy]
 
     self.dbretries = -1
-    for retry_interval in policy['retry']:
+    for retry_interval in self._retry_schedule(policy, None):
       self.addr = self._pick_addr(policy)
 
       try:
@@ -133,7 +226,7 @@ class TcpGraphConnector(GraphConnector):
           time.sleep(retry_interval)
 
         self.dbretries += 1
-        self.tcp_conn = TcpConnection(self.addr, policy['connect'])
+        conn = TcpConnection(self.addr, policy['connect'])
 
         break  # got it
 
@@ -144,17 +237,36 @@ class TcpGraphConnector(GraphConnector):
       LOG.warning('graph.connect.error', str(e))
       raise e
 
+    if self.pool is not None:
+      # warm the pool with the connection we just made.
+      self.pool.add_idle(conn)
+    else:
+      self.tcp_conn = conn
+
     self.totalcost['gcr'] = self.dbretries
-    LOG.debug('graph.connect', 'created and connected db', conn=self.tcp_conn)
+    LOG.debug('graph.connect', 'created and connected db', conn=conn)
+
+  def _pick_addr(self, policy, exclude=None):
+    """Pick a graph to make the next connect attempt to.
+
+    Args:
+      policy: timeout policy dict
+      exclude: an address not to pick
 
-  def _pick_addr(self, policy):
-    """Pick a graph to make the next connect attempt to."""
+    Returns:
+      (host, port), or None if exclude was the only choice.
+    """
 
     acceptable_time = (time.time() - policy['down_interval'])
 
-    pick_list = [
-        x for x in self.addr_list if self.failures.get(x, 0) < acceptable_time
-    ]
+    addr_list = [x for x in self.addr_list if x != exclude]
+    if not addr_list:
+      return None
+
+    with self.replica_lock:
+      pick_list = [
+          x for x in addr_list if self.failures.get(x, 0) < acceptable_time
+      ]
 
     if not pick_list:
       # eek - everyone has failed in the past 5 minutes
@@ -162,23 +274,304 @@ class TcpGraphConnector(GraphConnector):
           'graph.connect.pick.failure',
           'All failed in past %d seconds' % policy['down_interval'],
           addresses=repr(self.addr_list))
-      pick_list = self.addr_list  # open to the whole list
+      pick_list = addr_list  # open to the whole list
 
-    i = random.randrange(len(pick_list))
-    addr = pick_list[i]
+    if len(pick_list) == 1 or self.replica_selection == 'random':
+      addr = random.choice(pick_list)
+    elif self.replica_selection == 'p2c':
+      addr = min(random.sample(pick_list, 2), key=self._replica_score)
+    else:
+      # shuffle first so that ties are broken randomly
+      pick_list = list(pick_list)
+      random.shuffle(pick_list)
+      addr = min(pick_list, key=self._replica_score)
 
     LOG.info('graph.connect.pick', addr)
 
     return addr
 
+  def _replica_score(self, addr):
+    """Expected wait at addr; graphs we have no numbers for come first."""
+
+    replica = self.replicas.get(addr)
+    if replica is None or replica['latency'] is None:
+      return 0.0
+    if replica['updated'] < time.time() - self.LATENCY_STALE_TIME:
+      return 0.0
+    return replica['latency'] * (replica['in_flight'] + 1)
+
+  def _replica(self, addr):
+    # call with self.replica_lock held
+    replica = self.replicas.get(addr)
+    if replica is None:
+      replica = self.replicas[addr] = {
+          'latency': None,
+          'graph_time': None,
+          'in_flight': 0,
+          'requests': 0,
+          'failures': 0,
+          'updated': 0.0,
+      }
+    return replica
+
+  def _replica_begin(self, addr):
+    with self.replica_lock:
+      self._replica(addr)['in_flight'] += 1
+
+  def _replica_end(self, addr, start_time, cost, failed):
+    """Feed the tg/te of a request to addr into its latency averages.
+
+    Args:
+      addr: graph the request went to
+      start_time: when the request was sent
+      cost: cost dict of the first reply, or of the failure (or None)
+      failed: True if the request did not get all of its replies
+    """
+
+    cost = dict(cost or {})
+    if 'tg' not in cost:
+      # failures count with the time they took us
+      cost['tg'] = time.time() - start_time
+
+    alpha = self.LATENCY_EWMA_ALPHA
+    with self.replica_lock:
+      replica = self._replica(addr)
+      replica['in_flight'] -= 1
+      replica['requests'] += 1
+      replica['updated'] = time.time()
+      if failed:
+        replica['failures'] += 1
+
+      for stat, key, scale in (('latency', 'tg', 1.0),
+                               ('graph_time', 'te', 0.001)):
+        if key in cost:
+          sample = cost[key] * scale
+          if replica[stat] is None:
+            replica[stat] = sample
+          else:
+            replica[stat] += alpha * (sample - replica[stat])
+
+  def replica_stats(self):
+    """Per graph stats, keyed by address.
+
+    latency and graph_time are averages, in seconds, of what we see
+    (tg) and what the graph reports (te); 'down' is true while the
+    graph is skipped by _pick_addr after a failure.
+    """
+
+    acceptable_time = (
+        time.time() -
+        self.timeout_policies[self.default_policy]['down_interval'])
+
+    with self.replica_lock:
+      stats = {}
+      for addr in self.addr_list:
+        stats[addr] = dict(self._replica(addr))
+        stats[addr]['down'] = self.failures.get(addr, 0) >= acceptable_time
+      return stats
+
+  def clone(self, addrs):
+    """A new connector to addrs, with the same settings as this one."""
+    return type(self)(addrs, **self.settings)
+
   def close(self):
     if self.tcp_conn is not None:
       self.tcp_conn.disconnect()
+    if self.pool is not None:
+      self.pool.close()
+
+  def _checkout(self, policy, deadline):
+    """Get a connected TcpConnection for the next request attempt.
+
+    In pool mode a fresh address is picked for every attempt; otherwise
+    the single connection is reused and only reopened once it has been
+    disconnected.
+
+    Args:
+      policy: timeout policy dict
+      deadline: epoch deadline of the whole query (or None)
+
+    Returns:
+      TcpConnection to send the request on.
+    """
+
+    connect_timeout = self._connect_timeout(policy, deadline)
+
+    if self.pool is None:
+      if self.tcp_conn is None or self.tcp_conn.socket is None:
+        self.addr = self._pick_addr(policy)
+        self.tcp_conn = None
+        self.tcp_conn = TcpConnection(self.addr, connect_timeout)
+      return self.tcp_conn
+
+    self.addr = self._pick_addr(policy)
+    return self._pool_checkout(self.addr, connect_timeout)
+
+  def _connect_timeout(self, policy, deadline):
+    connect_timeout = policy['connect']
+    if deadline is not None:
+      connect_timeout = min(connect_timeout, max(deadline - time.time(), 0))
+    return connect_timeout
+
+  def _pool_checkout(self, addr, connect_timeout):
+    conn, stats = self.pool.checkout(addr, connect_timeout)
+    self._add_pool_costs(stats)
+    return conn
+
+  def _add_pool_costs(self, stats, request=None):
+    """Charge the wait of a pool checkout to the request.
+
+    request is the RequestCost to charge, by default the one of the
+    request running on this thread; likewise for the other _add methods.
+    """
+
+    totalcost = (request or self.request_state).totalcost
+    totalcost['gpw'] += stats['wait_time']
+    for k in ('gpu', 'gpq'):
+      totalcost[k] = max(stats[k], totalcost.get(k, 0))
+
+  def _checkin(self, conn):
+    if self.pool is not None:
+      self.pool.checkin(conn)
+
+  def _hedgeable(self, policy, msgs):
+    """True if msgs may be hedged under policy."""
+
+    if not policy.get('hedge') or len(self.addr_list) < 2:
+      return False
+
+    # only reads can safely be sent twice
+    read_prefix = '%s ' % ReadMode
+    for msg in msgs:
+      if not msg.startswith(read_prefix):
+        return False
+
+    return True
+
+  def _hedge_delay(self, policy):
+    """Seconds to wait for a reply before hedging, or None."""
+
+    with self.replica_lock:
+      samples = sorted(self.read_latencies)
+    if len(samples) < self.HEDGE_MIN_SAMPLES:
+      return None
+
+    i = min(int(len(samples) * policy['hedge'] / 100.0), len(samples) - 1)
+    return max(samples[i], policy.get('hedge_min', 0.0))
+
+  def _hedge(self, conn, request, delay, start_time, policy, deadline):
+    """Race conn against a second graph if it is slow to answer.
+
+    request has been sent on conn. If no reply starts to arrive within
+    delay, request is sent to another graph as well, and the connection
+    that starts answering first wins. The loser is disconnected, the
+    same as on a timeout, so that graphd drops the query.
+
+    Args:
+      conn: TcpConnection request was sent on
+      request: the text sent
+      delay: seconds to wait before hedging
+      start_time: when request was sent on conn
+      policy: timeout policy dict
+      deadline: epoch deadline of the whole query (or None)
+
+    Returns:
+      the TcpConnection to read the replies from.
+    """
+
+    timeout = self._make_timeout(policy['timeout'], deadline)
+    if timeout is not None and timeout <= delay:
+      return conn
+    if conn.readable(delay):
+      return conn
+
+    addr = self._pick_addr(policy, exclude=conn.addr)
+    if addr is None:
+      return conn
+
+    LOG.notice('graph.request.hedge', '', addr=addr, delay=delay)
+    hedge_time = time.time()
+    self.totalcost['ghr'] += 1
+    try:
+      if self.pool is None:
+        other = TcpConnection(addr, self._connect_timeout(policy, deadline))
+      else:
+        other = self._pool_checkout(addr,
+                                    self._connect_timeout(policy, deadline))
+    except (MQLConnectionError, MQLTimeoutError), e:
+      # never mind, keep waiting for the first graph
+      self._record_failure(addr)
+      return conn
+
+    self._replica_begin(addr)
+    try:
+      other.send_socket(request, self._make_timeout(policy['timeout'],
+                                                    deadline))
+      ready = select.select([conn.socket, other.socket], [], [],
+                            self._make_timeout(policy['timeout'],
+                                               deadline))[0]
+    except (MQLConnectionError, MQLTimeoutError, select.error), e:
+      self._record_failure(addr)
+      ready = []
+
+    # the first graph wins ties, and a hedge that went nowhere
+    if other.socket in ready and conn.socket not in ready:
+      winner, loser, loser_start = other, conn, start_time
+      self.totalcost['ghw'] += 1
+      if self.pool is None:
+        self.addr = addr
+        self.tcp_conn = other
+    else:
+      winner, loser, loser_start = conn, other, hedge_time
+
+    # the loser never gets to tell us its costs; charge what we know.
+    self.totalcost['ght'] += time.time() - loser_start
+    loser.disconnect()
+    self._replica_end(loser.addr, loser_start, None, True)
+    self._checkin(loser)
+
+    return winner
+
+  def _retry_schedule(self, policy, deadline, request=None):
+    """Yield the seconds to sleep before each attempt at a request.
+
+    The first attempt is always made. Retries stop early once the
+    deadline has passed or the process wide RetryBudget runs dry.
+
+    Args:
+      policy: timeout policy dict
+      deadline: epoch deadline of the whole query (or None)
+      request: RequestCost to charge the retries to (or None)
+    """
+
+    totalcost = (request or self.request_state).totalcost
+    budget = retry_budget()
+    for attempt, interval in enumerate(policy['retry']):
+      if attempt:
+        if attempt > 1 and 'backoff' in policy:
+          interval = min(policy['backoff'] * 2**(attempt - 2),
+                         policy.get('backoff_max', self.RETRY_BACKOFF_MAX))
+        interval *= 1.0 - random.random() * self.RETRY_JITTER
+
+        if deadline is not None:
+          remaining = deadline - time.time()
+          if remaining <= 0:
+            return
+          interval = min(interval, remaining / 2)
+
+        if not budget.withdraw():
+          LOG.warning('graph.retry.budget', 'retry budget exhausted')
+          totalcost['grb'] += 1
+          return
+        totalcost['grs'] += 1
+
+      yield interval
 
   def _record_failure(self, failed_addr):
     now = time.time()
     LOG.error('graph.connect.failed', failed_addr)
-    self.failures[failed_addr] = now
+    with self.replica_lock:
+      self.failures[failed_addr] = now
 
   def _make_timeout(self, timeout, deadline):
     """Make a custom timeout based on a drop-dead time.
@@ -211,54 +604,81 @@ class TcpGraphConnector(GraphConnector):
   def transmit_query(self, msg, policy, deadline, **kwargs):
     """Transmit the query over TCP."""
 
+    return self.transmit_queries([msg], policy, deadline, **kwargs)[0]
+
+  def transmit_queries(self, msgs, policy, deadline, **kwargs):
+    """Transmit several queries over a single TCP connection.
+
+    graphd answers the requests on a connection in order, so all of
+    msgs are written up front and the replies are read back one after
+    the other. A retry resends the whole batch.
+    """
+
     costs = []
 
     self.qretries = -1
 
-    for retry_interval in policy['retry']:
+    for retry_interval in self._retry_schedule(policy, deadline):
+      conn = None
+      addr = self.addr
+      results = []
+      start_time = None
       try:
         if retry_interval:
           time.sleep(retry_interval)
 
-          if not self.tcp_conn:
-            self.tcp_conn = TcpConnection(policy['connect'], self.addr)
+        conn = self._checkout(policy, deadline)
+        addr = conn.addr
 
-          self.qretries += 1
+        self.qretries += 1
 
-          # Keep close to the connection.send
-          LOG.notice('graph.request.start', '', policy=policy, addr=self.addr)
+        # Keep close to the connection.send
+        LOG.notice(
+            'graph.request.start',
+            '',
+            policy=policy,
+            addr=addr,
+            count=len(msgs))
 
-          start_time = time.time()
+        self._replica_begin(addr)
+        start_time = time.time()
 
-          timeout = self._make_timeout(policy['timeout'], deadline)
+        timeout = self._make_timeout(policy['timeout'], deadline)
 
-          self.tcp_conn.send_socket(msg + '\n', timeout)
+        request = ''.join(msg + '\n' for msg in msgs)
+        conn.send_socket(request, timeout)
 
-          timeout = self._make_timeout(policy['timeout'], deadline)
+        hedgeable = self._hedgeable(policy, msgs)
+        if hedgeable:
+          hedge_delay = self._hedge_delay(policy)
+          if hedge_delay is not None:
+            # if the first graph loses, _hedge has already let it go
+            conn = self._hedge(conn, request, hedge_delay, start_time, policy,
+                               deadline)
+            addr = conn.addr
 
-          result = self.tcp_conn.wait_response(timeout)
+        for msg in msgs:
+          timeout = self._make_timeout(policy['timeout'], deadline)
 
-          token_time = time.time()
+          result = conn.wait_response(timeout, pipelined=bool(results))
+          results.append(result)
 
-          if result.cost is not None:
-            request_cost = coststr_to_dict(result.cost)
-            #request_cost['tg'] = (time.time() - start_time)
-            request_cost['tg'] = (result.end_time - start_time)
-            request_cost['tf'] = (token_time - start_time)
+          # on success, the cost will be in req
+          costs.append(self._request_cost(result, start_time, time.time()))
 
-            # on success, the cost will be in req
-            costs.append(request_cost)
+        if hedgeable:
+          with self.replica_lock:
+            self.read_latencies.append(results[0].end_time - start_time)
 
-          LOG.notice('graph.request.end', '')
+        LOG.notice('graph.request.end', '')
 
-          break
+        break
 
       except GraphIsSnapshottingError, e:
         # The connection is OK, but we need to break it
         # so that when we try again we'll reconnect somewhere else.
-        self.tcp_conn.disconnect()
-        self.tcp_conn = None
-        self._record_failure(self.addr)
+        conn.disconnect()
+        self._record_failure(addr)
         cost = coststr_to_dict(e.cost)
         costs.append(cost)
 
@@ -266,7 +686,10 @@ class TcpGraphConnector(GraphConnector):
         # only trap MQLConnectionError, not MQLTimeoutError.
         # most of the time a timeout error say "this query is too hard"
         # don't shop it around and force everyone else to timeout too.
-        self._record_failure(self.addr)
+        if conn is None:
+          # _checkout could not connect to the graph it picked
+          addr = self.addr
+        self._record_failure(addr)
         cost = coststr_to_dict(e.cost)
         costs.append(cost)
 
@@ -277,38 +700,321 @@ class TcpGraphConnector(GraphConnector):
         raise
 
       finally:
+        if start_time is not None:
+          self._replica_end(addr, start_time, costs and costs[0],
+                            len(results) < len(msgs))
+
+        if conn is not None:
+          if len(results) + 1 < len(msgs):
+            # we bailed out with replies still to come on this
+            # connection; they would be read as answers to the
+            # next request.
+            conn.disconnect()
+          self._checkin(conn)
 
         # accumulate all the costs from successes *and* failures
-        for cost in costs:
-          if cost:
-            for k, v in cost.iteritems():
-              self.totalcost[k] += v
+        self._add_costs(costs)
 
     else:
       LOG.warning('graph.request.error', str(e))
       raise e
 
-    self.nrequests += 1
-    self.totalcost['gqr'] = self.qretries
-    if 'mql_dbreqs' in self.totalcost:
-      self.totalcost['mql_dbreqs'] += 1
+    self._count_requests(results)
+
+    return results
+
+  def _request_cost(self, result, start_time, token_time):
+    """Cost dict of a successful reply, with our own tg/tf timings."""
+
+    if result.cost is None:
+      return None
+
+    request_cost = coststr_to_dict(result.cost)
+    #request_cost['tg'] = (time.time() - start_time)
+    request_cost['tg'] = (result.end_time - start_time)
+    request_cost['tf'] = (token_time - start_time)
+    return request_cost
+
+  def _add_costs(self, costs, request=None):
+    """Move the cost dicts in costs into the request's totalcost."""
+
+    totalcost = (request or self.request_state).totalcost
+    for cost in costs:
+      if cost:
+        for k, v in cost.iteritems():
+          totalcost[k] += v
+    del costs[:]
+
+  def _count_requests(self, results, request=None):
+    request = request or self.request_state
+    request.nrequests += len(results)
+    request.totalcost['gqr'] = request.qretries
+    if 'mql_dbreqs' in request.totalcost:
+      request.totalcost['mql_dbreqs'] += len(results)
     else:
-      self.totalcost['mql_dbreqs'] = 1
-    self.dateline = result.dateline
+      request.totalcost['mql_dbreqs'] = len(results)
+    request.dateline = results[-1].dateline
+
+
+class RetryBudget(object):
+  """Token bucket limiting the graph request retries of a process.
+
+  Without it a graphd brown-out multiplies the load on the graphs by
+  the number of retries in the policies. Each retry takes a token;
+  tokens come back at `rate` per second, up to `burst`.
+  """
+
+  def __init__(self, rate, burst):
+    self.rate = rate
+    self.burst = burst
+    self.tokens = float(burst)
+    self.last = time.time()
+    self.lock = threading.Lock()
+
+  def withdraw(self):
+    """Take a token for a retry; False if there are none left."""
+    with self.lock:
+      now = time.time()
+      self.tokens = min(self.burst,
+                        self.tokens + (now - self.last) * self.rate)
+      self.last = now
+      if self.tokens < 1:
+        return False
+      self.tokens -= 1
+      return True
+
+
+_retry_budget = None
+_retry_budget_lock = threading.Lock()
+
+
+def _flag_value(name):
+  """FLAGS.name, or its default if the flags haven't been parsed."""
+  if FLAGS.is_parsed():
+    return getattr(FLAGS, name)
+  return FLAGS[name].default
+
+
+def retry_budget():
+  """The RetryBudget shared by all graph connectors in this process."""
+  global _retry_budget
+  if _retry_budget is None:
+    with _retry_budget_lock:
+      if _retry_budget is None:
+        _retry_budget = RetryBudget(_flag_value('graphd_retry_budget_rate'),
+                                    _flag_value('graphd_retry_budget_burst'))
+  return _retry_budget
+
+
+class TcpConnectionPool(object):
+  """Thread-safe pool of TcpConnections, keyed by graphd address.
+
+  At most `size` connections per address are checked out at once;
+  further callers wait on a condition variable until one is returned.
+  Idle connections are evicted after `idle_timeout` seconds and every
+  connection is recycled once it is older than `max_lifetime`.
+  """
+
+  def __init__(self,
+               size,
+               idle_timeout=60.0,
+               max_lifetime=600.0):
+    self.size = size
+    self.idle_timeout = idle_timeout
+    self.max_lifetime = max_lifetime
+
+    self.cond = threading.Condition(threading.Lock())
+
+    # addr -> list of idle connections, most recently used last.
+    self.idle = defaultdict(list)
+    # addr -> number of connections checked out
+    self.in_use = defaultdict(int)
+
+    self.waiters = 0
+    self.wait_time = 0.0
+    self.checkouts = 0
+    self.connects = 0
+    self.evictions = 0
+
+  def _expired(self, conn, now):
+    if conn.socket is None:
+      return True
+    if self.max_lifetime and now - conn.created > self.max_lifetime:
+      return True
+    return False
+
+  def _evict_idle(self, addr, now):
+    # must be called with self.cond held.
+    keep = []
+    for conn in self.idle[addr]:
+      if (self._expired(conn, now) or
+          (self.idle_timeout and now - conn.last_used > self.idle_timeout)):
+        conn.disconnect()
+        self.evictions += 1
+      else:
+        keep.append(conn)
+    self.idle[addr] = keep
+
+  def add_idle(self, conn):
+    """Hand an already connected TcpConnection to the pool."""
+    with self.cond:
+      if len(self.idle[conn.addr]) + self.in_use[conn.addr] < self.size:
+        self.idle[conn.addr].append(conn)
+        self._notify()
+        return
+
+    conn.disconnect()
+
+  def checkout(self, addr, timeout):
+    """Take a connection to addr out of the pool, connecting if needed.
+
+    Args:
+      addr: (host, port) of the graphd
+      timeout: how long to wait for a free slot, and to connect
+
+    Returns:
+      (TcpConnection, stats) where stats holds the time spent waiting
+      ('wait_time'), and the connections in use ('gpu') and callers
+      waiting ('gpq') for this address when we got our slot.
+
+    Raises:
+      MQLTimeoutError: if no connection became available in time.
+    """
 
-    return result
+    start_time = time.time()
+
+    with self.cond:
+      while True:
+        conn = self._take(addr)
+        if conn is not None:
+          break
+
+        remaining = self._remaining(addr, start_time, timeout)
+        self.waiters += 1
+        try:
+          self.cond.wait(remaining)
+        finally:
+          self.waiters -= 1
+
+      stats = self._checked_out(addr, start_time)
+
+    if conn is True:
+      # connect outside the lock, but keep our slot reserved.
+      try:
+        conn = TcpConnection(addr, timeout)
+      except:
+        self._release(addr)
+        raise
+
+      with self.cond:
+        self.connects += 1
+
+    return conn, stats
+
+  def _take(self, addr):
+    """An idle connection to addr, True for a free slot, or None if full.
+
+    Must be called with self.cond held.
+    """
+
+    self._evict_idle(addr, time.time())
+
+    if self.idle[addr]:
+      return self.idle[addr].pop()
+    if self.in_use[addr] < self.size:
+      return True
+    return None
+
+  def _remaining(self, addr, start_time, timeout):
+    """Seconds left to wait for a slot, raising MQLTimeoutError if none."""
+
+    if timeout is None:
+      return None
+
+    remaining = start_time + timeout - time.time()
+    if remaining <= 0:
+      raise MQLTimeoutError(
+          None,
+          'Timed out waiting for a pooled graph connection',
+          host=addr[0],
+          port=addr[1],
+          pool_size=self.size)
+    return remaining
+
+  def _checked_out(self, addr, start_time):
+    """Count a checkout, returning its stats; call with self.cond held."""
+
+    self.in_use[addr] += 1
+    self.checkouts += 1
+    wait_time = time.time() - start_time
+    self.wait_time += wait_time
+    return {
+        'wait_time': wait_time,
+        'gpu': self.in_use[addr],
+        'gpq': self.waiters,
+    }
+
+  def _release(self, addr):
+    """Give up a slot that no connection was made for."""
+
+    with self.cond:
+      self.in_use[addr] -= 1
+      self._notify()
+
+  def _notify(self):
+    # must be called with self.cond held.
+    self.cond.notify()
+
+  def checkin(self, conn):
+    """Return a connection taken with checkout()."""
+
+    now = time.time()
+    with self.cond:
+      self.in_use[conn.addr] -= 1
+      if self._expired(conn, now):
+        conn.disconnect()
+      else:
+        conn.last_used = now
+        self.idle[conn.addr].append(conn)
+      self._notify()
+
+  def close(self):
+    """Disconnect all idle connections."""
+    with self.cond:
+      for conns in self.idle.itervalues():
+        for conn in conns:
+          conn.disconnect()
+      self.idle.clear()
+
+  def stats(self):
+    with self.cond:
+      return {
+          'size': self.size,
+          'idle': sum(len(conns) for conns in self.idle.itervalues()),
+          'in_use': sum(self.in_use.itervalues()),
+          'waiters': self.waiters,
+          'wait_time': self.wait_time,
+          'checkouts': self.checkouts,
+          'connects': self.connects,
+          'evictions': self.evictions,
+      }
 
 
 class TcpConnection(object):
   """TCP Connection to wrap a Unix Socket."""
 
   def __init__(self, addr, timeout):
+    self.addr = addr
     self.host, self.port = addr
     self.socket = None
     self.connect(timeout)
 
+    self.created = self.last_used = time.time()
+
     self.pending = None
     self.reply_parser = ReplyParser()
+    # reused by every read; the parser tokenizes straight out of it.
+    self.recvbuf = bytearray(8192)
 
   def connect(self, timeout):
     """Connect using the TCP Socket."""
@@ -354,6 +1060,21 @@ class TcpConnection(object):
           port=self.port,
           detail=list(e.args))
 
+  def readable(self, timeout):
+    """Wait up to timeout seconds for a reply to start arriving.
+
+    Returns:
+      True if there is something to read (or the socket is closed,
+      which wait_response will report).
+    """
+
+    if self.socket is None or self.reply_parser.isready():
+      return True
+    try:
+      return bool(select.select([self.socket], [], [], timeout)[0])
+    except select.error:
+      return True
+
   def disconnect(self):
     """Close the TCP socket."""
 
@@ -408,13 +1129,16 @@ class TcpConnection(object):
           port=self.port,
           detail=list(e.args))
 
-  def wait_response(self, timeout):
+  def wait_response(self, timeout, pipelined=False):
     """Wait for complete response from graphd.
 
     This may incur multiple socket reads.
 
     Args:
       timeout: socket timeout for read
+      pipelined: True if this is not the first reply we are waiting for
+        since the last send; it may already have arrived with the
+        previous one.
 
     Returns:
       GRparser result.  See grparse.ReplyParser
@@ -428,17 +1152,18 @@ class TcpConnection(object):
       if self.reply_parser.isready():
         reply = self.reply_parser.get_reply()
         reply.end_time = time.time()
-        LOG.error(
-            'graph.read.reply',
-            'saw reply before first socket read',
-            reply=reply)
+        if not pipelined:
+          LOG.error(
+              'graph.read.reply',
+              'saw reply before first socket read',
+              reply=reply)
         return reply
 
       self.socket.settimeout(timeout)
 
       while 1:
         try:
-          b = self.socket.recv(8192)
+          n = self.socket.recv_into(self.recvbuf)
         except socket.timeout, e:
           # we disconnect before we raise MQLConnectionError. That way if
           # the MQLConnectionError is not caught we don't leave a dangling
@@ -461,7 +1186,7 @@ class TcpConnection(object):
 
         # weirdly enough, this is how python signals a closed nonblocking
         # socket.
-        if not b:
+        if not n:
           self.disconnect()
           raise MQLReadWriteError(
               self.pending,
@@ -472,7 +1197,7 @@ class TcpConnection(object):
         else:
           # we may have got a \n -- record the time
           last_parse_time = time.time()
-          self.reply_parser.parsestr(b)
+          self.reply_parser.parsestr(buffer(self.recvbuf, 0, n))
 
         if self.reply_parser.isready():
           reply = self.reply_parser.get_reply()
@@ -31,6 +31,10 @@ __author__ = 'nicholasv@google.com (Nicholas Veeser)'
 # pylint: disable-msg=C6409
 
 from collections import defaultdict
+from collections import OrderedDict
+import re
+import sys
+import threading
 import time
 
 from absl import flags
@@ -39,6 +43,8 @@ from pymql.error import GraphConnectionError
 from pymql.log import LOG
 from pymql.mql.error import MQLDatelineInvalidError
 from pymql.mql.error import MQLParseError
+from pymql.mql.error import MQLTimeoutError
+from pymql.mql.grparse import copy_result
 from pymql.mql.grparse import coststr_to_dict
 from pymql.mql.grparse import gstr_unescape
 from pymql.mql.utils import ReadMode
@@ -90,6 +96,43 @@ def log_graph_status(varenv, dateline_in, dateline_out):
   log_grw(varenv, 's', dateline_in, dateline_out)
 
 
+class RequestCost(object):
+  """Cost and dateline of one request."""
+
+  def __init__(self):
+    # dateline of the last reply, and graph it came from
+    self.dateline = None
+    self.addr = None
+    self.reset()
+
+  def reset(self):
+    # these 3 counters remain for backward compatiblity
+    self.nrequests = 0
+    # -1 because the first attempt is not really a 'retry'
+    self.dbretries = -1
+    self.qretries = -1
+
+    # all cost info is tracked in this dict
+    # this includes cost info returned by GQL
+    self.totalcost = defaultdict(float)
+
+
+class RequestState(RequestCost, threading.local):
+  """RequestCost of the request running on the current thread."""
+
+
+def request_property(name):
+  """A GraphConnector attribute kept in its RequestState."""
+
+  def get(self):
+    return getattr(self.request_state, name)
+
+  def set(self, value):
+    setattr(self.request_state, name, value)
+
+  return property(get, set)
+
+
 class GraphConnector(object):
   """Handle for all context of all queries to the graph.
 
@@ -116,6 +159,11 @@ class GraphConnector(object):
     transmit_query(self, query, policy, epoch_deadline):
        send a GQL message with the specified policy
 
+  and may implement:
+    transmit_queries(self, queries, policy, epoch_deadline):
+       send several GQL messages, returning the replies in order.
+       The default sends them one at a time with transmit_query.
+
   """
 
   # TODO(bneutra): strip out all the policy stuff
@@ -126,11 +174,28 @@ class GraphConnector(object):
                no_timeouts=False,
                policy_map=None,
                default_policy=None,
-               custom_policy=None):
+               custom_policy=None,
+               coalesce_reads=False,
+               reply_cache_bytes=0,
+               reply_cache_ttl=10.0):
 
+    self.request_state = RequestState()
     self.reset_cost()
     self.timeout_policies = policy_map
 
+    # optionally, identical reads made at the same time by several
+    # threads share one graph request; see InflightReads.
+    if coalesce_reads:
+      self.inflight_reads = InflightReads()
+    else:
+      self.inflight_reads = None
+
+    # optional LRU of read replies; see ReplyCache.
+    if reply_cache_bytes:
+      self.reply_cache = ReplyCache(reply_cache_bytes, reply_cache_ttl)
+    else:
+      self.reply_cache = None
+
     if default_policy:
       self.default_policy = default_policy
     else:
@@ -162,6 +227,24 @@ class GraphConnector(object):
     _ = q, policy, epoch_deadline, kwargs
     raise NotImplemented
 
+  def transmit_queries(self, qs, policy, epoch_deadline, **kwargs):
+    """Transmit several queries to the graph.
+
+    Connectors that can pipeline requests (see TcpGraphConnector)
+    override this to send everything in a single round trip.
+
+    Args:
+      qs: list of graph queries
+      policy: map of various timeouts to use
+      epoch_deadline: float of time left before query becomes invalid
+
+    Returns:
+      list of results, in the same order as qs.
+    """
+    return [
+        self.transmit_query(q, policy, epoch_deadline, **kwargs) for q in qs
+    ]
+
   def validate_policy_map(self, required_keys):
     """Validate that the policy_map has the correct format.
 
@@ -221,18 +304,20 @@ class GraphConnector(object):
   default_policy = property(_get_default_policy, _set_default_policy, None,
                             _doc_default_policy)
 
+  # The cost and dateline of a request are kept per thread, so that a
+  # connector shared by threads (see TcpGraphConnector's pool mode)
+  # charges each request only for its own graph requests.
+  nrequests = request_property('nrequests')
+  dbretries = request_property('dbretries')
+  qretries = request_property('qretries')
+  totalcost = request_property('totalcost')
+  dateline = request_property('dateline')
+  addr = request_property('addr')
+
   def reset_cost(self):
 
     LOG.debug('resetting graphd costs')
-    # these 3 counters remain for backward compatiblity
-    self.nrequests = 0
-    # -1 because the first attempt is not really a 'retry'
-    self.dbretries = -1
-    self.qretries = -1
-
-    # all cost info is tracked in this dict
-    # this includes cost info returned by GQL
-    self.totalcost = defaultdict(float)
+    self.request_state.reset()
 
   def _get_policy(self, policy=None):
     if policy is None:
@@ -272,10 +357,144 @@ class GraphConnector(object):
   def _generate_and_transmit_query(self, gql, varenv, mode):
     """Generate Modifiers for "envelope" of query and send."""
 
+    return self._generate_and_transmit_queries([gql], varenv, mode)[0]
+
+  def _generate_and_transmit_queries(self, gqls, varenv, mode):
+    """Generate Modifiers for "envelope" of several queries and send."""
+
+    if mode is ReadMode and len(gqls) == 1:
+      if self.reply_cache is not None:
+        return [self._cached_read(gqls[0], varenv)]
+      if self.inflight_reads is not None:
+        return [self._coalesced_read(gqls[0], varenv)]
+
+    return self._generate_and_transmit_queries_uncoalesced(gqls, varenv, mode)
+
+  def _cached_read(self, gql, varenv):
+    """Read gql through the reply cache.
+
+    A cached reply is good for a request if it is younger than the
+    cache ttl and at least as new as the request's write_dateline.
+    """
+
+    asof = None
+    if varenv.get('mql_query'):
+      asof = varenv.get('asof')
+    key = (gql, asof)
+
+    result = self.reply_cache.get(key, varenv.get('write_dateline'))
+    if result is not None:
+      self.totalcost['gch'] += 1
+      return copy_result(result)
+
+    self.totalcost['gcm'] += 1
+    if self.inflight_reads is not None:
+      result = self._coalesced_read(gql, varenv)
+    else:
+      result = self._generate_and_transmit_queries_uncoalesced([gql], varenv,
+                                                               ReadMode)[0]
+
+    evictions = self.reply_cache.put(key, copy_result(result))
+    if evictions:
+      self.totalcost['gce'] += evictions
+    return result
+
+  def _get_transmit_args(self, varenv):
+    """Returns (policy, epoch_deadline, kwargs) for transmit_queries."""
+
     policy = self._get_policy(varenv.get('policy'))
     # epoch_deadline is passed in by the caller
     # its unix epoch float by which time all work must be done here.
     epoch_deadline = varenv.get('epoch_deadline', None)
+
+    # set up quota user:
+    quota_user_id = None
+    if varenv.get('project_id'):
+      quota_user_id = 'project_id:' + varenv.get('project_id')
+
+    is_continuation = varenv.get('is_write_continuation', False)
+    is_idempotent = varenv.get('is_idempotent', False)
+
+    return policy, epoch_deadline, {
+        'quota_user_id': quota_user_id,
+        'continuation': is_continuation,
+        'idempotent': is_idempotent
+    }
+
+  # upper bounds, in seconds left to the deadline, of the classes of
+  # deadlines that reads are coalesced within; see _coalesce_key.
+  COALESCE_DEADLINE_CLASSES = (0.1, 1.0, 10.0, 100.0)
+
+  def _coalesce_key(self, gql, varenv):
+    """Reads with the same key may share one graph request.
+
+    That is, they make the same request, less its id= modifier, under
+    the same timeout policy, with about as long left to their deadlines.
+    """
+
+    policy = varenv.get('policy') or self.default_policy
+    if isinstance(policy, dict):
+      policy = repr(sorted(policy.iteritems()))
+
+    deadline_class = None
+    epoch_deadline = varenv.get('epoch_deadline')
+    if epoch_deadline is not None:
+      remaining = epoch_deadline - time.time()
+      for deadline_class in self.COALESCE_DEADLINE_CLASSES:
+        if remaining <= deadline_class:
+          break
+      else:
+        deadline_class = None
+
+    return (self._generate_query(gql, varenv, ReadMode, with_id=False),
+            policy, deadline_class)
+
+  def _coalesced_read(self, gql, varenv):
+    """Read gql, sharing the request with identical reads in flight.
+
+    Reads are identical if they have the same _coalesce_key. The first
+    one (the leader) goes to the graph, and is charged the cost; the
+    others wait for it, until their own deadline at most, and count as
+    'gqc'. Everybody gets their own copy of the reply, since readers
+    change them in place.
+    """
+
+    key = self._coalesce_key(gql, varenv)
+    call, leader = self.inflight_reads.join(key)
+
+    if not leader:
+      self.totalcost['gqc'] += 1
+      LOG.debug('graph.read.coalesced', '', gql=gql)
+      timeout = None
+      epoch_deadline = varenv.get('epoch_deadline')
+      if epoch_deadline is not None:
+        timeout = max(epoch_deadline - time.time(), 0)
+      return copy_result(call.wait(timeout))
+
+    try:
+      result = self._generate_and_transmit_queries_uncoalesced([gql], varenv,
+                                                               ReadMode)[0]
+      call.set_result(result)
+    except:
+      call.set_error(sys.exc_info())
+      raise
+    finally:
+      followers = self.inflight_reads.leave(key, call)
+
+    if followers:
+      # keep ours pristine for the followers to copy
+      return copy_result(result)
+    return result
+
+  def _generate_and_transmit_queries_uncoalesced(self, gqls, varenv, mode):
+    policy, epoch_deadline, kwargs = self._get_transmit_args(varenv)
+    full_queries = [self._generate_query(gql, varenv, mode) for gql in gqls]
+    return self.transmit_queries(full_queries, policy, epoch_deadline,
+                                 **kwargs)
+
+  def _generate_query(self, gql, varenv, mode, with_id=True):
+    """Wrap gql in the request envelope; returns the full GQL request."""
+
     modifiers = []
 
     # we always set a maximum graphd 'user time' in ms
@@ -322,38 +541,40 @@ class GraphConnector(object):
     # Modifier: Tid
     #   Legacy Transaction Id
     #
-    transaction_id = varenv.get('tid')
-    if transaction_id is None:
-      transaction_id = generate_transaction_id('graph_%s' % str(mode))
-    modifiers.append(('id', '"%s"' % transaction_id))
+    if with_id:
+      transaction_id = varenv.get('tid')
+      if transaction_id is None:
+        transaction_id = generate_transaction_id('graph_%s' % str(mode))
+      modifiers.append(('id', '"%s"' % transaction_id))
 
     modifiers = ' '.join(('%s=%s' % x) for x in modifiers)
 
-    # set up quota user:
-    quota_user_id = None
-    if varenv.get('project_id'):
-      quota_user_id = 'project_id:' + varenv.get('project_id')
-
-    is_continuation = varenv.get('is_write_continuation', False)
-    is_idempotent = varenv.get('is_idempotent', False)
-
-    full_query = '%s %s %s' % (mode, modifiers, gql)
-    return self.transmit_query(
-        full_query,
-        policy,
-        epoch_deadline,
-        quota_user_id=quota_user_id,
-        continuation=is_continuation,
-        idempotent=is_idempotent)
+    return '%s %s %s' % (mode, modifiers, gql)
 
   def read_varenv(self, qs, varenv):
     """Read from the graph the specified "query"."""
+    return self.read_varenv_multiple([qs], varenv)[0]
+
+  def read_varenv_multiple(self, qs_list, varenv):
+    """Read several independent queries from the graph in one go.
+
+    The queries share the varenv (and so the dateline, asof and
+    policy) and are handed to transmit_queries together, which lets a
+    pipelining connector answer all of them in a single round trip.
+
+    Args:
+      qs_list: list of GQL query strings
+      varenv: the varenv of the request
+
+    Returns:
+      list of graph results, in the same order as qs_list.
+    """
     try:
       # the pymql user provides a 'write_dateline', which should be a valid
       # dateline returned to said user by a previous mqlwrite query
       dateline_in = varenv.get('write_dateline', None)
 
-      r = self._generate_and_transmit_query(qs, varenv, ReadMode)
+      rs = self._generate_and_transmit_queries(qs_list, varenv, ReadMode)
 
     except MQLDatelineInvalidError:
       # Drop the datelines out of the varenv,
@@ -366,12 +587,19 @@ class GraphConnector(object):
                varenv.get('write_dateline'))
       varenv['write_dateline'] = ''
 
-      r = self._generate_and_transmit_query(qs, varenv, ReadMode)
+      rs = self._generate_and_transmit_queries(qs_list, varenv, ReadMode)
 
-    if not r and varenv.get('graph_noisy'):
-      raise EmptyResult('query %s' % qs)
+    return self._finish_read(qs_list, rs, varenv, dateline_in)
 
-    dateline_out = r.dateline
+  def _finish_read(self, qs_list, rs, varenv, dateline_in):
+    """Record the dateline of a completed read in the varenv."""
+
+    if varenv.get('graph_noisy'):
+      for qs, r in zip(qs_list, rs):
+        if not r:
+          raise EmptyResult('query %s' % qs)
+
+    dateline_out = rs[-1].dateline
 
     # 'dateline' is returned to the original caller of pymql read.
     # though, in practice, it is not passed on by frapi and
@@ -389,21 +617,24 @@ class GraphConnector(object):
 
     LOG.debug('graph.dateline.set', '', dateline=varenv['dateline'])
 
-    return r
-
-  def write_varenv(self, qs, varenv):
-    """Write to the graph the specified "query"."""
+    return rs
 
+  def _check_writable(self):
     if getattr(self, 'readonly', None):
       raise GraphConnectionError(
           'Tried to write to a read-only graph',
           http_code=500,
           app_code='/mqlwrite/backend/read_only')
 
-    dateline_in = varenv.get('write_dateline', None)
-
     self.write_occurred = 1
 
+  def write_varenv(self, qs, varenv):
+    """Write to the graph the specified "query"."""
+
+    self._check_writable()
+
+    dateline_in = varenv.get('write_dateline', None)
+
     try:
       r = self._generate_and_transmit_query(qs, varenv, WriteMode)
 
@@ -416,6 +647,11 @@ class GraphConnector(object):
 
       r = self._generate_and_transmit_query(qs, varenv, WriteMode)
 
+    return self._finish_write(r, varenv, dateline_in)
+
+  def _finish_write(self, r, varenv, dateline_in):
+    """Record the dateline of a completed write in the varenv."""
+
     dateline_out = r.dateline
 
     # update our write_dateline in case we do subsequent reads
@@ -454,3 +690,168 @@ class GraphConnector(object):
           self.totalcost[k] += v
         else:
           self.totalcost[k] = v
+
+
+class InflightReads(object):
+  """Graph reads in progress, by request text, for _coalesced_read."""
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.calls = {}
+
+  def join(self, key):
+    """Returns (call, leader); leader is True if the caller must send."""
+    with self.lock:
+      call = self.calls.get(key)
+      if call is not None:
+        call.followers += 1
+        return call, False
+      call = self.calls[key] = InflightRead()
+      return call, True
+
+  def leave(self, key, call):
+    """Forget the leader's call; returns how many followers it had."""
+    with self.lock:
+      if self.calls.get(key) is call:
+        del self.calls[key]
+      return call.followers
+
+
+class InflightRead(object):
+  """One read that other threads are waiting for."""
+
+  def __init__(self):
+    self.done = threading.Event()
+    self.followers = 0
+    self.result = None
+    self.exc_info = None
+
+  def set_result(self, result):
+    self.result = result
+    self.done.set()
+
+  def set_error(self, exc_info):
+    self.exc_info = exc_info
+    self.done.set()
+
+  def wait(self, timeout=None):
+    """The leader's reply, waiting at most timeout seconds for it."""
+    if not self.done.wait(timeout):
+      raise MQLTimeoutError(
+          None, 'No more time in deadline to wait for a coalesced read')
+    if self.exc_info is not None:
+      raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+    return self.result
+
+
+def parse_dateline(dateline):
+  """Split a graphd dateline into (instance, position), or None.
+
+  Datelines are either a bare number or '<instance>,<guid>', in which
+  case the position is the primitive id in the guid. Only datelines of
+  the same instance can be compared.
+  """
+
+  if not dateline:
+    return None
+  if dateline.isdigit():
+    return ('', int(dateline))
+
+  m = re.match(r'^(\w+),([0-9a-f]{16})([0-9a-f]{16})$', dateline)
+  if m is None:
+    return None
+  return (m.group(1) + m.group(2), int(m.group(3), 16))
+
+
+def dateline_covers(have, want):
+  """True if a reply at dateline have is fresh enough for dateline want."""
+
+  if not want:
+    return True
+  if have == want:
+    return True
+
+  have = parse_dateline(have)
+  want = parse_dateline(want)
+  if have is None or want is None or have[0] != want[0]:
+    return False
+  return want[1] <= have[1]
+
+
+class ReplyCache(object):
+  """In process LRU of graph read replies, bounded in bytes of reply text.
+
+  Entries expire after ttl seconds, and are only handed out to requests
+  whose write_dateline they cover. get() and put() return and take
+  replies that must not be changed; callers copy them.
+  """
+
+  def __init__(self, max_bytes, ttl):
+    self.max_bytes = max_bytes
+    self.ttl = ttl
+    self.lock = threading.Lock()
+
+    # key -> (result, time stored), least recently used first
+    self.entries = OrderedDict()
+    self.nbytes = 0
+
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def _remove(self, key):
+    result, _ = self.entries.pop(key)
+    self.nbytes -= result.nbytes
+
+  def get(self, key, write_dateline):
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is not None:
+        result, stored = entry
+        if stored < time.time() - self.ttl:
+          self._remove(key)
+        elif dateline_covers(result.dateline, write_dateline):
+          del self.entries[key]
+          self.entries[key] = entry
+          self.hits += 1
+          return result
+
+      self.misses += 1
+      return None
+
+  def put(self, key, result):
+    """Cache result; returns the number of entries evicted for it."""
+
+    nbytes = getattr(result, 'nbytes', None)
+    if nbytes is None or nbytes > self.max_bytes:
+      return 0
+
+    evictions = 0
+    with self.lock:
+      if key in self.entries:
+        self._remove(key)
+      self.entries[key] = (result, time.time())
+      self.nbytes += nbytes
+
+      while self.nbytes > self.max_bytes:
+        self._remove(next(iter(self.entries)))
+        evictions += 1
+      self.evictions += evictions
+
+    return evictions
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.nbytes = 0
+
+  def stats(self):
+    with self.lock:
+      return {
+          'entries': len(self.entries),
+          'bytes': self.nbytes,
+          'max_bytes': self.max_bytes,
+          'hits': self.hits,
+          'misses': self.misses,
+          'evictions': self.evictions,
+      }
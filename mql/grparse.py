@@ -98,7 +98,37 @@ cost_parameters = [
     ('gcr', 'graph connect retries',
      'the number of times that ME tried to open a connection to a graph'),
     ('gqr', 'graph query retries',
-     'the number of times that ME tried to service a query from a single graph')
+     'the number of times that ME tried to service a query from a single graph'
+    ),
+    ('gpw', 'graph pool/wait',
+     'seconds spent waiting for a pooled graph connection to become free'),
+    ('gpu', 'graph pool/in use',
+     'most connections to one graph checked out of the pool, by all '
+     'requests, when this request took one'),
+    ('gpq', 'graph pool/queued',
+     'most callers seen waiting for a pooled graph connection'),
+    ('ghr', 'graph hedge/requests',
+     'the number of reads that ME also sent to a second graph because the '
+     'first was slow to answer'),
+    ('ghw', 'graph hedge/wins',
+     'the number of hedged reads where the second graph answered first'),
+    ('ght', 'graph hedge/time',
+     'seconds that the losing side of hedged reads ran before being dropped'),
+    ('grs', 'graph retries/spent',
+     'the number of graph request retries ME made, over all requests'),
+    ('grb', 'graph retries/over budget',
+     'the number of retries ME gave up on because the process wide retry '
+     'budget was exhausted'),
+    ('gqc', 'graph query coalesced',
+     'the number of reads that were answered by an identical read already '
+     'in flight, rather than sent to the graph'),
+    ('gch', 'graph reply cache/hit',
+     'the number of reads answered from the in process graph reply cache'),
+    ('gcm', 'graph reply cache/miss',
+     'the number of reads that missed the in process graph reply cache'),
+    ('gce', 'graph reply cache/evict',
+     'the number of replies pushed out of the graph reply cache to make '
+     'room for the ones this request read')
 ]
 
 costcode_dict = dict([(cc[0], (cc[1], cc[2])) for cc in cost_parameters])
@@ -117,20 +147,56 @@ graphresult_re = re.compile(
     r'(\(|\)| |\-\>|\<\-|[a-z]+\=|[\-\:\._A-Za-z0-9]+|\"(?:[^\"\\]|\\[\\\"n])*\")'
 )
 
+# the same tokens, for ReplyParser, plus the newline that ends a
+# reply. A string can't run on past the end of its reply. At the end of
+# a chunk, a string that is still open and a lone < are tokens of their
+# own, to be finished with the next chunk.
+replytoken_re = re.compile(
+    r'[\(\)\n]|\-\>|\<\-|[a-z]+\=|[\-\:\._A-Za-z0-9]+|'
+    r'\"(?:[^\"\\\n]|\\[\\\"n])*(?:\"|\\?\Z)|\<\Z')
+# what may follow the start of a token cut off by the end of a chunk
+barechars_re = re.compile(r'[\-\:\._A-Za-z0-9]*')
+stringchars_re = re.compile(r'(?:[^\"\\\n]|\\[\\\"n])*')
+
 
 class GraphResult(list):
   pass
 
 
+def copy_result(result):
+  """Copy a parsed reply, so that it can be changed by another reader.
+
+  The nested lists are copied; the token strings and reply attributes
+  are shared.
+  """
+  items = [
+      copy_result(item) if isinstance(item, list) else item for item in result
+  ]
+  if type(result) is list:
+    return items
+  copy = type(result)(items)
+  copy.__dict__.update(result.__dict__)
+  return copy
+
+
 class ReplyParser:
   """
-    parses a graphd reply char by char.
+    parses graphd replies incrementally, one chunk at a time.
       paren lists are broken up into python lists
       all list elements are returned as strings
+
+    Each chunk is tokenized as it arrives and the nested result lists
+    are built as we go. A token cut off by the end of a chunk is kept
+    in pieces until a later chunk finishes it; only the new chunks are
+    looked at meanwhile, so a long string costs no more to parse when
+    it arrives in many chunks.
+
+    Replies are always built in full. MQL walks every result it reads,
+    and lists tokenized only when first used were slower for every
+    kind of reply it gets, counts and uniqueness probes included.
     """
 
   def __init__(self):
-    self.inbuf = []
     self.replyqueue = []
 
     self.reset_parser()
@@ -138,37 +204,150 @@ class ReplyParser:
   def reset_parser(self):
     # parser state
 
-    self.instring = 0  # true if we have read an open " but no close
-    self.escaped = 0  # true if we just read a backslash
-    # if instring is 1, curstr is a list of characters that
-    #  will be joined to make the string
-    self.curstr = []
-    self.curreply = []  # list of strings - join when ready to
-    # use (faster than string concat)
-
-  def parsestr(self, s):
-    if '\n' in s:
-      # parse all of the 'completed' lines, and if there is an
-      # uncompleted line at the end of s, leave it in curreply
-
-      reply_list = s.split('\n')
-
-      self.curreply.append(reply_list.pop(0))
+    # pieces of a token cut off by the end of the last chunk(s)
+    self.partial = []
+    # the partial token is a string, and ends in the \ of an escape
+    self.partial_string = False
+    self.partial_escape = False
+    self.curlist = []  # list we are adding tokens to
+    self.stack = []  # enclosing lists of curlist
+    self.ntokens = 0
+    self.nbytes = 0  # length of the current reply so far, less the partial
+
+  @property
+  def tail(self):
+    """The start of a token cut off by the end of the last chunk."""
+    return ''.join(self.partial)
+
+  def _continue_partial(self, s):
+    """Add what belongs to the partial token from the start of chunk s.
+
+    Returns:
+      None if all of s does, and the token goes on in the next chunk;
+      the offset in s just past the closing quote if the token is a
+      string that is now whole, and is in self.partial; or 0 if the
+      token has to be tokenized again along with s.
+    """
 
-      for reply in reply_list:
+    if self.partial_string:
+      pos = 0
+      if self.partial_escape:
+        if not s or s[0] not in '\\"n':
+          # a bad escape; tokenizing again makes it a stray quote
+          return 0
+        pos = 1
+      end = stringchars_re.match(s, pos).end()
+      if end == len(s):
+        self.partial_escape = False
+      elif end == len(s) - 1 and s[end] == '\\':
+        self.partial_escape = True
+      elif s[end] == '"':
+        self.partial.append(s[:end + 1])
+        return end + 1
+      else:
+        return 0
+    elif barechars_re.match(s).end() != len(s):
+      return 0
 
-        # parse the previous reply
-        replystr = ''.join(self.curreply)
-        self.parse_full_reply(replystr)
-        self.reset_parser()
+    self.partial.append(s)
+    return None
 
-        # now add the current line
-        self.curreply.append(reply)
+  def _cut_off(self, tok):
+    """True if tok, found at the very end of a chunk, may not be whole."""
+
+    c = tok[0]
+    if c == '"':
+      if len(tok) > 1 and tok[-1] == '"':
+        # closed unless the quote is escaped
+        i = len(tok) - 2
+        while tok[i] == '\\':
+          i -= 1
+        if (len(tok) - 2 - i) % 2 == 0:
+          return False
+      self.partial_string = True
+      i = len(tok) - 1
+      while tok[i] == '\\':
+        i -= 1
+      self.partial_escape = (len(tok) - 1 - i) % 2 == 1
+      return True
+    if c in '()\n':
+      return False
+    # a bare token or a lone <, but not a modifier= or ->
+    self.partial_string = False
+    return tok[-1] not in '=>'
 
-      # note that we're not processing the last line, because it is incomplete
+  def parsestr(self, s):
+    """Parse the next chunk of graphd output.
 
-    else:
-      self.curreply.append(s)
+    Args:
+      s: a str, or a buffer() over the bytes just received.
+    """
+    s = str(s)
+
+    tokens = []
+    if self.partial:
+      end = self._continue_partial(s)
+      if end is None:
+        return
+      if end:
+        # a whole string
+        tokens.append(''.join(self.partial))
+        self.nbytes += len(tokens[0])
+        s = s[end:]
+      else:
+        # the token ends in this chunk: tokenize it whole, once
+        self.partial.append(s)
+        s = ''.join(self.partial)
+      self.partial = []
+
+    LOG.debug('graph.result', s)
+
+    tokens += replytoken_re.findall(s)
+    if tokens and s.endswith(tokens[-1]) and self._cut_off(tokens[-1]):
+      self.partial.append(tokens.pop())
+
+    curlist = self.curlist
+    stack = self.stack
+    ntokens = self.ntokens
+    base = 0  # where the current reply starts in s
+
+    try:
+      for tok in tokens:
+        if tok == '(':
+          stack.append(curlist)
+          curlist = []
+        elif tok == ')':
+          if not stack:
+            raise MQLGraphError(
+                None, 'unbalanced ) in graph reply', reply=curlist)
+          sublist = curlist
+          curlist = stack.pop()
+          curlist.append(sublist)
+        elif tok == '\n':
+          if stack:
+            raise MQLGraphError(
+                None,
+                'got linefeed in the middle of a reply?',
+                reply=stack[0],
+                depth=len(stack))
+          LOG.debug('graph.result.parsed', 'Parsed %d tokens' % ntokens)
+          end = s.index('\n', base) + 1
+          self.replyqueue.append((curlist, self.nbytes + end - base))
+          curlist = []
+          ntokens = 0
+          self.nbytes = 0
+          base = end
+        else:
+          curlist.append(tok)
+          ntokens += 1
+
+    except MQLGraphError:
+      self.reset_parser()
+      raise
+
+    self.curlist = curlist
+    self.ntokens = ntokens
+    self.nbytes += len(s) - base - len(self.tail)
 
   def parse_full_reply(self, replystr):
     """
@@ -176,47 +355,11 @@ class ReplyParser:
         nested lists of tokens. Results are in the form:
         [ 'ok', 'id=', '"me;..."', [[['010000..', '01...', ...]]]]
         """
-    LOG.debug('graph.result', replystr)
-    token_list = graphresult_re.findall(replystr)
-
-    curlist = []
-
-    stack = []
-    push_state = stack.append
-    pop_state = stack.pop
-
-    for count, tok in enumerate(token_list):
-      if tok == '(':
-        push_state(curlist)
-        curlist = []
-      elif tok == ')':
-        sublist = curlist
-        curlist = pop_state()
-        curlist.append(sublist)
-      elif tok == '\n':
-        raise MQLGraphError(
-            None,
-            'Not allowed a newline in parse_full_reply',
-            reply=replystr,
-            tokens=token_list)
-      elif tok == ' ' or tok == '':
-        pass
-      else:
-        curlist.append(tok)
-
-    LOG.debug('graph.result.parsed', 'Parsed %d tokens' % count)
-    if len(stack) != 0:
-      raise MQLGraphError(
-          None,
-          'got linefeed in the middle of a reply?',
-          reply=replystr,
-          tokens=token_list,
-          depth=len(stack))
-
-    self.replyqueue.append(curlist)
+    self.parsestr(replystr + '\n')
 
   def get_reply_raw(self):
-    return self.replyqueue.pop(0)
+    l, self.reply_nbytes = self.replyqueue.pop(0)
+    return l
 
   def get_reply(self):
     l = self.get_reply_raw()
@@ -224,6 +367,8 @@ class ReplyParser:
     result.status = l.pop(0)
     result.cost = None
     result.dateline = None
+    # size of the reply text, including the newline
+    result.nbytes = self.reply_nbytes
 
     if result.status == 'ok':
       result += l.pop()
@@ -266,9 +411,6 @@ class ReplyParser:
           dateline=result.dateline)
     return result
 
-  def put_buf(self, buf):
-    self.inbuf.append(buf)
-
   def isready(self):
     return len(self.replyqueue) > 0
 
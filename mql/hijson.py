@@ -25,7 +25,8 @@ import json
 from utils import (QueryDict, QueryList, element, high_elements, ReadMode,
                    WriteMode, CheckMode, valid_comparison,
                    make_comparison_truekey, valid_high_idname, valid_mql_key,
-                   reserved_word, valid_guid, valid_key, valid_mid, Missing)
+                   reserved_word, valid_guid, valid_idname, valid_key,
+                   valid_mid, Missing)
 import schema
 
 from readqp import ReadQP
@@ -33,12 +34,17 @@ from readqp import ReadQP
 import pprint
 import traceback
 import copy
+import threading
 import time
+from collections import defaultdict
+from collections import OrderedDict
 from pymql.mql.env import Varenv, DeferredGuidLookup, DeferredGuidLookups, Guid, \
     FixedGuidList, DeferredGuidOfMidLookup, DeferredGuidOfMidLookups, \
     DeferredGuidOfMidOrGuidLookups
 
 from pymql.mql.error import MQLError, MQLParseError, MQLInternalError, MQLTypeError
+from pymql.mql.error import MQLDatelineInvalidError
+from pymql.mql.graph.connector import dateline_covers
 
 from pymql.mql import mid
 import resource
@@ -53,7 +59,13 @@ class HighQuery(object):
   write_directives = set(['create', 'connect'])
   directives = read_directives | write_directives
 
-  def __init__(self, lowq, transaction_id=None, cached_lowq=None):
+  def __init__(self,
+               lowq,
+               transaction_id=None,
+               cached_lowq=None,
+               plan_cache_size=0,
+               missing_schema_ttl=60.0,
+               schema_snapshots=False):
 
     varenv = {'tid': transaction_id}
 
@@ -72,6 +84,21 @@ class HighQuery(object):
     self._schema_factory = None
     self._init_varenv = varenv
 
+    # see attach_shared_cache()
+    self.shared_cache = None
+    # whether snapshot() can be used; see SchemaFactory's keep_json
+    self.schema_snapshots = schema_snapshots
+
+    # off by default, like the graph reply cache: on a miss every read
+    # pays for lifting its params out and keying the plan.
+    if plan_cache_size:
+      self.plan_cache = QueryPlanCache(plan_cache_size)
+    else:
+      self.plan_cache = None
+
+    # MQLTypeErrors that refreshing the schema didn't fix
+    self.missing_schema = MissingSchemaCache(1000, missing_schema_ttl)
+
   # Lazily load these.
   @property
   def has_right_order(self):
@@ -99,8 +126,11 @@ class HighQuery(object):
   @property
   def schema_factory(self):
     if not self._schema_factory:
-      self._schema_factory = schema.SchemaFactory(self.cached_querier,
-                                                  self._init_varenv)
+      self._schema_factory = schema.SchemaFactory(
+          self.cached_querier,
+          self._init_varenv,
+          shared=self.shared_cache,
+          keep_json=self.schema_snapshots)
     return self._schema_factory
 
   @property
@@ -111,9 +141,81 @@ class HighQuery(object):
                                           self._init_varenv))
     return self._has_left_order
 
+  def snapshot(self):
+    """The schema and namespaces cached, as plain data.
+
+    See mql/snapshot.py; restore_snapshot() takes it back. Only made
+    with schema_snapshots.
+    """
+    return {
+        'schema': self.schema_factory.snapshot(),
+        'namespaces': self.querier.lookup.namemap.snapshot()
+    }
+
+  def attach_shared_cache(self, shared, varenv):
+    """Look in shared, a sharedcache.SharedSchemaCache, on cache misses.
+
+    Our own caches are looked in first. Namespace entries and ids found
+    in shared aren't copied into them; types are, as they are built
+    into objects of our own. Flushing the caches stops using shared.
+
+    shared is caught up first with what has been written since it was
+    built, as restore_snapshot() does. Returns False, and leaves shared
+    unused, if the graph can't say what (a different graph, or one
+    rebuilt since).
+    """
+    if shared.dateline is None:
+      LOG.warning('mql.hijson.attach_shared_cache',
+                  'shared cache has no dateline, not using it')
+      return False
+
+    try:
+      shared.catch_up(self.querier.gc, varenv)
+    except MQLDatelineInvalidError:
+      LOG.warning('mql.hijson.attach_shared_cache',
+                  'shared cache is from another graph, not using it')
+      return False
+
+    self.shared_cache = shared
+    self.querier.lookup.attach_shared(shared)
+    if self._schema_factory is not None:
+      self._schema_factory.shared = shared
+      self._schema_factory.forgotten.clear()
+    return True
+
+  def restore_snapshot(self, snapshot, varenv):
+    """Start from an earlier snapshot() rather than an empty cache.
+
+    What has been written since is caught up on with a graph read or
+    two. If the graph can't say what (a different graph, or one rebuilt
+    since), the caches are flushed instead.
+    """
+    namemap = self.querier.lookup.namemap
+    namemap.restore(snapshot['namespaces'])
+
+    schema_factory = schema.SchemaFactory(
+        self.cached_querier,
+        varenv,
+        snapshot['schema'],
+        shared=self.shared_cache,
+        keep_json=self.schema_snapshots)
+    if self._schema_factory is not None:
+      # plans compiled against the old one mustn't be used
+      schema_factory.generation = self._schema_factory.generation + 1
+    self._schema_factory = schema_factory
+
+    try:
+      namemap.catch_up(varenv)
+      schema_factory.catch_up(varenv)
+    except MQLDatelineInvalidError:
+      LOG.warning('mql.hijson.restore_snapshot',
+                  'snapshot is from another graph, flushing it')
+      self.querier.lookup.flush()
+      schema_factory.flush(varenv)
+
   def reset_cost(self):
 
-    cost_keys = ('mql_utime', 'mql_stime', 'mql_rtime')
+    cost_keys = ('mql_utime', 'mql_stime', 'mql_rtime', 'mql_plan_hits')
     # add them to other costs
     for m in cost_keys:
       self.querier.gc.totalcost[m] = 0
@@ -209,6 +311,23 @@ class HighQuery(object):
     if orig_varenv.get('normalize_only'):
       return self.normalize(orig_query, orig_varenv)
 
+    return self.read_planned(orig_query, orig_varenv, self.planned_graph_query)
+
+  def read_prepared(self, template, params, orig_varenv):
+    """Read template (from prepare()) with its placeholders set to params."""
+
+    orig_query = template.substitute(params)
+
+    self.cost_start()
+
+    def plan_query(orig_query, varenv, transaction_id):
+      return self.prepared_graph_query(template, params, varenv)
+
+    return self.read_planned(orig_query, orig_varenv, plan_query)
+
+  def read_planned(self, orig_query, orig_varenv, plan_query):
+    """The body of read(); plan_query() gives the tree and GQL to use."""
+
     varenv = Varenv(orig_varenv, self.querier.lookup)
 
     transaction_id = varenv.get('tid')
@@ -216,11 +335,15 @@ class HighQuery(object):
     LOG.debug('mql.query', '', mql=orig_query)
 
     try:
-      mquery, gquery = self.create_graph_query(orig_query, varenv,
-                                               transaction_id)
+      mquery, gquery, plan = plan_query(orig_query, varenv, transaction_id)
       gresult = self.graph_read(gquery, varenv)
       high_result = self.create_mql_result(mquery, gresult, varenv)
 
+      # a plan that failed part way is dropped rather than handed back,
+      # its ReadQP tree may be left holding half a result.
+      if plan is not None:
+        plan.cache.checkin(plan)
+
       LOG.debug('mql.result', '', mql=high_result)
 
       # yuck -- I hate the cursor side-effect too!
@@ -239,6 +362,121 @@ class HighQuery(object):
       self.cost_end()
       raise
 
+  def read_many(self, orig_queries, orig_varenvs):
+    """Read several independent queries, sharing their round trips.
+
+    The id and mid lookups of all the queries are made together, before
+    and after the main reads, and the main reads are sent to the graph
+    in one read_varenv_multiple(). So the batch takes about as many
+    round trips as a single read() rather than as many per query.
+
+    Args:
+      orig_queries: dict of key -> mql query
+      orig_varenvs: dict of key -> varenv, as for read(). The graph
+        settings (asof, dateline, policy, deadline) are taken from one
+        of them, so they should only differ in their cursors.
+
+    Returns:
+      dict of key -> mql result, or the MQLError that query raised.
+      An error in the shared lookups is raised for the whole batch.
+    """
+
+    self.cost_start()
+
+    keys = sorted(orig_queries)
+    results = {}
+    if not keys:
+      self.cost_end()
+      return results
+
+    # the shared lookups and the main reads go through this varenv.
+    batch_varenv = Varenv(orig_varenvs[keys[0]], self.querier.lookup)
+    manager = batch_varenv.lookup_manager
+
+    try:
+      started = []
+      for key in keys:
+        varenv = Varenv(orig_varenvs[key], self.querier.lookup)
+        varenv.lookup_manager = manager
+
+        LOG.debug('mql.query', '', key=key, mql=orig_queries[key])
+
+        try:
+          query, plan = self.start_planned_graph_query(
+              orig_queries[key], varenv, varenv.get('tid'))
+        except MQLError, e:
+          results[key] = e
+          continue
+
+        started.append((key, varenv, query, plan))
+
+      manager.do_mid_and_guid_lookups()
+
+      gqueries = [
+          self.finish_planned_graph_query(query, plan, varenv)
+          for key, varenv, query, plan in started
+      ]
+      gresults = self.graph_read_many(gqueries, batch_varenv)
+
+      parsed = []
+      for (key, varenv, query, plan), gresult in zip(started, gresults):
+        if isinstance(gresult, MQLError):
+          results[key] = gresult
+          continue
+
+        try:
+          high_result = element(query).node.parse_result_root(gresult, varenv)
+        except MQLError, e:
+          results[key] = e
+          continue
+
+        parsed.append((key, varenv, plan, high_result))
+
+      # mids and ids, for every result in one graph read.
+      manager.do_mid_and_id_lookups()
+      manager.fill_result_slots()
+
+      for key, varenv, plan, high_result in parsed:
+        if plan is not None:
+          plan.cache.checkin(plan)
+
+        LOG.debug('mql.result', '', key=key, mql=high_result)
+
+        varenv['dateline'] = batch_varenv.get('dateline')
+        varenv.export(('cursor', 'vars_used', 'dateline', 'write_dateline'))
+
+        results[key] = high_result
+
+      return results
+
+    finally:
+      self.cost_end()
+
+  def graph_read_many(self, gqueries, varenv):
+    """graph_read() of each of gqueries, all in one round trip.
+
+    If the batch fails, each query is read on its own, so that a query
+    the graph rejects fails only its own key; those results are the
+    MQLError raised.
+    """
+    varenv['mql_query'] = True
+    try:
+      return self.querier.gc.read_varenv_multiple(gqueries, varenv)
+    except MQLError, e:
+      if len(gqueries) == 1:
+        return [e]
+      LOG.info('mql.read_many.retry', 'batch read failed', error=str(e))
+
+      gresults = []
+      for gquery in gqueries:
+        try:
+          gresults.append(self.querier.gc.read_varenv(gquery, varenv))
+        except MQLError, e:
+          gresults.append(e)
+      return gresults
+    finally:
+      del varenv['mql_query']
+
   def to_gql(self, tid, mql, varenv):
     """
         Return the GQL constraints for a MQL query
@@ -271,7 +509,12 @@ class HighQuery(object):
           varenv=varenv)
 
       # XXX fairly nasty hack for bug #889 and bug #892. If we can't find a type or property,
-      # maybe it is new and not in our type cache. If so, flush the type cache and try again...
+      # maybe it is new and not in our type cache. If so, drop the types and ids
+      # involved from the cache and try again...
+      if self.missing_schema.confirmed(str(e), varenv.get('write_dateline')):
+        # we already have, since the client's last write.
+        raise
+
       transaction_id = varenv.get('tid')
 
       # FIX:
@@ -294,8 +537,15 @@ class HighQuery(object):
           transaction_id=transaction_id,
           level=log_util.DEBUG,
           push=True)
-      self.querier.lookup.flush()
-      self.schema_factory.flush(varenv)
+      ids = schema_error_ids(e)
+      if ids:
+        for typepath in ids:
+          guid = self.schema_factory.forget_type(typepath)
+          self.querier.lookup.forget(typepath, guid)
+      else:
+        # the error doesn't say what is missing, so refresh everything.
+        self.querier.lookup.flush()
+        self.schema_factory.flush(varenv)
       pprintlog(
           'CACHE_FLUSH_%s_COMPLETE' % str(mode),
           str(e),
@@ -319,24 +569,121 @@ class HighQuery(object):
         return query
 
       except MQLTypeError, mt:
+        if str(mt) == str(e):
+          self.missing_schema.add(str(e), varenv.get('dateline'))
         raise
 
   def create_graph_query(self, orig_query, varenv, transaction_id):
+    query = self.compile_graph_query(orig_query, varenv)
+
+    # mids and ids, together in one round trip.
+    varenv.lookup_manager.do_mid_and_guid_lookups()
+
+    return (query, self.generate_graph_query(query))
+
+  def compile_graph_query(self, orig_query, varenv):
+    """The query tree, with its id lookups queued but not yet done."""
     query = self.resolve_schema(orig_query, ReadMode, varenv)
 
     self.add_query_primitive_root(element(query), varenv, ReadMode)
 
-    # two round trips.
-    varenv.lookup_manager.do_mid_to_guid_lookups()
-    # and..
-    varenv.lookup_manager.do_guid_lookups()
+    return query
 
+  def generate_graph_query(self, query):
     graph_query = []
     qpush = graph_query.append
     element(query).node.generate_graph_query(qpush)
     gquery = ''.join(graph_query)
     #print gquery
-    return (query, gquery)
+    return gquery
+
+  def planned_graph_query(self, orig_query, varenv, transaction_id):
+    """create_graph_query() through the plan cache.
+
+    Returns (query, gquery, plan). plan is None if the query was not
+    cached; otherwise the caller hands it back with plan.cache.checkin()
+    once the graph result has been parsed with it.
+    """
+    query, plan = self.start_planned_graph_query(orig_query, varenv,
+                                                 transaction_id)
+
+    # mids and ids, together in one round trip.
+    varenv.lookup_manager.do_mid_and_guid_lookups()
+
+    gquery = self.finish_planned_graph_query(query, plan, varenv)
+    return (query, gquery, plan)
+
+  def start_planned_graph_query(self, orig_query, varenv, transaction_id):
+    """planned_graph_query() up to its id lookups; returns (query, plan).
+
+    The lookups are left queued on varenv.lookup_manager, so that the
+    lookups of several queries can be done together before each is
+    finished with finish_planned_graph_query().
+
+    The ids, mids and text values in orig_query are lifted out into
+    params, as if it had been prepare()d, so that queries differing only
+    in those share a plan. Macros are expanded into the tree, so queries
+    using them are not cached.
+    """
+    template = None
+    if self.plan_cache is not None and not varenv.get('macro'):
+      template, params = QueryTemplate.lift(orig_query, self.plan_cache)
+
+    if template is None:
+      return (self.compile_graph_query(orig_query, varenv), None)
+
+    return self.start_prepared_graph_query(template, params, varenv)
+
+  def start_prepared_graph_query(self, template, params, varenv):
+    """start_planned_graph_query() for a QueryTemplate bound to params."""
+
+    if varenv.get('macro'):
+      return (self.compile_graph_query(template.substitute(params), varenv),
+              None)
+
+    plan = template.checkout(params, varenv, self.schema_factory.generation)
+    if plan is not None:
+      self.querier.gc.totalcost['mql_plan_hits'] += 1
+      plan.attach_params(params, varenv)
+      return (plan.query, plan)
+
+    manager = varenv.lookup_manager
+    marks = (len(manager.guid_lookups), len(manager.mid_to_guid_lookups))
+
+    # the tree keeps references into the query it was compiled from, and
+    # the plan rebinds them, so that is a copy of our own.
+    orig_query = template.substitute(params)
+    query = self.compile_graph_query(orig_query, varenv)
+
+    # resolve_schema() may have flushed the schema, so this is read after.
+    plan = PreparedPlan(template, self.schema_factory.generation, query,
+                        varenv, orig_query, params, marks)
+    return (query, plan)
+
+  def finish_planned_graph_query(self, query, plan, varenv):
+    """The GQL for start_planned_graph_query(), once the lookups are done."""
+    if plan is None:
+      return self.generate_graph_query(query)
+    return plan.generate(varenv)
+
+  def prepare(self, query_template):
+    """Make a QueryTemplate for read_prepared()."""
+    return QueryTemplate(query_template)
+
+  def prepared_graph_query(self, template, params, varenv):
+    """planned_graph_query() for a QueryTemplate bound to params.
+
+    The template keeps its own plans, keyed on the params that can't be
+    bound into a plan and the form of those that can, so a hit needs no
+    schema resolution even though the ids differ on every read.
+    """
+    query, plan = self.start_prepared_graph_query(template, params, varenv)
+
+    # mids and ids, together in one round trip.
+    varenv.lookup_manager.do_mid_and_guid_lookups()
+
+    gquery = self.finish_planned_graph_query(query, plan, varenv)
+    return (query, gquery, plan)
 
   def graph_read(self, query, varenv):
     # this is the real mql query so it gets the special flag to generate asof, cursor= etc.
@@ -352,12 +699,10 @@ class HighQuery(object):
   def create_mql_result(self, query, graph_result, varenv):
     high_result = element(query).node.parse_result_root(graph_result, varenv)
 
-    varenv.lookup_manager.do_guid_to_mid_lookups()
-    varenv.lookup_manager.do_id_lookups()
+    # mids and ids, together in one graph read.
+    varenv.lookup_manager.do_mid_and_id_lookups()
 
-    # this is ugly, but what else can I do???
-    high_result = varenv.lookup_manager.substitute_ids(high_result)
-    high_result = varenv.lookup_manager.substitute_mids(high_result)
+    varenv.lookup_manager.fill_result_slots()
 
     return high_result
 
@@ -3923,6 +4268,626 @@ class HighQuery(object):
         None, 'Unknown id from |= list', guid=guid, list=mapping.keys())
 
 
+class QueryPlan(object):
+  """A compiled mqlread: the resolved query tree with its ReadQP nodes.
+
+  The tree is shared by every request for the same plan key, so it only
+  keeps what is the same for all of them. What is not is bound per
+  request by bind(): the guids of the ids the query names, which are
+  looked up again each time so that renames and merges are seen, and the
+  cursor. The GQL is only generated again if those changed.
+  """
+
+  def __init__(self, cache, key, generation, query, gquery, varenv,
+               marks=(0, 0)):
+    self.cache = cache
+    self.key = key
+    self.generation = generation
+    self.query = query
+    self.gquery = gquery
+
+    # the id and mid lookups made while compiling; the manager may be
+    # shared with other queries, whose lookups come before marks.
+    manager = varenv.lookup_manager
+    guid_mark, mid_mark = marks
+    self.guid_lookups = manager.guid_lookups[guid_mark:]
+    self.mid_lookups = manager.mid_to_guid_lookups[mid_mark:]
+
+    # None until the GQL has been generated, with the lookups done.
+    self.bindings = None
+    if gquery is not None:
+      self.bindings = self._bindings(varenv)
+
+  def _bindings(self, varenv):
+    guids = tuple(defer.guid for defer in self.guid_lookups)
+    mid_guids = tuple(defer.guid for defer in self.mid_lookups)
+    return (guids, mid_guids, varenv.get('cursor'))
+
+  def bind(self, varenv):
+    """Bind this plan to the request in varenv; returns the GQL."""
+
+    self.attach(varenv)
+    varenv.lookup_manager.do_mid_and_guid_lookups()
+    return self.generate(varenv)
+
+  def attach(self, varenv):
+    """Queue the id lookups on varenv's manager and set the cursor."""
+
+    manager = varenv.lookup_manager
+    for defer in self.guid_lookups:
+      defer.guid = None
+      manager.guid_lookups.append(defer)
+    for defer in self.mid_lookups:
+      defer.guid = None
+      manager.mid_to_guid_lookups.append(defer)
+
+    cursor = varenv.get('cursor')
+    if cursor is not None:
+      element(self.query).node.cursor = cursor
+
+  def generate(self, varenv):
+    """The GQL once the lookups queued by attach() have been done."""
+
+    bindings = self._bindings(varenv)
+    if bindings != self.bindings:
+      graph_query = []
+      element(self.query).node.generate_graph_query(graph_query.append)
+      self.gquery = ''.join(graph_query)
+      self.bindings = bindings
+
+    return self.gquery
+
+
+class QueryPlanCache(object):
+  """LRU of QueryPlans, by QueryTemplate.plan_key().
+
+  A plan is checked out for the length of one request, so concurrent
+  requests for the same key compile their own. Every plan is stamped
+  with the SchemaFactory generation it was compiled against; when the
+  schema is flushed or a type refreshed, the generation moves on and
+  the whole cache is dropped.
+  """
+
+  def __init__(self, size):
+    self.size = size
+    self.lock = threading.Lock()
+    self.generation = None
+
+    # key -> QueryPlan, least recently used first
+    self.entries = OrderedDict()
+
+    # (template shape, param forms) -> the names of the params bound into
+    # the plans for them; see QueryTemplate.find_sites().
+    self.bound = OrderedDict()
+
+    self.hits = 0
+    self.misses = 0
+    self.invalidations = 0
+    self.evictions = 0
+
+  def checkout(self, key, generation):
+    with self.lock:
+      if generation != self.generation:
+        self.invalidations += len(self.entries)
+        self.entries.clear()
+        self.bound.clear()
+        self.generation = generation
+
+      plan = self.entries.pop(key, None)
+      if plan is None:
+        self.misses += 1
+      else:
+        self.hits += 1
+      return plan
+
+  def checkin(self, plan):
+    with self.lock:
+      if plan.key is None or plan.generation != self.generation:
+        return
+
+      self.entries.pop(plan.key, None)
+      self.entries[plan.key] = plan
+      while len(self.entries) > self.size:
+        self.entries.popitem(last=False)
+        self.evictions += 1
+
+  def bound_names(self, key):
+    with self.lock:
+      return self.bound.get(key)
+
+  def learn(self, key, names, generation):
+    with self.lock:
+      if generation != self.generation:
+        return
+
+      self.bound.pop(key, None)
+      self.bound[key] = names
+      while len(self.bound) > self.size:
+        self.bound.popitem(last=False)
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.bound.clear()
+
+  def stats(self):
+    with self.lock:
+      lookups = self.hits + self.misses
+      return {
+          'entries': len(self.entries),
+          'size': self.size,
+          'hits': self.hits,
+          'misses': self.misses,
+          'hit_rate': lookups and float(self.hits) / lookups,
+          'invalidations': self.invalidations,
+          'evictions': self.evictions,
+      }
+
+
+class MissingSchemaCache(object):
+  """MQLTypeErrors that outlasted a refresh of the schema involved, by message.
+
+  An error is taken as confirmed, and the refresh not tried again, for
+  ttl seconds, and only for requests whose write_dateline is covered by
+  the dateline it was confirmed at: a client that has written since may
+  have made the missing type or property.
+  """
+
+  def __init__(self, size, ttl):
+    self.size = size
+    self.ttl = ttl
+    self.lock = threading.Lock()
+
+    # message -> (dateline, time confirmed), oldest first
+    self.entries = OrderedDict()
+
+  def add(self, message, dateline):
+    with self.lock:
+      self.entries.pop(message, None)
+      self.entries[message] = (dateline, time.time())
+      while len(self.entries) > self.size:
+        self.entries.popitem(last=False)
+
+  def confirmed(self, message, write_dateline):
+    with self.lock:
+      entry = self.entries.get(message)
+      if entry is None:
+        return False
+
+      dateline, confirmed = entry
+      if confirmed < time.time() - self.ttl:
+        del self.entries[message]
+        return False
+
+      return dateline_covers(dateline, write_dateline)
+
+
+def schema_error_ids(error):
+  """The ids of the types and domains an MQLTypeError names.
+
+  A property id stands for its type. Ids in /type are left out: they
+  are loaded with the schema itself, and only SchemaFactory.flush()
+  reloads them.
+  """
+  ids = set()
+  for kwd in ('expected_type', 'type', 'domain', 'id'):
+    ids.add(error.get_kwd(kwd))
+
+  prop = error.get_kwd('property')
+  if isinstance(prop, basestring) and prop.startswith('/'):
+    ids.add(prop.rsplit('/', 1)[0])
+
+  return sorted(
+      id for id in ids
+      if isinstance(id, basestring) and valid_idname(id) and id != '/' and
+      id != '/type' and not id.startswith('/type/'))
+
+
+def id_form(value):
+  """'mid', 'guid' or 'id' for a value that can be bound as an id, else None."""
+
+  if not isinstance(value, basestring):
+    return None
+  if valid_mid(value):
+    return 'mid'
+  if valid_guid(value):
+    return 'guid'
+  if valid_high_idname(value):
+    return 'id'
+  return None
+
+
+def is_placeholder(value):
+  return (isinstance(value, basestring) and value[:1] == '$' and
+          valid_key(value[1:]))
+
+
+class QueryTemplate(object):
+  """A read query with '$name' placeholders.
+
+  Made by HighQuery.prepare(), or by lift() for a plain read. Every
+  string value of the form '$name' in the query is a placeholder, set
+  from the params of each read. Placeholders for ids, mids and text
+  values are bound straight into a compiled PreparedPlan, where they can
+  be found in it again; the values of any others are part of the plan
+  key, so the query is resolved once for each distinct value of those.
+  """
+
+  id_keys = set(['id', 'mid', '/type/object/id', '/type/object/mid'])
+
+  # keys whose values are schema, and so always part of the plan key.
+  schema_keys = set(['type', '/type/object/type', 'lang', '/type/text/lang'])
+
+  # the value types that go into the GQL as they are given
+  value_types = set(['/type/text', '/type/rawstring', '/type/uri'])
+
+  # as make_orig() allows
+  max_value_bytes = 4096
+
+  def __init__(self, query, plans=None, plan_cache_size=100):
+    self.query = query
+
+    # (path, name, kind) for each placeholder, path being the keys and
+    # indexes that lead to it; see slot_kind().
+    self.slots = []
+    self.find_slots(query, ())
+    self.names = set(name for _, name, _ in self.slots)
+
+    # tells apart the templates sharing plans; see lift().
+    self.shape = None
+
+    if plans is None:
+      plans = QueryPlanCache(plan_cache_size)
+    self.plans = plans
+
+  @classmethod
+  def lift(cls, query, plans):
+    """A template for a plain read of query, with its params.
+
+    The strings in query that a placeholder could stand for become
+    placeholders, the same string in several places the same one; so
+    does any string that would be taken for a placeholder. The template
+    shares plans with every other lifted from a query of the same shape.
+
+    Returns (template, params), or (None, None) if query isn't JSON.
+    """
+    params = {}
+    names = {}
+
+    def lift_recurse(part, parent_key):
+      if isinstance(part, dict):
+        # in order, so that the names don't depend on the dict's order
+        return type(part)(
+            (key, lift_recurse(part[key], key)) for key in sorted(part))
+      elif isinstance(part, list):
+        return [lift_recurse(value, None) for value in part]
+      elif isinstance(part, basestring) and (is_placeholder(part) or
+                                             cls.slot_kind(parent_key)):
+        name = names.get(part)
+        if name is None:
+          name = names[part] = 'v%d' % len(names)
+          params[name] = part
+        return '$' + name
+      else:
+        return part
+
+    lifted = lift_recurse(query, None)
+    try:
+      shape = json.dumps(lifted, sort_keys=True)
+    except (TypeError, ValueError):
+      return (None, None)
+
+    template = cls(lifted, plans)
+    template.shape = shape
+    return (template, params)
+
+  @classmethod
+  def slot_kind(cls, key):
+    """'id' or 'value' if a placeholder under key might be bound, else None."""
+
+    m = isinstance(key, basestring) and valid_mql_key(key)
+    if not m:
+      return None
+
+    name = m.group(3)
+    if name in cls.id_keys:
+      return 'id'
+    if name in HighQuery.directives or name in cls.schema_keys:
+      return None
+    return 'value'
+
+  def find_slots(self, part, path):
+    if isinstance(part, dict):
+      for key, value in part.iteritems():
+        self.find_slots(value, path + (key,))
+    elif isinstance(part, list):
+      for i, value in enumerate(part):
+        self.find_slots(value, path + (i,))
+    elif is_placeholder(part):
+      self.slots.append((path, part[1:], self.slot_kind(path and path[-1])))
+
+  def substitute(self, params):
+    """A copy of the query with params in place of the placeholders."""
+
+    for name in params:
+      if name not in self.names:
+        raise MQLParseError(
+            None, 'Parameter %(name)s is not used in the query', name=name)
+
+    return self.substitute_recurse(self.query, params)
+
+  def substitute_recurse(self, part, params):
+    if isinstance(part, dict):
+      return type(part)((key, self.substitute_recurse(value, params))
+                        for key, value in part.iteritems())
+    elif isinstance(part, list):
+      return [self.substitute_recurse(value, params) for value in part]
+    elif is_placeholder(part):
+      if part[1:] not in params:
+        raise MQLParseError(
+            None, 'Parameter %(name)s is not bound', name=part[1:])
+      return params[part[1:]]
+    else:
+      return part
+
+  def forms(self, params):
+    """How each slot's param could be bound: its id_form(), 'value' or None."""
+
+    forms = []
+    for _, name, kind in self.slots:
+      value = params[name]
+      form = None
+      if kind == 'id':
+        form = id_form(value)
+      elif kind == 'value' and isinstance(value, basestring):
+        if len(utf8(value)) <= self.max_value_bytes:
+          form = 'value'
+      forms.append(form)
+
+    return tuple(forms)
+
+  def plan_key(self, params, forms, bound, varenv):
+    """The key of the plan for params, or None if they can't use one.
+
+    The params named in bound are only keyed by their form.
+    """
+
+    literals = []
+    for (_, name, _), form in zip(self.slots, forms):
+      if name in bound:
+        literals.append(form)
+      else:
+        literals.append(params[name])
+
+    try:
+      text = json.dumps(literals, sort_keys=True)
+    except (TypeError, ValueError):
+      return None
+
+    return (self.shape, text, varenv.get('$lang'),
+            varenv.get('cursor') is not None)
+
+  def checkout(self, params, varenv, generation):
+    """The cached plan for params, or None."""
+
+    forms = self.forms(params)
+    bound = self.plans.bound_names((self.shape, forms))
+    key = self.plan_key(params, forms, bound or (), varenv)
+    if key is None:
+      return None
+
+    return self.plans.checkout(key, generation)
+
+  def find_sites(self, plan, varenv):
+    """Find the params in the tree just compiled for plan; returns its key.
+
+    A param is found again by its value, so that must be distinct and
+    appear nowhere else in the query. An id must have gone into id
+    lookups, and a value into a text value, rather than straight into
+    the GQL. The params that aren't found are left in the plan key.
+    """
+
+    params = plan.params
+    slots = defaultdict(list)
+    for (path, name, _), form in zip(self.slots, plan.forms):
+      slots[name].append((path, form))
+
+    owners = defaultdict(int)
+    for name in slots:
+      if isinstance(params[name], basestring):
+        owners[params[name]] += 1
+
+    counts = defaultdict(int)
+    for value in scalars(plan.orig_query):
+      counts[value] += 1
+
+    clauses = list(query_clauses(plan.query))
+    lookups = plan.guid_lookups + plan.mid_lookups
+    lang_id = varenv.get_lang_id()
+
+    bound = set()
+    for name, paths in slots.iteritems():
+      forms = set(form for _, form in paths)
+      orig_value = params[name]
+      if (None in forms or len(forms) != 1 or owners[orig_value] != 1 or
+          counts[orig_value] != len(paths)):
+        continue
+
+      value = utf8(orig_value)
+      if value == lang_id:
+        continue
+
+      if forms.pop() == 'value':
+        site = self.value_site(value, clauses, lookups)
+      else:
+        site = self.id_site(value, plan.gquery, clauses, lookups)
+      if site is None:
+        continue
+
+      containers = []
+      for path, _ in paths:
+        container = plan.orig_query
+        for step in path[:-1]:
+          container = container[step]
+        containers.append((container, path[-1]))
+
+      plan.sites[name] = (containers,) + site
+      bound.add(name)
+
+    bound = frozenset(bound)
+    self.plans.learn((self.shape, plan.forms), bound, plan.generation)
+    return self.plan_key(params, plan.forms, bound, varenv)
+
+  def id_site(self, value, gquery, clauses, lookups):
+    """(clauses, lookups, links) that an id param is bound into, or None."""
+
+    if value in gquery:
+      return None
+
+    lookups = [defer for defer in lookups if defer.id == value]
+    if not lookups:
+      return None
+
+    return ([clause for clause in clauses if clause.value == value], lookups,
+            [])
+
+  def value_site(self, value, clauses, lookups):
+    """(clauses, lookups, links) that a value param is bound into, or None.
+
+    The value must have gone into the links of text values and nowhere
+    else: any other clause holding it must be the default property of
+    one of those, or have one of them as its own default property.
+    """
+
+    if any(defer.id == value for defer in lookups):
+      return None
+
+    holding = [clause for clause in clauses if clause.value == value]
+
+    sites = []
+    for clause in holding:
+      stype = getattr(clause, 'stype', None)
+      if (clause.link is not None and clause.link.value == value and
+          stype is not None and stype.id in self.value_types):
+        sites.append(clause)
+    if not sites:
+      return None
+
+    site_ids = set(id(clause) for clause in sites)
+    for clause in holding:
+      if id(clause) in site_ids:
+        continue
+
+      parent = clause.parent_clause
+      if (id(parent) in site_ids and
+          clause.key == parent.stype.get_default_property_name()):
+        continue
+
+      default = getattr(clause, 'default', None)
+      if default is not None and id(clause.get(default)) in site_ids:
+        continue
+
+      return None
+
+    return (holding, [], [clause.link for clause in sites])
+
+
+def utf8(value):
+  if isinstance(value, unicode):
+    return value.encode('utf-8')
+  return value
+
+
+def scalars(part):
+  """The string values in a query."""
+
+  if isinstance(part, dict):
+    part = part.itervalues()
+  elif not isinstance(part, list):
+    if isinstance(part, basestring):
+      yield part
+    return
+
+  for value in part:
+    for scalar in scalars(value):
+      yield scalar
+
+
+def query_clauses(query):
+  """Every QueryDict in a resolved query tree."""
+
+  if isinstance(query, QueryList):
+    for elem in query:
+      for clause in query_clauses(elem):
+        yield clause
+  elif isinstance(query, QueryDict):
+    yield query
+    for value in query.itervalues():
+      for clause in query_clauses(value):
+        yield clause
+
+
+class PreparedPlan(QueryPlan):
+  """A QueryPlan for a QueryTemplate, with its params bound per read."""
+
+  def __init__(self, template, generation, query, varenv, orig_query,
+               params, marks=(0, 0)):
+    # param name -> (containers in orig_query, clauses, id lookups, links)
+    self.sites = {}
+
+    QueryPlan.__init__(self, template.plans, None, generation, query, None,
+                       varenv, marks)
+    self.template = template
+
+    # the query the tree was compiled from. Clauses keep references into
+    # it for error messages, so it is kept up to date with the params.
+    self.orig_query = orig_query
+
+    # what it was compiled for, until generate() has found the sites.
+    self.params = params
+    self.forms = template.forms(params)
+
+  def _bindings(self, varenv):
+    values = tuple(link.value
+                   for _, _, _, links in self.sites.itervalues()
+                   for link in links)
+    return QueryPlan._bindings(self, varenv) + (values,)
+
+  def attach_params(self, params, varenv):
+    """Bind the params, then attach() the request."""
+
+    for name, (containers, clauses, lookups, links) in self.sites.iteritems():
+      orig_value = params[name]
+      for container, key in containers:
+        container[key] = orig_value
+
+      # as make_orig() does
+      value = utf8(orig_value)
+
+      for clause in clauses:
+        clause.value = value
+        if hasattr(clause, 'original_query'):
+          clause.original_query = orig_value
+      for defer in lookups:
+        defer.id = value
+        if isinstance(defer, DeferredGuidOfMidLookup):
+          defer.mid = value
+      for link in links:
+        link.value = value
+
+    self.attach(varenv)
+
+  def generate(self, varenv):
+    gquery = QueryPlan.generate(self, varenv)
+
+    if self.params is not None:
+      self.key = self.template.find_sites(self, varenv)
+      self.bindings = self._bindings(varenv)
+      self.params = None
+
+    return gquery
+
+
 def cmdline_main():
   from mql.mql import cmdline
   op = cmdline.OP(usage='%prog [-g GRAPHD_ADDR] [...] <query>')
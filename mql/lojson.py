@@ -1346,6 +1346,19 @@ class LowQuery(object):
     else:
       varenv = Varenv(orig_varenv, self.lookup)
 
+    query = self.compile_read(orig_query, varenv)
+
+    # turn QPs into write query.
+    gresult = self.run_query(query, ReadMode, varenv)
+
+    return self.read_result(query, gresult, varenv)
+
+  def compile_read(self, orig_query, varenv):
+    """The first half of read(): the query with its QueryPrimitives.
+
+    element(query).node.generate_graph_query(ReadMode) is the GQL to
+    run; hand its result to read_result().
+    """
     transaction_id = varenv.get('tid')
 
     # stages:
@@ -1370,8 +1383,12 @@ class LowQuery(object):
     dumplog('LOW_QUERY', query)
     dumplog('READ_PRIMITIVES', element(query).node)
 
-    # turn QPs into write query.
-    gresult = self.run_query(query, ReadMode, varenv)
+    return query
+
+  def read_result(self, query, gresult, varenv):
+    """The second half of read(): the result of query from gresult."""
+
+    transaction_id = varenv.get('tid')
 
     result = self.create_query_result(query, varenv, gresult, ReadMode)
 
@@ -18,36 +18,106 @@
 # Nick -- I understand your point very well now...
 #
 
-from utils import valid_idname, valid_guid
+from utils import valid_idname, valid_guid, element, ReadMode, SegmentedLRU
 from error import MQLParseError, MQLInternalError
 from namespace import NameMap
 
+from absl import flags
 from pymql.error import EmptyResult
 from pymql.log import LOG
 
 import mid
 
+FLAGS = flags.FLAGS
+flags.DEFINE_integer("mql_id_cache_bytes", 32 << 20,
+                     "Bytes of guid to id lookups to keep cached")
+flags.DEFINE_integer("mql_namespace_cache_bytes", 64 << 20,
+                     "Bytes of namespaces and their entries to keep cached")
+
+# what the id cache holds for a guid lookup_ids() found no id for; its
+# answer, the guid's mid, is made again from the guid.
+_NO_ID = object()
+
 
 class NamespaceFactory:
 
-  def __init__(self, querier):
+  def __init__(self, querier, id_cache_bytes=None, namespace_cache_bytes=None):
+    """id_cache_bytes and namespace_cache_bytes default to their flags."""
+    if id_cache_bytes is None:
+      id_cache_bytes = FLAGS.mql_id_cache_bytes
+    if namespace_cache_bytes is None:
+      namespace_cache_bytes = FLAGS.mql_namespace_cache_bytes
+
     self.querier = querier
-    self.guids = {}
+    # guid -> id
+    self.guids = SegmentedLRU(id_cache_bytes)
     self.ids = {}
-    self.namemap = NameMap(self.querier.gc)
+    self.namemap = NameMap(self.querier.gc, max_bytes=namespace_cache_bytes)
     self.topic_en = None
     self.best_hrid_guid = None
     self.forbidden_namespaces = ()
 
+    # a sharedcache.SharedSchemaCache to look in after our own caches,
+    # and the guids not to look for there.
+    self.shared = None
+    self.forgotten = set()
+
   def flush(self):
     """
         Completely empty the caches.
         This takes care of flushing namespace.py caches as well.
         """
 
-    self.guids = {}
+    self.guids.clear()
     self.ids = {}
     self.namemap.flush()
+    self.shared = None
+    self.forgotten.clear()
+
+  def attach_shared(self, shared):
+    """Look in shared, a sharedcache.SharedSchemaCache, on a cache miss."""
+    self.shared = shared
+    self.forgotten.clear()
+    self.namemap.shared = shared
+    self.namemap.forgotten.clear()
+
+  def cached_id(self, guid):
+    """The id cached for guid, here or in the shared cache, or None.
+
+    _NO_ID if lookup_ids() found none for guid.
+    """
+    found_id = self.guids.get(guid)
+    if (found_id is None and self.shared is not None and
+        guid not in self.forgotten):
+      found_id = self.shared.get("ids", guid)
+    return found_id
+
+  def forget(self, id, guid=None):
+    """Drop what is cached about id, and about guid, what it named.
+
+    Unlike flush(), the rest of the caches are kept.
+    """
+    self.namemap.forget(id)
+    if guid is not None:
+      self.guids.pop(guid)
+      self.namemap.namespaces.pop(guid)
+      if self.shared is not None:
+        self.forgotten.add(guid)
+
+  def cache_stats(self):
+    """Sizes, hits, misses and evictions of the id and namespace caches.
+
+    "shared" is the stats of the shared cache, if there is one.
+    """
+    namespaces, namespace_entries = self.namemap.stats()
+    stats = {
+        "ids": self.guids.stats(),
+        "namespaces": namespaces,
+        "namespace_entries": namespace_entries,
+    }
+    if self.shared is not None:
+      stats["shared"] = self.shared.stats()
+    return stats
 
   def preload(self, varenv):
     # load stuff that we know we will need later...
@@ -147,16 +217,36 @@ class NamespaceFactory:
     if guid is None:
       return None
 
-    elif guid in self.guids:
-      return self.guids[guid]
-
-    else:
+    found_id = self.cached_id(guid)
+    # lookup_id_query() goes further than lookup_ids() to find an id
+    if found_id is None or found_id is _NO_ID:
       found_id = self.lookup_id_query(guid, varenv)
       self.guids[guid] = found_id
-      return found_id
+    return found_id
 
   # eek. see https://wiki.metaweb.com/index.php/Machine_IDs
   def lookup_guids_of_mids(self, mid_list, varenv):
+    result, rev, query = self.start_mids_lookup(mid_list)
+    if query is None:
+      return result
+
+    # read
+    varenv["gr_log_code"] = "guids2mids"
+    query_results = self.querier.read(query, varenv)
+    varenv.pop("gr_log_code")
+
+    self.finish_mids_lookup(result, rev, query_results)
+
+    # pray.
+    return result
+
+  def start_mids_lookup(self, mid_list):
+    """The first half of lookup_guids_of_mids().
+
+    Returns the result so far, the guid to mid map and the low json
+    query for replaced_by links, or None if there is nothing to ask.
+    Hand the query's result to finish_mids_lookup().
+    """
     ask_list = set()
     result = {}
     rev = {}
@@ -177,7 +267,7 @@ class NamespaceFactory:
             None, "'%(mid)s' is not a properly formatted mid", mid=m)
 
     if not len(ask_list):
-      return result
+      return result, rev, None
 
     # i'm not caching these.
     LOG.debug(
@@ -186,10 +276,9 @@ class NamespaceFactory:
     # replaced_by links are unique, if they arent then this will signify some
     # end-of-the-world type event.
     query = [{"@guid": ask_list, "replaced_by": {"@guid": None}}]
-    # read
-    varenv["gr_log_code"] = "guids2mids"
-    query_results = self.querier.read(query, varenv)
-    varenv.pop("gr_log_code")
+    return result, rev, query
+
+  def finish_mids_lookup(self, result, rev, query_results):
     # "now see what we found out..."
     for item in query_results:
       # [guid, replaced_by { guid }]
@@ -198,26 +287,93 @@ class NamespaceFactory:
       m = rev[guid]
       result[m] = rep_by
 
-    # pray.
-    return result
+  def lookup_guids_and_mids(self, id_list, mid_list, varenv):
+    """lookup_guids(id_list) and lookup_guids_of_mids(mid_list) together.
+
+    When both have to ask the graph, the replaced_by query and the
+    namespace walk go out in a single read_varenv_multiple(), which a
+    pipelining connector answers in one round trip instead of two.
+
+    Returns:
+      (id_map, mid_map) as the two would have.
+    """
+    id_map = self.internal_lookup_checks(id_list)
+
+    # mids given as ids are asked along with the rest.
+    id_mids = [m for m in id_list if m.startswith("/m/")]
+    mid_map, rev, mids_query = self.start_mids_lookup(list(mid_list) +
+                                                      id_mids)
+
+    next_step = [
+        id for id in id_map if id_map[id] is None and not id.startswith("/m/")
+    ]
+    ns_map, ns_query = self.namemap.start_lookup_multiple(next_step)
+
+    if mids_query is None or ns_query is None:
+      # one round trip at most anyway.
+      return (self.lookup_guids(id_list, varenv),
+              self.lookup_guids_of_mids(mid_list, varenv))
+
+    low_query = self.querier.compile_read(mids_query, varenv)
+    gqls = [element(low_query).node.generate_graph_query(ReadMode), ns_query]
+
+    varenv["gr_log_code"] = "id2guid"
+    try:
+      mids_result, ns_result = self.querier.gc.read_varenv_multiple(
+          gqls, varenv)
+    except EmptyResult:
+      # only with graph_noisy; let the separate reads deal with it.
+      varenv.pop("gr_log_code")
+      return (self.lookup_guids(id_list, varenv),
+              self.lookup_guids_of_mids(mid_list, varenv))
+    varenv.pop("gr_log_code")
+
+    self.finish_mids_lookup(
+        mid_map, rev, self.querier.read_result(low_query, mids_result, varenv))
+    self.namemap.recursive_ns_result_parse(ns_result, ns_map)
+
+    for m in id_mids:
+      id_map[m] = mid_map[m]
+    id_map.update(self.namemap.finish_lookup_multiple(next_step, varenv))
+
+    return id_map, dict((m, mid_map[m]) for m in mid_list)
 
   # harder
   def lookup_mids_of_guids(self, guid_list, varenv):
+    result, clause = self.start_mids_of_guids_lookup(guid_list)
+    if clause is None:
+      return {}
+
+    query = [dict(clause, **{"@guid": set(result),
+                             "@pagesize": len(result) + 1})]
+
+    varenv["gr_log_code"] = "mids2guids"
+    query_results = self.querier.read(query, varenv)
+    varenv.pop("gr_log_code")
+
+    self.finish_mids_of_guids_lookup(result, query_results)
+
+    return result
+
+  def start_mids_of_guids_lookup(self, guid_list):
+    """The first half of lookup_mids_of_guids().
+
+    Returns the result so far, keyed by the guids to ask about, and the
+    clauses to ask with, to go in a query rooted at those guids; None
+    if there is nothing to ask. Hand the query's result to
+    finish_mids_of_guids_lookup().
+    """
     # It's..sort of the same as before. We have some guids,
     # see if any of them are replaced_by.
     # If they are,
     if not guid_list:
-      return {}
+      return {}, None
 
-    ask_list = set()
     result = {}
-    rev = {}
     for g in guid_list:
       # convert the mid directly.
       m = mid.of_guid(g[1:])
-      ask_list.add(g)
       result[g] = [m]
-      rev[m] = g
 
     LOG.debug("mql.lookup.mids", "Looking up mids for guids")
 
@@ -236,33 +392,24 @@ class NamespaceFactory:
     # in this diagram, we root at B.
     # We list B first but also A and C if present.
 
-    query = [{
-        "@guid": ask_list,
-        "@pagesize": len(ask_list) + 1,
-        "-replaced_by": [{
-            "@guid": None,
-            ":optional": True
-        }]
-    }]
+    clause = {"-replaced_by": [{"@guid": None, ":optional": True}]}
+    return result, clause
 
-    varenv["gr_log_code"] = "mids2guids"
-    query_results = self.querier.read(query, varenv)
-    varenv.pop("gr_log_code")
+  def finish_mids_of_guids_lookup(self, result, query_results):
     # each result is going to (hopefully) either haave a -replaced_by link
     # or a replaced_by one.
     for item in query_results:
       guid = item["@guid"]
 
       # otherwise, theres just links pointing at me.
-      if item["-replaced_by"]:
+      # (the query may have been shared with guids we weren't asked about)
+      if item["-replaced_by"] and guid in result:
         # me first
         result[guid] = [mid.of_guid(guid[1:])]
         # then everyone else
         for r in item["-replaced_by"]:
           result[guid].append(mid.of_guid(r["@guid"][1:]))
 
-    return result
-
   def lookup_id(self, guid, varenv):
     # this function needs to have exactly the same semantics as
     # lookup_ids() (which now contains the "official" semantics)
@@ -279,6 +426,34 @@ class NamespaceFactory:
         Returns a dictionary of guid->id.
         """
 
+    result, ask_list, cache = self.start_ids_lookup(guid_list, varenv)
+
+    if not ask_list:
+      return result
+
+    LOG.debug("mql.lookup.ids", "Lookup ids", code=len(ask_list))
+
+    self.preload(varenv)
+
+    # Step 2: resolve the ask_list
+    query = [dict(self.ids_clause(), **{"@guid": ask_list,
+                                        "@pagesize": len(ask_list) + 1})]
+
+    varenv["gr_log_code"] = "guid2id"
+    query_results = self.querier.read(query, varenv)
+    varenv.pop("gr_log_code")
+
+    self.finish_ids_lookup(guid_list, result, ask_list, cache, query_results,
+                           varenv)
+
+    return result
+
+  def start_ids_lookup(self, guid_list, varenv):
+    """Step 1 of lookup_ids().
+
+    Returns the result so far, the guids that still need asking about
+    and whether to cache the answers.
+    """
     ask_list = set()
     result = {}
 
@@ -288,12 +463,13 @@ class NamespaceFactory:
         if isinstance(guid, unicode):
           guid = guid.encode("utf-8")
 
-        if guid in self.guids:
+        cached = self.cached_id(guid)
+        if cached is _NO_ID:
+          result[guid] = mid.of_guid(guid[1:])
+        elif cached is not None:
           LOG.debug(
-              "mql.lookup.id.cached",
-              "found %s in cache" % guid,
-              value=self.guids[guid])
-          result[guid] = self.guids[guid]
+              "mql.lookup.id.cached", "found %s in cache" % guid, value=cached)
+          result[guid] = cached
         elif guid not in ask_list:
           ask_list.add(guid)
 
@@ -308,17 +484,14 @@ class NamespaceFactory:
 
       cache = False
 
-    if not ask_list:
-      return result
-
-    LOG.debug("mql.lookup.ids", "Lookup ids", code=len(ask_list))
+    return result, ask_list, cache
 
-    self.preload(varenv)
+  def ids_clause(self):
+    """The clauses of the lookup_ids() query, rooted at the guids.
 
-    # Step 2: resolve the ask_list
-    query = [{
-        "@guid": ask_list,
-        "@pagesize": len(ask_list) + 1,
+    preload() must have been called.
+    """
+    return {
         "best_hrid": [{
             ":typeguid": self.best_hrid_guid,
             ":value": None,
@@ -356,18 +529,21 @@ class NamespaceFactory:
             "@id": "/type/namespace",
             ":optional": True
         }
-    }]
+    }
 
-    varenv["gr_log_code"] = "guid2id"
-    query_results = self.querier.read(query, varenv)
-    varenv.pop("gr_log_code")
+  def finish_ids_lookup(self, guid_list, result, ask_list, cache,
+                        query_results, varenv):
+    """Step 3 of lookup_ids(): fill in result from query_results."""
 
     LOG.debug("mql.lookup.id.results", "", results=query_results)
 
     # now see what we found out...
     # these should be cached.
-    leftover_guids = []
     for item in query_results:
+      # (the query may have been shared with guids we weren't asked about)
+      if item["@guid"] not in ask_list:
+        continue
+
       res = self.search_id_result(item, varenv)
       if res:
         result[item["@guid"]] = res
@@ -380,8 +556,46 @@ class NamespaceFactory:
       if guid not in result:
         LOG.debug("mql.lookup.id.notfound", "midifying %s" % guid)
         result[guid] = mid.of_guid(guid[1:])
+        if cache and guid in ask_list:
+          self.guids[guid] = _NO_ID
 
-    return result
+  def lookup_ids_and_mids(self, id_guid_list, mid_guid_list, varenv):
+    """lookup_ids(id_guid_list) and lookup_mids_of_guids(mid_guid_list).
+
+    Both are asked in a single query rooted at the union of the guids,
+    carrying the best_hrid and -has_key clauses of the one and the
+    -replaced_by clause of the other, so they cost one graph read
+    instead of two.
+
+    Returns:
+      (id_map, mid_map) as the two would have.
+    """
+    id_result, ask_list, cache = self.start_ids_lookup(id_guid_list, varenv)
+    mid_result, mids_clause = self.start_mids_of_guids_lookup(mid_guid_list)
+
+    if not ask_list or mids_clause is None:
+      # one read at most anyway.
+      return (self.lookup_ids(id_guid_list, varenv),
+              self.lookup_mids_of_guids(mid_guid_list, varenv))
+
+    LOG.debug("mql.lookup.ids", "Lookup ids and mids", code=len(ask_list))
+
+    self.preload(varenv)
+
+    guids = ask_list | set(mid_result)
+    clause = self.ids_clause()
+    clause.update(mids_clause)
+    query = [dict(clause, **{"@guid": guids, "@pagesize": len(guids) + 1})]
+
+    varenv["gr_log_code"] = "guid2id"
+    query_results = self.querier.read(query, varenv)
+    varenv.pop("gr_log_code")
+
+    self.finish_ids_lookup(id_guid_list, id_result, ask_list, cache,
+                           query_results, varenv)
+    self.finish_mids_of_guids_lookup(mid_result, query_results)
+
+    return id_result, mid_result
 
   def search_id_result(self, head, varenv):
     """
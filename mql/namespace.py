@@ -24,15 +24,22 @@ if __name__ == '__main__':
 
 
 from pymql.log import LOG
+from pymql.mql.graph.connector import parse_dateline
 from pymql.tid import generate_transaction_id
 from grquoting import quote, unquote
 
 
 from error import MQLInternalError, MQLParseError
+from utils import SegmentedLRU
 
 # Maximum segments in an id.
 MAX_ID_PARTS = 200
 
+# default bounds, in bytes, on what a NameMap keeps cached: all its
+# namespaces together, and (a quarter of that) the entries of any one
+NAMEMAP_MAX_BYTES = 64 << 20
+NAMESPACE_MAX_BYTES = NAMEMAP_MAX_BYTES / 4
+
 # this is only used in the multiple id lookup case.
 class InternalNsMap(dict):
     def __init__(self,guid,namespace):
@@ -42,16 +49,22 @@ class InternalNsMap(dict):
         self.needed = False
 
 class Namespace(object):
-    def __init__(self):
-        self.byname = {}
+    def __init__(self, max_bytes=NAMESPACE_MAX_BYTES):
+        # name -> guid. Only names that exist are stored.
+        self.byname = SegmentedLRU(max_bytes)
 
     def store(self, name, g):
         if g:
             self.byname[name] = g
 
+    def cached(self, name):
+        '''the guid cached for name, or None'''
+        return self.byname.get(name)
+
     def lookup(self, name, varenv):
-        if name in self.byname:
-            return self.byname[name]
+        g = self.cached(name)
+        if g is not None:
+            return g
 
         return False
 
@@ -105,7 +118,7 @@ class NamespaceConcept(Namespace):
     '''
 
     def __init__(self, namemap, g):
-        Namespace.__init__(self)
+        Namespace.__init__(self, namemap.namespace_max_bytes)
 
         self.namemap = namemap
         self.guid = g
@@ -121,18 +134,30 @@ class NamespaceConcept(Namespace):
         self.max_complete = 200
 
 
+    def store(self, name, g):
+        Namespace.store(self, name, g)
+        self.namemap.namespaces.resize(self.guid)
+
+    def cached(self, key):
+        '''the guid cached for key, here or in the shared cache, or None'''
+        val = self.byname.get(key)
+        if val is None:
+            val = self.namemap.shared_entry(self.guid, key)
+        return val
+
     def lookup(self, key, varenv):
         # if we have it, don't go any further
-        if key in self.byname:
-            return self.byname[key]
+        val = self.cached(key)
+        if val is not None:
+            return val
 
         # try to fetch the whole thing.
         if self.complete == -1:
             self.refresh(varenv)
 
-        if key in self.byname:
-            val = self.byname[key]
-        else:
+        # (even a complete namespace may have had the key evicted)
+        val = self.byname.get(key)
+        if val is None:
             val = self.fetch(key, varenv)
 
         return val
@@ -218,48 +243,190 @@ class NamespaceConcept(Namespace):
         LOG.debug('updated namespace %s' % self.guid, '%d entries' % len(r))
 
 
+def namespace_sizeof(g, namespace):
+    return (sys.getsizeof(g) + sys.getsizeof(namespace) +
+            namespace.byname.nbytes)
+
+
 class NameMap:
     '''a NameMap is a search path of Namespaces.
        the global namemap is found at gc.namemap, it is likely to contain:
           the true bootstrap namespace (guids of / and has_key)
           the metaweb bootstrap_namespace (contents of /boot)
+
+       the namespaces kept are bounded by max_bytes, counting their
+       entries; least recently used namespaces are dropped past that,
+       and are loaded again when next needed.
     '''
-    def __init__(self, gc, bootstrap=True):
+    def __init__(self, gc, bootstrap=True, max_bytes=NAMEMAP_MAX_BYTES):
         self.gc = gc
-        self.namespaces = {}
+        self.namespaces = SegmentedLRU(max_bytes, namespace_sizeof)
+        self.namespace_max_bytes = max_bytes / 4
+
+        # a sharedcache.SharedSchemaCache to look in after our own, and
+        # the (namespace guid, key)s not to look for there.
+        self.shared = None
+        self.forgotten = set()
         
         if bootstrap:
             self.bootstrap = BootNamespace(self)
 
     def refresh(self,varenv):
-        for nsc in self.namespaces.itervalues():
+        for nsc in self.namespaces.values():
             nsc.refresh(varenv)
 
     def flush(self):
         '''
         Empty the namespace stack completely except
-        for the bootstrap namespace.
+        for the bootstrap namespace, and stop using the
+        shared cache.
         '''
         
-        self.namespaces = {}
+        self.namespaces.clear()
+        self.shared = None
+        self.forgotten.clear()
+
+    def shared_entry(self, g, key):
+        '''the guid for key in namespace g in the shared cache, or None'''
+        if self.shared is None or (g, key) in self.forgotten:
+            return None
+        return self.shared.namespace_entry(g, key)
+
+    def cached_entry(self, g, key):
+        '''the guid cached for key in namespace g, or None'''
+        ns = self.namespaces.get(g)
+        if ns is not None:
+            return ns.cached(key)
+        return self.shared_entry(g, key)
+
+    def forget(self, id):
+        '''
+        Drop the cached entry for the last key of id, so that it is
+        looked up in the graph again. Only what is cached is walked.
+        '''
+        keys = id.rstrip('/').split('/')[1:]
+        if not keys:
+            return
+
+        g = self.bootstrap.root_namespace
+        for key in keys[:-1]:
+            g = self.cached_entry(g, key)
+            if g is None:
+                return
+
+        ns = self.namespaces.get(g)
+        if ns is not None:
+            ns.byname.pop(keys[-1])
+            self.namespaces.resize(g)
+
+        if self.shared is not None:
+            self.forgotten.add((g, keys[-1]))
+
+    def snapshot(self):
+        '''
+        The cached namespaces as plain data, for restore(): a
+        (guid, complete, last_dateline, [(name, guid), ...]) for each.
+        '''
+        return [(nsc.guid, nsc.complete, nsc.last_dateline, nsc.byname.items())
+                for nsc in self.namespaces.values()]
+
+    def restore(self, namespaces):
+        '''
+        Cache the namespaces of an earlier snapshot(). The complete ones
+        are brought up to date by catch_up().
+        '''
+        for (g, complete, last_dateline, entries) in namespaces:
+            nsc = self.get_or_add_namespace(g)
+            nsc.complete = complete
+            nsc.last_dateline = last_dateline
+            for (name, eg) in entries:
+                nsc.store(name, eg)
+
+    def catch_up(self, varenv):
+        '''
+        Add what has been written since to every completely cached
+        namespace, in one graph read from the earliest of their
+        datelines (as refresh() would, one namespace at a time).
+        '''
+        stale = [nsc for nsc in self.namespaces.values()
+                 if nsc.complete == 1 and nsc.last_dateline is not None]
+        if not stale:
+            return
+
+        datelines = [parse_dateline(nsc.last_dateline) for nsc in stale]
+        if None in datelines or len(set(d[0] for d in datelines)) > 1:
+            # no telling which is earliest
+            for nsc in stale:
+                nsc.refresh(varenv)
+            return
+
+        dateline = stale[datelines.index(min(datelines))].last_dateline
+        max_complete = max(nsc.max_complete for nsc in stale)
+
+        args = (' '.join(nsc.guid[1:] for nsc in stale), len(stale)+1,
+                self.bootstrap.has_key[1:], dateline, max_complete+1)
+        qs = '(guid=(%s) pagesize=%d result=((guid contents)) (<-left typeguid=%s comparator="octet" datatype=string dateline>%s pagesize=%d result=((value right))))' % args
+
+        r = self.gc.read_varenv(qs, varenv)
+
+        for (g, kv_list) in r:
+            nsc = self.namespaces.get('#' + g)
+            if nsc is None:
+                continue
+            if len(kv_list) > nsc.max_complete:
+                LOG.notice('mql.namespace.catch_up', '%s too large to cache' % nsc.guid)
+                nsc.complete = 0
+            nsc.update_from_graph(kv_list)
+
+        if r.dateline is not None:
+            for nsc in stale:
+                nsc.last_dateline = r.dateline
+
+    def stats(self):
+        '''(stats of the namespaces cached, totals over their entries)'''
+        totals = dict(entries=0, hits=0, misses=0, evictions=0)
+        for nsc in self.namespaces.values():
+            stats = nsc.byname.stats()
+            for k in totals:
+                totals[k] += stats[k]
+
+        lookups = totals['hits'] + totals['misses']
+        totals['hit_rate'] = lookups and float(totals['hits']) / lookups
+        return self.namespaces.stats(), totals
 
     def lookup_multiple(self, id_list, varenv):
         '''lookup_multiple(id_list) returns a map from the listed ids to guids.
         '''
 
+        ns_map, query = self.start_lookup_multiple(id_list)
+        if query is not None:
+            result = self.gc.read_varenv(query,varenv)
+            self.recursive_ns_result_parse(result,ns_map)
+
+        return self.finish_lookup_multiple(id_list, varenv)
+
+    def start_lookup_multiple(self, id_list):
+        '''the first half of lookup_multiple(id_list): returns the
+        ns_map tree and the GQL that fills it in, or None if nothing
+        needs to be asked. Hand the result to recursive_ns_result_parse()
+        and then call finish_lookup_multiple().
+        '''
+
         # build the id_list dictionary tree
         ns_map = self.build_ns_dict_tree(id_list)
 
         # now we have a dictionary of lookups and their guids (if any) and namespace objects (if any)
         # let's go build a query for the missing stuff...
         query = self.recursive_ns_query_build(ns_map)
-        if len(query):
-            query = '(guid=%s result=(guid contents) %s)' % (
-                self.bootstrap.root_namespace[1:], ''.join(query)
-            )
-            result = self.gc.read_varenv(query,varenv)
-            self.recursive_ns_result_parse(result,ns_map)
+        if not len(query):
+            return ns_map, None
+
+        query = '(guid=%s result=(guid contents) %s)' % (
+            self.bootstrap.root_namespace[1:], ''.join(query)
+        )
+        return ns_map, query
 
+    def finish_lookup_multiple(self, id_list, varenv):
         # now return all the results which must be in the tree now.
         retval = {}
         for id in id_list:
@@ -297,7 +464,7 @@ class NameMap:
                 if key not in iddict:
                     ns = None
                     if iddict.namespace:
-                        guid = iddict.namespace.byname.get(key,None)
+                        guid = iddict.namespace.cached(key)
                         if guid:
                             ns = self.get_or_add_namespace(guid)
                     
@@ -391,11 +558,12 @@ class NameMap:
         return g
 
     def get_or_add_namespace(self,g):
-        if g not in self.namespaces:
+        nsconcept = self.namespaces.get(g)
+        if nsconcept is None:
             nsconcept = NamespaceConcept(self, g)
             self.namespaces[g] = nsconcept
 
-        return self.namespaces[g]        
+        return nsconcept
 
     def lookup_by_guid_oneoff(self,g, varenv):
         root_ns_guid = self.bootstrap.root_namespace
@@ -150,6 +150,20 @@ class QueryPrimitive(object):
   result_pointers = (
       pointers | guid_field | connectors | set(('previous', 'next')))
 
+  # a large write makes thousands of primitives, so they have no
+  # __dict__. These are all the attributes a primitive may have besides
+  # all_fields; orig, new_order and existing_order are only set on
+  # unique checks and order primitives.
+  internal_fields = ('vars', 'contents', 'children', 'container', 'parent',
+                     'ordered', 'order_info', 'child', 'valueops',
+                     'timestampops', 'history_ops', 'unique_checks',
+                     'unique_namespace_info', 'unique_namespace_checks',
+                     'mode', 'state', 'access_control_ok', 'prefix', 'query',
+                     'query_unique', 'query_key', 'orig', 'new_order',
+                     'existing_order')
+
+  __slots__ = tuple(sorted(all_fields)) + internal_fields
+
   allowed_state_transitions = {
       None: ('insert', 'delete', 'ensurechild', 'ensure', 'link', 'unlink',
              'match', 'unique', 'default', 'order_read', 'order_info',
@@ -240,7 +254,11 @@ class QueryPrimitive(object):
       if fullkey[0] != prefix:
         continue
 
+      # the field names end up in self.result of every primitive, so
+      # share one copy of each.
       k = fullkey[1:]
+      if isinstance(k, str):
+        k = intern(k)
       if k[0] == '$':
         self.vars[k] = v
       elif valid_value_op(k):
@@ -21,6 +21,32 @@ from collections import defaultdict
 
 import mid
 
+# the lookups that stand in for ids and mids in a result until
+# LookupManager.fill_result_slots()
+DEFERRED_RESULTS = (DeferredIdLookup, DeferredMidOfGuidLookup,
+                    DeferredMidsOfGuidLookup)
+
+
+def set_result(container, key, value, varenv):
+  """container[key] = value, noting where value holds deferred lookups.
+
+  The lookup manager fills in just those slots once the lookups are
+  done. A list result is either all dicts, which note their own slots
+  as they are built, or all terminals, which are noted here.
+  """
+  container[key] = value
+
+  if isinstance(value, DEFERRED_RESULTS):
+    varenv.lookup_manager.add_result_slot(container, key, value)
+  elif isinstance(value, list) and value and not isinstance(value[0], dict):
+    if isinstance(value[0], DeferredMidsOfGuidLookup):
+      # the list of mids takes the place of the whole list
+      varenv.lookup_manager.add_result_slot(container, key, value[0])
+    else:
+      for i, item in enumerate(value):
+        if isinstance(item, DEFERRED_RESULTS):
+          varenv.lookup_manager.add_result_slot(value, i, item)
+
 
 class ReadQP(object):
   """
@@ -55,6 +81,12 @@ class ReadQP(object):
 
   result_pointers = (guids | frozenset(('previous', 'next')))
 
+  # deep reads make a lot of these, so they have no __dict__.
+  __slots__ = tuple(sorted(graphfields | result_field)) + (
+      'query', 'contents', 'implied', 'parent', 'linkage', 'comparisons',
+      'category', 'return_count', 'return_estimate_count', 'include_count',
+      'include_estimate_count', 'vars', 'final', 'bang_indexes')
+
   def __init__(self, query, category):
     for field in self.graphfields:
       setattr(self, field, None)
@@ -423,14 +455,17 @@ class ReadQP(object):
         result[n + i] = result[n + i][1:]
 
       if qp.category == 'link':
-        high_result[qp.query.key] = qp.parse_result_link(result[n + i], varenv)
+        set_result(high_result, qp.query.key,
+                   qp.parse_result_link(result[n + i], varenv), varenv)
       elif qp.category == 'value':
-        high_result[qp.query.key] = qp.parse_result_value(result[n + i], varenv)
+        set_result(high_result, qp.query.key,
+                   qp.parse_result_value(result[n + i], varenv), varenv)
       elif qp.category == 'attached':
-        high_result[qp.query.key] = qp.parse_result_right(result[n + i], varenv)
+        set_result(high_result, qp.query.key,
+                   qp.parse_result_right(result[n + i], varenv), varenv)
       elif qp.category == 'directlink':
-        high_result[qp.query.key] = qp.parse_result_direct_link(
-            result[n + i], varenv)
+        set_result(high_result, qp.query.key,
+                   qp.parse_result_direct_link(result[n + i], varenv), varenv)
       elif qp.category == 'constraint':
         # constraints are supressed
         pass
@@ -557,7 +592,7 @@ class ReadQP(object):
       else:
         # a full dictionary result...
         if dpn in item:
-          imp_result[dpn] = value
+          set_result(imp_result, dpn, value, varenv)
         if 'type' in item:
           type_res = item.stype.get_value_type(datatype, typeguid)
           if isinstance(item['type'], list):
@@ -588,12 +623,12 @@ class ReadQP(object):
           rpn_res = self.final.parse_result_final(dz, varenv)
           if self.final.query.list:
             rpn_res = [rpn_res]
-          imp_result[rpn] = rpn_res
+          set_result(imp_result, rpn, rpn_res, varenv)
 
       if item.list:
         imp_result = [imp_result]
 
-      high_result[item.key] = imp_result
+      set_result(high_result, item.key, imp_result, varenv)
 
   def parse_result_index(self, result, varenv):
     if len(result) > 1:
@@ -665,8 +700,8 @@ class ReadQP(object):
       n = len(self.result)
       for i, qp in enumerate(self.contents):
         if qp.category == 'attached':
-          high_result[qp.query.key] = qp.parse_result_right(
-              sub_result[n + i], varenv)
+          set_result(high_result, qp.query.key,
+                     qp.parse_result_right(sub_result[n + i], varenv), varenv)
         elif qp.category == 'index':
           high_result['index'] = None
           index = qp.parse_result_index(sub_result[n + i], varenv)
@@ -723,7 +758,8 @@ class ReadQP(object):
             self.parent.bang_indexes[self.query.property].append(
                 (index, high_result))
         elif qp.category == 'attached':
-          link[qp.query.key] = qp.parse_result_right(sub_result[n + i], varenv)
+          set_result(link, qp.query.key,
+                     qp.parse_result_right(sub_result[n + i], varenv), varenv)
         else:
           raise MQLInternalError(
               self.query,
@@ -829,7 +865,7 @@ class ReadQP(object):
         if rpn:
           if self.final.query.list:
             rpn_res = [rpn_res]
-          high_result[rpn] = rpn_res
+          set_result(high_result, rpn, rpn_res, varenv)
 
       if self.implied:
         # a non terminal with a 'link' clause
@@ -840,14 +876,16 @@ class ReadQP(object):
         if qp.category == 'node':
           # we must have specified RPN to do this...
           rpn = stype.get_right_property_name(self.query)
-          high_result[rpn] = qp.parse_result_right(sub_result[n + i], varenv)
+          set_result(high_result, rpn,
+                     qp.parse_result_right(sub_result[n + i], varenv), varenv)
         elif qp.category == 'index':
           high_result['index'] = None
           index = qp.parse_result_index(sub_result[n + i], varenv)
           if index is not None:
             indexes.append((index, high_result))
         elif qp.category == 'attached':
-          link[qp.query.key] = qp.parse_result_right(sub_result[n + i], varenv)
+          set_result(link, qp.query.key,
+                     qp.parse_result_right(sub_result[n + i], varenv), varenv)
         elif qp.category == 'constraint':
           # the RPN may be only a constraint.
           pass
@@ -889,9 +927,9 @@ class ReadQP(object):
       if link is Missing or not isinstance(high_result, dict):
         pass
       elif is_list:
-        high_result['link'] = [link]
+        set_result(high_result, 'link', [link], varenv)
       else:
-        high_result['link'] = link
+        set_result(high_result, 'link', link, varenv)
     else:
       raise MQLInternalError(self.query,
                              "Didn't find link clause, but got link results")
@@ -951,6 +989,8 @@ class FinalQP(object):
     basic QP tree
     """
 
+  __slots__ = ('query', 'field', 'guid')
+
   def __init__(self, query, property, guid):
     self.query = query
     if property.reverse:
@@ -22,11 +22,16 @@ from utils import valid_idname, valid_guid, valid_key, reserved_word, find_key_i
 from error import MQLParseError, MQLInternalError, MQLTypeError
 from env import Guid
 
+from absl import flags
 from pymql.util import keyquote
 from pymql.log import LOG
 from pymql.util.mwdatetime import coerce_datetime, uncoerce_datetime
 import copy
 
+FLAGS = flags.FLAGS
+flags.DEFINE_list("mql_preload_domains", [],
+                  "Domains to load the schema of, in one read, with /type")
+
 _value_types = set(
     ('/type/value', '/type/int', '/type/text', '/type/float', '/type/boolean',
      '/type/rawstring', '/type/uri', '/type/key', '/type/datetime', '/type/id',
@@ -60,9 +65,29 @@ _no_delegation_property_guid_map = {}
 
 class SchemaFactory(object):
 
-  def __init__(self, querier, varenv):
+  def __init__(self, querier, varenv, snapshot=None, shared=None,
+               keep_json=False):
+    """snapshot, if given, is an earlier snapshot() to start from.
+
+    shared, if given, is a sharedcache.SharedSchemaCache to load domains
+    and types from before asking the graph.
+
+    keep_json keeps the graph results the domains and types are loaded
+    from, which snapshot() needs; they take about as much memory again
+    as the schema itself.
+    """
     self.querier = querier
-    self.init(varenv)
+    self.keep_json = keep_json
+    # moves on whenever cached schema is thrown away, so that anything
+    # compiled against it (see hijson.QueryPlanCache) can tell.
+    self.generation = 0
+    self.shared = shared
+    # ids not to load from self.shared
+    self.forgotten = set()
+    if snapshot is None:
+      self.init(varenv)
+    else:
+      self.restore(snapshot, varenv)
 
   def init(self, varenv):
     self.domains = {}
@@ -75,9 +100,11 @@ class SchemaFactory(object):
     self.has_key_guid = self.querier.lookup.lookup_guid('/boot/has_key', varenv)
 
     self.add_domain('/type', varenv)
+
+    # everything cached was read at or after this dateline
+    self.dateline = varenv.get('dateline')
     try:
-      #self.add_domain('/common', varenv)
-      pass
+      self.preload_domains(FLAGS.mql_preload_domains, varenv)
     except MQLTypeError:
       # debug ME-907
       LOG.exception('mql.schema.SchemaFactory.init()', varenv=varenv)
@@ -100,6 +127,125 @@ class SchemaFactory(object):
       raise MQLParseError(
           None, 'Domain id %(domain)s is invalid', domain=domainpath)
 
+  def preload_domains(self, domainpaths, varenv):
+    """Load the schema of every type in domainpaths, in one graph read.
+
+    Domains already loaded, or in the shared cache, aren't read.
+    """
+    domainpaths = [d for d in domainpaths if d not in self.domains]
+    for domainpath in domainpaths:
+      if not valid_idname(domainpath):
+        raise MQLParseError(
+            None, 'Domain id %(domain)s is invalid', domain=domainpath)
+
+    if not domainpaths:
+      return
+
+    ask = {}
+    missing = []
+    ns_guids = self.querier.lookup.lookup_guids(domainpaths, varenv)
+    for domainpath in domainpaths:
+      ns_guid = ns_guids[domainpath]
+      if not ns_guid:
+        # load the rest before complaining
+        missing.append(domainpath)
+        continue
+
+      sdomain = SchemaDomain(self, ns_guid, varenv, domainpath, load=False)
+      ns_result = self.shared_schema('domains', domainpath)
+      if ns_result is not None:
+        sdomain.init_from_json(ns_result, varenv)
+        self.domains[domainpath] = sdomain
+      else:
+        ask[ns_guid] = sdomain
+
+    if ask:
+      LOG.debug(
+          'mql.schema.domains.query', 'preloading domains', code=len(ask))
+
+      query = [dict(get_domain_query(None), **{'@guid': list(ask),
+                                                '@pagesize': len(ask) + 1})]
+      results = self.querier.read(query, varenv)
+
+      for ns_result in results:
+        sdomain = ask.pop(ns_result['@guid'], None)
+        if sdomain is not None:
+          sdomain.init_from_json(ns_result, varenv)
+          self.domains[sdomain.id] = sdomain
+
+    if missing:
+      raise MQLTypeError(
+          None, 'Domain %(domain)s could not be found', domain=missing[0])
+
+    if ask:
+      sdomain = ask.values()[0]
+      raise MQLTypeError(
+          None,
+          'Unable to load schema for domain %(domain)s %(guid)s',
+          domain=sdomain.id,
+          guid=sdomain.guid)
+
+  def preload_types(self, typepaths, varenv):
+    """Load the schema of each of typepaths, in one graph read.
+
+    Types already loaded, or in the shared cache, aren't read.
+    """
+    typepaths = [
+        t for t in typepaths if t not in self.types or not self.types[t].loaded
+    ]
+
+    stypes = []
+    for typepath in typepaths:
+      stype = self.get_or_add_type(typepath, varenv)
+      result = self.shared_schema('types', typepath)
+      if result is not None:
+        stype.init_from_json(result, varenv)
+      else:
+        stypes.append(stype)
+
+    if not stypes:
+      return
+
+    ask = {}
+    missing = []
+    guids = self.querier.lookup.lookup_guids([s.id for s in stypes], varenv)
+    for stype in stypes:
+      if not guids[stype.id]:
+        # load the rest before complaining
+        missing.append(stype.id)
+        continue
+      if stype.guid is None:
+        # so that types that extend it find it
+        stype.set_guid(guids[stype.id])
+      ask[stype.guid] = stype
+
+    if ask:
+      LOG.debug('mql.schema.types.query', 'preloading types', code=len(ask))
+
+      # we know their ids
+      query = get_schema_query(None)
+      del query['has_domain']
+      query.update({'@guid': list(ask), '@pagesize': len(ask) + 1})
+      results = self.querier.read([query], varenv)
+
+      for result in results:
+        stype = ask.pop(result['@guid'], None)
+        if stype is not None:
+          stype.init_from_json(result, varenv)
+
+    if missing:
+      raise MQLTypeError(
+          None,
+          'Unable to load schema for %(expected_type)s',
+          expected_type=missing[0])
+
+    if ask:
+      stype = ask.values()[0]
+      raise MQLTypeError(
+          None,
+          'Unable to load schema for %(expected_type)s',
+          expected_type=stype.id)
+
   def addtype(self, typepath, varenv):
     if valid_idname(typepath):
       stype = SchemaType(self, None, varenv, typepath, load=False)
@@ -110,9 +256,22 @@ class SchemaFactory(object):
           None, 'Type id %(expected_type)s is invalid', expected_type=typepath)
 
   # flush everything - if we have possible cache consistency issues then we should do this...
+  # (that goes for the shared cache too)
   def flush(self, varenv):
+    self.generation += 1
+    self.shared = None
+    self.forgotten.clear()
     self.init(varenv)
 
+  def shared_schema(self, table, id):
+    """The graph result for domain or type id in the shared cache, or None.
+
+    table is "domains" or "types".
+    """
+    if self.shared is None or id is None or id in self.forgotten:
+      return None
+    return self.shared.schema(table, id)
+
   # the underlying guid may have changed, properties may have been added or deleted.
   # XXX when do we call this? Right now only when we find a legal property name
   # that we couldn't resolve to solve bug 889.
@@ -120,12 +279,11 @@ class SchemaFactory(object):
   # cache, but today is not that day...
   def refresh_type(self, typepath, varenv):
     if valid_idname(typepath):
+      self.generation += 1
+
       # if we found it, remove it from the cache - note that the guid may have changed too...
       # (but we won't know that unless we flush the namespace)
-      if typepath in self.types:
-        typeguid = self.types[typepath].guid
-        del self.types[typepath]
-        del self.guids[typeguid]
+      self.forget_type(typepath)
 
       # and now reload it.
       self.addtype(typepath, varenv)
@@ -133,6 +291,144 @@ class SchemaFactory(object):
       raise MQLParseError(
           None, 'Type id %(expected_type)s is invalid', expected_type=typepath)
 
+  def forget_type(self, typepath):
+    """Drop typepath and its properties, to be loaded again when next used.
+
+    Returns the guid the type had, or None if it wasn't loaded.
+    """
+    if self.shared is not None:
+      self.forgotten.add(typepath)
+
+    stype = self.types.pop(typepath, None)
+    if stype is None:
+      return None
+
+    self.generation += 1
+
+    for node in [stype] + stype.props.values():
+      if node.guid is not None and self.guids.get(node.guid) is node:
+        del self.guids[node.guid]
+
+    if stype.domain is not None:
+      stype.domain.types.pop(typepath.rsplit('/', 1)[1], None)
+
+    return stype.guid
+
+  def snapshot(self):
+    """The loaded schema as plain data, for SchemaFactory(snapshot=...).
+
+    Only the graph results the domains and types were loaded from are
+    kept; restore() loads them again with init_from_json(). They are
+    only there if the factory was made with keep_json.
+    """
+    if not self.keep_json:
+      raise MQLInternalError(
+          None, 'A schema snapshot needs a SchemaFactory with keep_json')
+
+    domains = []
+    for domainpath, sdomain in self.domains.iteritems():
+      # leaving out any types forgotten since
+      result = dict(sdomain.json)
+      result['has_key'] = [
+          r for r in sdomain.json['has_key'] if r[':value'] in sdomain.types
+      ]
+      domains.append((domainpath, sdomain.guid, result))
+
+    types = [(stype.id, stype.json)
+             for stype in self.types.itervalues()
+             if stype.loaded and stype.domain is None and stype.id is not None]
+
+    return {
+        'dateline': self.dateline,
+        'enumeration_ect_guid': self.enumeration_ect_guid,
+        'has_key_guid': self.has_key_guid,
+        'domains': domains,
+        'types': types
+    }
+
+  def restore(self, snapshot, varenv):
+    """Load the schema from snapshot() rather than from the graph.
+
+    Whatever has changed in the graph since snapshot['dateline'] is
+    still to be caught up with; see catch_up().
+    """
+    self.domains = {}
+    self.types = {}
+    self.guids = {}
+
+    self.enumeration_ect_guid = snapshot['enumeration_ect_guid']
+    self.has_key_guid = snapshot['has_key_guid']
+    self.dateline = snapshot['dateline']
+
+    # /type first, as every other type is loaded onto /type/object
+    domains = sorted(snapshot['domains'], key=lambda d: d[0] != '/type')
+    for domainpath, guid, result in domains:
+      sdomain = SchemaDomain(self, guid, varenv, domainpath, load=False)
+      sdomain.init_from_json(result, varenv)
+      self.domains[domainpath] = sdomain
+
+    for typepath, result in snapshot['types']:
+      stype = self.get_or_add_type(typepath, varenv)
+      if not stype.loaded:
+        stype.init_from_json(result, varenv)
+
+  def catch_up(self, varenv):
+    """Forget the loaded types that have changed since self.dateline.
+
+    One graph read finds the types and properties with links written
+    or deleted since then; their types are loaded again when next
+    used. A change to /type flushes everything.
+    """
+    if self.dateline is None:
+      self.flush(varenv)
+      return
+
+    typepaths = self.type_guids()
+    if not typepaths:
+      return
+
+    qs = ('(guid=(%s) pagesize=%d result=((guid)) '
+          '(<-left dateline>%s live=dontcare newest>=0 pagesize=1 result=()))' %
+          (' '.join(guid[1:] for guid in typepaths), len(typepaths) + 1,
+           self.dateline))
+    r = self.querier.gc.read_varenv(qs, varenv)
+
+    changed = set()
+    for entry in r:
+      changed.update(typepaths.get('#' + entry[0], ()))
+
+    LOG.debug(
+        'mql.schema.catch_up',
+        '%d types changed' % len(changed),
+        dateline=self.dateline)
+
+    if [typepath for typepath in changed
+        if typepath == '/type' or typepath.startswith('/type/')]:
+      self.flush(varenv)
+      return
+
+    for typepath in changed:
+      self.forget_type(typepath)
+
+    if r.dateline:
+      self.dateline = r.dateline
+
+  def type_guids(self):
+    """guid -> ids of the loaded types that depend on it.
+
+    A type depends on its own guid and on the guids and typeguids of
+    its properties; a link to any of them may change it.
+    """
+    typepaths = {}
+    for stype in self.types.values():
+      if not stype.loaded or stype.id is None:
+        continue
+      for node in [stype] + stype.props.values():
+        for guid in (node.guid, getattr(node, 'typeguid', None)):
+          if guid is not None:
+            typepaths.setdefault(guid, set()).add(stype.id)
+    return typepaths
+
   def addtypebyguid(self, guid, varenv):
     if valid_guid(guid):
       # XXX should provide real support for this rubbish...
@@ -413,12 +709,14 @@ class SchemaDomain(SchemaNode):
     It primarily allows the entire domain to be loaded in a single query
     """
 
-  def __init__(self, factory, guid, varenv, id):
+  def __init__(self, factory, guid, varenv, id, load=True):
     super(SchemaDomain, self).__init__(factory, guid)
 
     self.id = id
     self.types = {}
-    self.load_from_graph(varenv)
+    self.json = None
+    if load:
+      self.load_from_graph(varenv)
 
   def __repr__(self):
     name = self.id
@@ -433,6 +731,11 @@ class SchemaDomain(SchemaNode):
     return (self.id == id)
 
   def load_from_graph(self, varenv):
+    ns_result = self.factory.shared_schema('domains', self.id)
+    if ns_result is not None:
+      self.init_from_json(ns_result, varenv)
+      return
+
     ns_query = get_domain_query(self.guid)
 
     LOG.debug('mql.schema.domain.query', 'loading domain', guid=self.guid)
@@ -451,6 +754,9 @@ class SchemaDomain(SchemaNode):
           domain=domain,
           guid=self.guid)
 
+    self.init_from_json(ns_result, varenv)
+
+  def init_from_json(self, ns_result, varenv):
     # XXX we need to order the types because uses_properties_from depends on this ordering during the parse sequence (ick)...
     results = ns_result['has_key']
     results.sort(key=ugly_sort_key)
@@ -470,6 +776,9 @@ class SchemaDomain(SchemaNode):
         raise MQLParseError(
             None, 'Invalid type name %(expected_type)', expected_type=typename)
 
+    if self.factory.keep_json:
+      self.json = ns_result
+
 
 #
 # A SchemaType is a type for a type_type in a schema
@@ -490,6 +799,7 @@ class SchemaType(SchemaNode):
     self.default_property_name = None
     self.domain = domain
     self.loaded = None
+    self.json = None
 
     if load:
       self.load_from_graph(varenv)
@@ -908,6 +1218,11 @@ class SchemaType(SchemaNode):
     return prop
 
   def load_from_graph(self, varenv):
+    result = self.factory.shared_schema('types', self.id)
+    if result is not None:
+      self.init_from_json(result, varenv)
+      return
+
     # queries are in low-JSON
     if self.guid:
       base_query = get_schema_query(self.guid)
@@ -1215,6 +1530,9 @@ class SchemaType(SchemaNode):
 
     self.loaded = True
 
+    if self.factory.keep_json:
+      self.json = result
+
 
 #
 # A SchemaProperty represents a PD in the graph. It contains slots for
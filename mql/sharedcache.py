@@ -0,0 +1,301 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A schema cache shared by the worker processes on a host.
+
+build() writes what a HighQuery has cached to a file: namespace
+entries, the ids of guids, and the graph results that domains and types
+are loaded from. Each worker maps the file read only with
+SharedSchemaCache, so the operating system keeps one copy of it for all
+of them. A worker's own caches are looked in first, and hold only what
+it has loaded since; see HighQuery.attach_shared_cache(). Like a
+snapshot, the file is stamped with the graph dateline it was read at,
+and a worker catches up on what has been written since (catch_up())
+before using it.
+
+The file is a header, then tables. Each table is an index of offsets to
+its records, sorted by key, so an entry is found by a binary search
+that doesn't touch the rest of the file. Records are a key and a value,
+both strings; schema values are marshalled graph results.
+"""
+
+import marshal
+import mmap
+import os
+import struct
+import tempfile
+
+from absl import flags
+from pymql.log import LOG
+
+MAGIC = "PYMQLSC\0"
+
+# bumped whenever the layout of the file changes
+FORMAT_VERSION = 2
+
+# magic, version, number of tables
+_HEADER = struct.Struct("<8sII")
+# name, number of records, offset of the index
+_TABLE = struct.Struct("<16sQQ")
+# offset of a record
+_INDEX = struct.Struct("<Q")
+# lengths of the key and the value that follow
+_RECORD = struct.Struct("<II")
+
+# tables whose values are marshalled
+_SCHEMA_TABLES = ("domains", "types")
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string("mql_shared_schema_cache", None,
+                    "Shared schema cache file, from build(), to map")
+
+
+def namespace_key(g, key):
+  """The key of entry key of namespace g in the "namespaces" table."""
+  return g + "\0" + key
+
+
+def schema_tables(high_querier):
+  """The tables of a shared cache of what high_querier has cached."""
+  snapshot = high_querier.snapshot()
+  schema = snapshot["schema"]
+
+  namespaces = {}
+  namespace_guids = set()
+  for g, _, _, entries in snapshot["namespaces"]:
+    for key, eg in entries:
+      namespaces[namespace_key(g, key)] = eg
+      namespace_guids.add(g)
+
+  ids = dict((guid, id)
+             for guid, id in high_querier.querier.lookup.guids.items()
+             if isinstance(id, str))
+
+  domains = {}
+  types = {}
+  for domainpath, _, result in schema["domains"]:
+    domains[domainpath] = result
+    for r in result["has_key"]:
+      types[domainpath + "/" + r[":value"]] = r
+  types.update(schema["types"])
+
+  # guid -> the types that a link to it may change, for catch_up()
+  typeguids = dict(
+      (guid, "\n".join(sorted(typepaths))) for guid, typepaths in
+      high_querier.schema_factory.type_guids().iteritems())
+
+  return {
+      "meta": {
+          "dateline": schema["dateline"] or "",
+          "namespace_guids": " ".join(sorted(namespace_guids))
+      },
+      "namespaces": namespaces,
+      "ids": ids,
+      "domains": domains,
+      "types": types,
+      "typeguids": typeguids
+  }
+
+
+def build(path, high_querier):
+  """Write what high_querier has cached to path, for SharedSchemaCache.
+
+  The file is replaced in one step, so workers that have the old one
+  mapped keep a consistent copy of it.
+  """
+  tables = schema_tables(high_querier)
+  for name in _SCHEMA_TABLES:
+    tables[name] = dict(
+        (k, marshal.dumps(v)) for k, v in tables[name].iteritems())
+
+  dirname = os.path.dirname(os.path.abspath(path))
+  fd, tmp = tempfile.mkstemp(dir=dirname, prefix=".mql_shared")
+  try:
+    with os.fdopen(fd, "wb") as f:
+      write_tables(f, tables)
+    os.rename(tmp, path)
+  except:
+    os.unlink(tmp)
+    raise
+
+
+def write_tables(f, tables):
+  """Write tables, a dict of dicts of strings, to file f."""
+  names = sorted(tables)
+  offset = _HEADER.size + _TABLE.size * len(names)
+
+  headers = []
+  body = []
+  for name in names:
+    records = []
+    index = []
+    for key, value in sorted(tables[name].iteritems()):
+      index.append(_INDEX.pack(offset))
+      records.append(_RECORD.pack(len(key), len(value)) + key + value)
+      offset += _RECORD.size + len(key) + len(value)
+    body.extend(records)
+
+    headers.append(_TABLE.pack(name, len(index), offset))
+    body.extend(index)
+    offset += _INDEX.size * len(index)
+
+  f.write(_HEADER.pack(MAGIC, FORMAT_VERSION, len(names)))
+  f.write("".join(headers))
+  f.write("".join(body))
+
+
+def open_cache(path):
+  """The SharedSchemaCache in path, or None if there is no usable one."""
+  try:
+    return SharedSchemaCache(path)
+  except (IOError, ValueError, struct.error, mmap.error), e:
+    LOG.warning("mql.sharedcache.open", "can't map %s: %s" % (path, e))
+    return None
+
+
+class SharedSchemaCache(object):
+  """Read only lookups in a file from build(), mapped into memory.
+
+  get() returns a value from the file or None; schema() unmarshals a
+  domain or type's graph result, which the caller may change.
+  namespace_entry() and schema() leave out what catch_up() has found
+  changed in the graph since the file was built.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    with open(path, "rb") as f:
+      self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, ntables = _HEADER.unpack_from(self.map, 0)
+    if magic != MAGIC or version != FORMAT_VERSION:
+      raise ValueError(
+          "not a version %d shared schema cache" % FORMAT_VERSION)
+
+    # name -> (number of records, offset of the index)
+    self.tables = {}
+    for i in xrange(ntables):
+      name, count, index = _TABLE.unpack_from(self.map,
+                                              _HEADER.size + i * _TABLE.size)
+      self.tables[name.rstrip("\0")] = (count, index)
+
+    self.hits = 0
+    self.misses = 0
+
+    self.dateline = self.get("meta", "dateline") or None
+
+    # what has changed since the file was built; see catch_up()
+    self.stale_schema = False
+    self.stale = {"domains": set(), "types": set(), "namespaces": set()}
+
+  def get(self, table, key):
+    count, index = self.tables.get(table, (0, 0))
+    lo, hi = 0, count
+    while lo < hi:
+      mid = (lo + hi) // 2
+      offset, = _INDEX.unpack_from(self.map, index + mid * _INDEX.size)
+      klen, vlen = _RECORD.unpack_from(self.map, offset)
+      start = offset + _RECORD.size
+      found = self.map[start:start + klen]
+      if found < key:
+        lo = mid + 1
+      elif found > key:
+        hi = mid
+      else:
+        self.hits += 1
+        return self.map[start + klen:start + klen + vlen]
+
+    self.misses += 1
+    return None
+
+  def items(self, table):
+    """(key, value) of each record of table, in key order."""
+    count, index = self.tables.get(table, (0, 0))
+    for i in xrange(count):
+      offset, = _INDEX.unpack_from(self.map, index + i * _INDEX.size)
+      klen, vlen = _RECORD.unpack_from(self.map, offset)
+      start = offset + _RECORD.size
+      yield (self.map[start:start + klen],
+             self.map[start + klen:start + klen + vlen])
+
+  def namespace_entry(self, g, key):
+    """The guid for key in namespace g, or None."""
+    if g in self.stale["namespaces"]:
+      return None
+    return self.get("namespaces", namespace_key(g, key))
+
+  def schema(self, table, id):
+    if self.stale_schema or id in self.stale[table]:
+      return None
+    value = self.get(table, id)
+    if value is None:
+      return None
+    return marshal.loads(value)
+
+  def catch_up(self, gc, varenv):
+    """Stop using what has been written to the graph since self.dateline.
+
+    One graph read, with gc, finds the types and namespaces in the file
+    with links written or deleted since then; they are looked up in the
+    graph again instead, as if they weren't here. A change to /type
+    stops all schema lookups here. self.dateline must not be None.
+    """
+    typepaths = dict(
+        (guid, value.split("\n")) for guid, value in self.items("typeguids"))
+    namespaces = set((self.get("meta", "namespace_guids") or "").split())
+    guids = set(typepaths) | namespaces
+    if not guids:
+      return
+
+    qs = ("(guid=(%s) pagesize=%d result=((guid)) "
+          "(<-left dateline>%s live=dontcare newest>=0 pagesize=1 result=()))" %
+          (" ".join(guid[1:] for guid in guids), len(guids) + 1, self.dateline))
+    r = gc.read_varenv(qs, varenv)
+
+    for entry in r:
+      guid = "#" + entry[0]
+      if guid in namespaces:
+        self.stale["namespaces"].add(guid)
+      for typepath in typepaths.get(guid, ()):
+        if typepath == "/type" or typepath.startswith("/type/"):
+          self.stale_schema = True
+        self.stale["types"].add(typepath)
+        self.stale["domains"].add(typepath.rsplit("/", 1)[0])
+
+    LOG.debug(
+        "mql.sharedcache.catch_up",
+        "%d types and %d namespaces changed" %
+        (len(self.stale["types"]), len(self.stale["namespaces"])),
+        dateline=self.dateline)
+
+    if r.dateline:
+      self.dateline = r.dateline
+
+  def close(self):
+    self.map.close()
+
+  def stats(self):
+    lookups = self.hits + self.misses
+    stats = {
+        "path": self.path,
+        "bytes": len(self.map),
+        "dateline": self.dateline,
+        "hits": self.hits,
+        "misses": self.misses,
+        "hit_rate": lookups and float(self.hits) / lookups,
+    }
+    for name, (count, _) in self.tables.iteritems():
+      stats[name] = count
+    for name, keys in self.stale.iteritems():
+      stats["stale_" + name] = len(keys)
+    return stats
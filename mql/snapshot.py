@@ -0,0 +1,68 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Schema snapshot files, for warm process startup.
+
+A snapshot is what a HighQuery has cached of the schema and of
+namespaces (see HighQuery.snapshot()), stamped with the graph dateline
+the schema was read at. A new process restores it rather than reading
+all of that from the graph again, and then catches up on what has been
+written since with dateline> reads.
+
+Snapshots are pickles: only read ones this service wrote itself.
+"""
+
+import cPickle as pickle
+import os
+import tempfile
+
+from absl import flags
+from pymql.log import LOG
+
+# bumped whenever what a snapshot holds changes
+SNAPSHOT_VERSION = 1
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string("mql_schema_snapshot", None,
+                    "Schema snapshot file to warm MQLService caches from")
+
+
+def write(path, snapshot):
+  """Write snapshot to path, replacing any file there in one step."""
+  dirname = os.path.dirname(os.path.abspath(path))
+  fd, tmp = tempfile.mkstemp(dir=dirname, prefix=".mql_snapshot")
+  try:
+    with os.fdopen(fd, "wb") as f:
+      pickle.dump((SNAPSHOT_VERSION, snapshot), f, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp, path)
+  except:
+    os.unlink(tmp)
+    raise
+
+
+def read(path):
+  """The snapshot written to path, or None if there is no usable one."""
+  try:
+    with open(path, "rb") as f:
+      version, snapshot = pickle.load(f)
+  except (IOError, EOFError, TypeError, ValueError,
+          pickle.UnpicklingError), e:
+    LOG.warning("mql.snapshot.read", "can't read %s: %s" % (path, e))
+    return None
+
+  if version != SNAPSHOT_VERSION:
+    LOG.notice("mql.snapshot.read",
+               "%s is version %s, not %s" % (path, version, SNAPSHOT_VERSION))
+    return None
+
+  return snapshot
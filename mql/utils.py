@@ -14,6 +14,8 @@
 
 import string, re
 import bisect
+import sys
+import threading
 
 from collections import OrderedDict
 from absl import logging as glogging
@@ -130,6 +132,171 @@ class ResultList(list):
   pass
 
 
+def entry_sizeof(key, value):
+  return sys.getsizeof(key) + sys.getsizeof(value)
+
+
+class SegmentedLRU(object):
+  """Thread safe cache mapping, bounded in bytes.
+
+  New entries go on a probation segment, and move to a protected segment
+  when they are asked for again. The protected segment holds at most
+  protected_share of max_bytes; past that its least recently used
+  entries go back to probation. Entries are evicted from probation
+  first, so a burst of entries that are only used once can't push out
+  the ones in regular use.
+
+  An entry's size is sizeof(key, value) plus ENTRY_BYTES. Call resize()
+  after a value has changed size in place.
+  """
+
+  # roughly what an entry costs in the OrderedDicts, besides itself
+  ENTRY_BYTES = 150
+
+  def __init__(self, max_bytes, sizeof=entry_sizeof, protected_share=0.8):
+    self.max_bytes = max_bytes
+    self.max_protected_bytes = int(max_bytes * protected_share)
+    self.sizeof = sizeof
+    self.lock = threading.Lock()
+
+    # key -> (value, size), least recently used first
+    self.probation = OrderedDict()
+    self.protected = OrderedDict()
+    self.nbytes = 0
+    self.protected_nbytes = 0
+
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def _remove(self, key):
+    """Drop key, if present; returns its (value, size) or None."""
+    entry = self.probation.pop(key, None)
+    if entry is None:
+      entry = self.protected.pop(key, None)
+      if entry is None:
+        return None
+      self.protected_nbytes -= entry[1]
+    self.nbytes -= entry[1]
+    return entry
+
+  def _evict(self):
+    while self.protected_nbytes > self.max_protected_bytes:
+      key, entry = self.protected.popitem(last=False)
+      self.protected_nbytes -= entry[1]
+      self.probation[key] = entry
+
+    while self.nbytes > self.max_bytes:
+      if self.probation:
+        _, entry = self.probation.popitem(last=False)
+      else:
+        _, entry = self.protected.popitem(last=False)
+        self.protected_nbytes -= entry[1]
+      self.nbytes -= entry[1]
+      self.evictions += 1
+
+  def get(self, key, default=None):
+    with self.lock:
+      entry = self.protected.pop(key, None)
+      if entry is None:
+        entry = self.probation.pop(key, None)
+        if entry is None:
+          self.misses += 1
+          return default
+        self.protected_nbytes += entry[1]
+        self.protected[key] = entry
+        self._evict()
+      else:
+        self.protected[key] = entry
+
+      self.hits += 1
+      return entry[0]
+
+  def __getitem__(self, key):
+    value = self.get(key, Missing)
+    if value is Missing:
+      raise KeyError(key)
+    return value
+
+  def __contains__(self, key):
+    # doesn't count as a use
+    return key in self.protected or key in self.probation
+
+  def __setitem__(self, key, value):
+    size = self.sizeof(key, value) + self.ENTRY_BYTES
+    with self.lock:
+      self._remove(key)
+      if size > self.max_bytes:
+        return
+      self.probation[key] = (value, size)
+      self.nbytes += size
+      self._evict()
+
+  def resize(self, key):
+    """Account for a change in the size of key's value."""
+    with self.lock:
+      entry = self.protected.get(key)
+      segment = self.protected
+      if entry is None:
+        entry = self.probation.get(key)
+        segment = self.probation
+        if entry is None:
+          return
+
+      size = self.sizeof(key, entry[0]) + self.ENTRY_BYTES
+      if size > self.max_bytes:
+        # as for __setitem__, rather than evict everything else first
+        self._remove(key)
+        return
+      segment[key] = (entry[0], size)
+      self.nbytes += size - entry[1]
+      if segment is self.protected:
+        self.protected_nbytes += size - entry[1]
+      self._evict()
+
+  def pop(self, key, default=None):
+    with self.lock:
+      entry = self._remove(key)
+    if entry is None:
+      return default
+    return entry[0]
+
+  def clear(self):
+    with self.lock:
+      self.probation.clear()
+      self.protected.clear()
+      self.nbytes = 0
+      self.protected_nbytes = 0
+
+  def __len__(self):
+    return len(self.probation) + len(self.protected)
+
+  def values(self):
+    with self.lock:
+      return ([value for value, _ in self.probation.itervalues()] +
+              [value for value, _ in self.protected.itervalues()])
+
+  def items(self):
+    """(key, value) pairs, least recently used first, without using them."""
+    with self.lock:
+      return ([(key, value) for key, (value, _) in self.probation.iteritems()] +
+              [(key, value) for key, (value, _) in self.protected.iteritems()])
+
+  def stats(self):
+    with self.lock:
+      lookups = self.hits + self.misses
+      return {
+          "entries": len(self.probation) + len(self.protected),
+          "protected": len(self.protected),
+          "bytes": self.nbytes,
+          "max_bytes": self.max_bytes,
+          "hits": self.hits,
+          "misses": self.misses,
+          "hit_rate": lookups and float(self.hits) / lookups,
+          "evictions": self.evictions,
+      }
+
+
 class ReadMode(object):
 
   def __str__(self):
@@ -0,0 +1,232 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Partitioned parallel reads of very large result sets.
+
+One cursor can only be read a page at a time from one graphd. A Scan
+splits a list query into timestamp windows ("timestamp>=" and
+"timestamp<" on the top of the query), each read with its own cursor,
+and runs the windows on several workers, each with its own MQLService
+and so its own graph connection. The results are yielded as they
+arrive, in no particular order across windows. The caller gives the
+window boundaries, at least one window per worker: a scan has no cheap
+way to learn how the results of a query spread over time.
+
+A scan can be stopped and resumed: checkpoint() gives the cursor each
+window has been yielded up to, and a Scan made with that checkpoint
+carries on from there. A page is only counted as yielded once all its
+results have been, so after a resume at most the rest of one page per
+window is yielded again.
+"""
+
+import logging
+import Queue
+import sys
+import threading
+
+from mql import error as mql_error
+from mql.utils import valid_timestamp
+
+
+class Partition(object):
+  """One timestamp window of a Scan, and how far it has been read.
+
+  start and end are timestamps, None for no bound. cursor is True if the
+  window has not been started, False once it has all been read, and
+  otherwise the cursor to read the window on from.
+  """
+
+  def __init__(self, start, end, cursor=True):
+    self.start = start
+    self.end = end
+    self.cursor = cursor
+
+  def query(self, query, page_size):
+    """query restricted to this window, page_size results at a time."""
+    clause = dict(query[0], limit=page_size)
+    if self.start is not None:
+      clause["timestamp>="] = self.start
+    if self.end is not None:
+      clause["timestamp<"] = self.end
+    return [clause]
+
+
+def timestamp_partitions(boundaries):
+  """Partitions for the windows between boundaries, and either side.
+
+  Args:
+    boundaries: list of timestamps, in increasing order
+
+  Returns:
+    list of len(boundaries) + 1 Partitions, which cover all timestamps.
+  """
+  for timestamp in boundaries:
+    if not isinstance(timestamp, basestring) or not valid_timestamp(timestamp):
+      raise mql_error.MQLParseError(
+          None, "Scan boundary %(timestamp)s is not a valid timestamp",
+          timestamp=timestamp)
+
+  if list(boundaries) != sorted(boundaries):
+    raise mql_error.MQLParseError(
+        None, "Scan boundaries must be in increasing order")
+
+  edges = [None] + list(boundaries) + [None]
+  return [Partition(start, end) for start, end in zip(edges, edges[1:])]
+
+
+class Scan(object):
+  """A partitioned read of a list query; iterate over it for the results.
+
+  Each of services is used by one worker thread at a time, and by
+  nothing else while the scan runs. Iterating runs the scan; it can
+  only be run once, but a new Scan can resume it from checkpoint().
+  """
+
+  def __init__(self,
+               services,
+               query,
+               boundaries=None,
+               page_size=100,
+               checkpoint=None,
+               close_services=False,
+               **varenv):
+    """Make a scan of query.
+
+    Args:
+      services: list of MQLService, one per worker
+      query: dict/json obj, mql query of the form [{...}], with no
+        "limit" and no comparison on its "timestamp".
+      boundaries: list of timestamps to split the query at, as for
+        timestamp_partitions(). There must be at least one fewer than
+        services, as each window is read by one worker; a scan can't
+        pick them itself. Ignored if checkpoint is given.
+      page_size: int, number of results per read
+      checkpoint: the checkpoint() of an earlier Scan of the same query,
+        to carry on from.
+      close_services: bool, close the services once the scan has run.
+      varenv: as for MQLService.read, for every read of the scan.
+    """
+
+    if (not isinstance(query, list) or len(query) != 1 or
+        not isinstance(query[0], dict)):
+      raise mql_error.MQLParseError(
+          None, "A scan needs a query of the form [{...}]")
+
+    for key in query[0]:
+      if key == "limit" or (key.startswith("timestamp") and
+                            key != "timestamp"):
+        raise mql_error.MQLParseError(
+            None, "A scan sets %(key)s itself", key=key)
+
+    if not services:
+      raise mql_error.MQLParseError(None, "A scan needs at least one service")
+
+    self.services = services
+    self.close_services = close_services
+    self.query = query
+    self.page_size = page_size
+    self.varenv = varenv
+
+    if checkpoint is not None:
+      self.partitions = [
+          Partition(start, end, cursor) for start, end, cursor in checkpoint
+      ]
+    else:
+      self.partitions = timestamp_partitions(boundaries or [])
+      if len(self.partitions) < len(services):
+        raise mql_error.MQLParseError(
+            None,
+            "A scan needs a window per worker, but has %(windows)d for "
+            "%(workers)d workers; give it more boundaries",
+            windows=len(self.partitions),
+            workers=len(services))
+
+    self.started = False
+
+  def checkpoint(self):
+    """[start, end, cursor] for each partition, to resume the scan from."""
+    return [[p.start, p.end, p.cursor] for p in self.partitions]
+
+  def __iter__(self):
+    if self.started:
+      raise mql_error.MQLInternalError(None, "A scan can only be run once")
+    self.started = True
+
+    todo = Queue.Queue()
+    for partition in self.partitions:
+      if partition.cursor:
+        todo.put(partition)
+
+    # at most one page waiting per worker
+    pages = Queue.Queue(len(self.services))
+    stop = threading.Event()
+
+    def put(item):
+      while not stop.is_set():
+        try:
+          pages.put(item, timeout=0.1)
+          return True
+        except Queue.Full:
+          pass
+      return False
+
+    def work(service):
+      try:
+        while not stop.is_set():
+          try:
+            partition = todo.get_nowait()
+          except Queue.Empty:
+            break
+
+          query = partition.query(self.query, self.page_size)
+          cursor = partition.cursor
+          while cursor:
+            r = service.read(query, cursor=cursor, **self.varenv)
+            cursor = r.cursor
+            if not put(("page", (partition, r.result, cursor))):
+              return
+      except Exception:
+        put(("error", sys.exc_info()))
+      else:
+        put(("done", None))
+
+    workers = []
+    for i, service in enumerate(self.services):
+      worker = threading.Thread(
+          target=work, args=(service,), name="pymql-scan-%d" % i)
+      worker.daemon = True
+      worker.start()
+      workers.append(worker)
+
+    try:
+      running = len(workers)
+      while running:
+        kind, item = pages.get()
+        if kind == "done":
+          running -= 1
+        elif kind == "error":
+          raise item[0], item[1], item[2]
+        else:
+          partition, result, cursor = item
+          for row in result:
+            yield row
+          partition.cursor = cursor
+
+      logging.debug("pymql.scan.end partitions: %d", len(self.partitions))
+    finally:
+      stop.set()
+      for worker in workers:
+        worker.join()
+      if self.close_services:
+        for service in self.services:
+          service.close()
@@ -0,0 +1,163 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""AsyncTcpGraphConnector unittest for pymql, against a fake graphd."""
+
+import socket
+import time
+
+import google3
+from pymql.mql.error import MQLTimeoutError
+from pymql.mql.graph import conn_async
+from pymql.mql.graph.connector import RequestCost
+from pymql.test import fake_graphd
+import trollius
+
+from google3.testing.pybase import googletest
+
+
+class AsyncTcpGraphConnectorTest(googletest.TestCase):
+
+  def setUp(self):
+    self.graphd = fake_graphd.FakeGraphd()
+    self.addCleanup(self.graphd.stop)
+    self.loop = trollius.new_event_loop()
+    # after the connectors are closed
+    self.addCleanup(self.loop.close)
+
+  def Connector(self, **kwargs):
+    gc = conn_async.AsyncTcpGraphConnector([self.graphd.addr],
+                                           loop=self.loop,
+                                           **kwargs)
+    self.addCleanup(gc.close)
+    return gc
+
+  def Run(self, coro):
+    return self.loop.run_until_complete(coro)
+
+  def testRead(self):
+    gc = self.Connector()
+    varenv = {'tid': 't'}
+    request = RequestCost()
+    self.assertEqual([['a']], self.Run(gc.read_varenv('(a)', varenv, request)))
+    self.assertEqual('5', varenv['dateline'])
+
+    rs = self.Run(gc.read_varenv_multiple(['(a)', '(b)'], varenv, request))
+    self.assertEqual([[['a']], [['b']]], rs)
+    self.assertEqual(3, request.totalcost['mql_dbreqs'])
+    self.assertEqual('5', request.dateline)
+    self.assertEqual(self.graphd.addr, request.addr)
+    self.assertEqual(1, gc.pool.stats()['connects'])
+    # the connector's own (per thread) cost is left alone
+    self.assertNotIn('mql_dbreqs', gc.totalcost)
+
+  def testConcurrentCosts(self):
+    """reads running together on the loop are charged separately."""
+    self.graphd.delay = 0.01
+    gc = self.Connector()
+
+    requests = [RequestCost() for _ in xrange(4)]
+    reads = [
+        gc.read_varenv_multiple(['(r%d)' % i] * (i + 1), {'tid': 't'},
+                                request) for i, request in enumerate(requests)
+    ]
+    self.Run(trollius.gather(*reads, loop=self.loop))
+
+    for i, request in enumerate(requests):
+      self.assertEqual(i + 1, request.totalcost['mql_dbreqs'])
+      self.assertEqual(i + 1, request.nrequests)
+      self.assertEqual(0, request.qretries)
+
+  def testConnectFailure(self):
+    """a graph that can't be reached is marked down, and only that one."""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    down = sock.getsockname()
+    sock.close()
+
+    gc = conn_async.AsyncTcpGraphConnector([down, self.graphd.addr],
+                                           loop=self.loop)
+    self.addCleanup(gc.close)
+
+    # enough reads that some of them pick the graph that's down
+    reads = [gc.read_varenv('(r%d)' % i, {'tid': 't'}) for i in xrange(20)]
+    rs = self.Run(trollius.gather(*reads, loop=self.loop))
+
+    self.assertEqual([[['r%d' % i]] for i in xrange(20)], rs)
+    stats = gc.replica_stats()
+    self.assertTrue(stats[down]['down'])
+    self.assertFalse(stats[self.graphd.addr]['down'])
+
+  def testNoReplyCache(self):
+    """the reply cache and coalescing are for threads; they stay off."""
+    gc = self.Connector(reply_cache_bytes=1 << 20, coalesce_reads=True)
+    self.assertEqual(None, gc.reply_cache)
+    self.assertEqual(None, gc.inflight_reads)
+
+    for _ in xrange(2):
+      self.assertEqual([['a']], self.Run(gc.read_varenv('(a)', {'tid': 't'})))
+    self.assertEqual(2, len(self.graphd.requests))
+
+  def testTimeout(self):
+    self.graphd.delay = 0.5
+    gc = self.Connector()
+    self.assertRaises(MQLTimeoutError, self.Run,
+                      gc.read_varenv('(a)', {'tid': 't', 'policy': 'fast'}))
+    # the connection that timed out is not reused
+    self.assertEqual(0, gc.pool.stats()['idle'])
+
+  def testPoolSize(self):
+    """concurrent reads wait for one of pool_size connections."""
+    self.graphd.delay = 0.01
+    gc = self.Connector(pool_size=2)
+
+    reads = [gc.read_varenv('(r%d)' % i, {'tid': 't'}) for i in xrange(10)]
+    rs = self.Run(trollius.gather(*reads, loop=self.loop))
+
+    self.assertEqual([[['r%d' % i]] for i in xrange(10)], rs)
+    stats = gc.pool.stats()
+    self.assertEqual(2, stats['connects'])
+    self.assertEqual(0, stats['in_use'])
+    self.assertEqual(2, stats['idle'])
+    self.assertLessEqual(gc.totalcost['gpu'], 2)
+
+  def testPoolWaitTimeout(self):
+    self.graphd.delay = 0.5
+    gc = self.Connector(pool_size=1)
+    policy = dict(gc.timeout_policies['default'], connect=0.1, retry=[0.0])
+
+    @conn_async.coroutine
+    def ReadBoth():
+      first = trollius.async(
+          gc.transmit_query('read (a)', policy, None), loop=self.loop)
+      yield trollius.From(trollius.sleep(0.05, loop=self.loop))
+      try:
+        yield trollius.From(gc.transmit_query('read (b)', policy, None))
+      finally:
+        yield trollius.From(first)
+
+    self.assertRaises(MQLTimeoutError, self.Run, ReadBoth())
+
+  def testPoolIdleTimeout(self):
+    gc = self.Connector(pool_idle_timeout=0.05)
+    self.Run(gc.read_varenv('(a)', {'tid': 't'}))
+    time.sleep(0.1)
+    self.Run(gc.read_varenv('(b)', {'tid': 't'}))
+
+    stats = gc.pool.stats()
+    self.assertEqual(1, stats['evictions'])
+    self.assertEqual(2, stats['connects'])
+
+
+if __name__ == '__main__':
+  googletest.main()
@@ -0,0 +1,442 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""TcpGraphConnector unittest for pymql, against a fake graphd."""
+
+import threading
+import time
+
+import google3
+from pymql.mql.error import MQLTimeoutError
+from pymql.mql.graph import conn_tcp
+from pymql.test import fake_graphd
+
+from google3.testing.pybase import googletest
+
+
+def dateline_reply(request):
+  """Echo the request, at the dateline named by its gql, (t<dateline>)."""
+  gql = fake_graphd.request_gql(request)
+  return fake_graphd.echo_reply(request, dateline=gql.strip('(t)'))
+
+
+class TcpGraphConnectorTest(googletest.TestCase):
+
+  def setUp(self):
+    self.graphd = fake_graphd.FakeGraphd()
+
+  def tearDown(self):
+    self.graphd.stop()
+
+  def testRead(self):
+    gc = conn_tcp.TcpGraphConnector([self.graphd.addr])
+    varenv = {'tid': 't'}
+    self.assertEqual([['a']], gc.read_varenv('(a)', varenv))
+    self.assertEqual('5', varenv['dateline'])
+    self.assertEqual('5', gc.dateline)
+    self.assertEqual(1, gc.totalcost['mql_dbreqs'])
+    gc.close()
+
+  def testPipelinedReadsKeepOrder(self):
+    gc = conn_tcp.TcpGraphConnector([self.graphd.addr])
+    gqls = ['(q%d)' % i for i in xrange(20)]
+    varenv = {'tid': 't'}
+
+    rs = gc.read_varenv_multiple(gqls, varenv)
+    self.assertEqual([[['q%d' % i]] for i in xrange(20)], rs)
+    self.assertEqual(gqls, self.graphd.gqls())
+    self.assertEqual(20, gc.totalcost['mql_dbreqs'])
+
+    # nothing is left behind on the connection for the next request
+    self.assertEqual([['next']], gc.read_varenv('(next)', varenv))
+    gc.close()
+
+  def testPoolConcurrentReads(self):
+    """threads sharing a pooled connector each see their own costs."""
+    self.graphd.reply = dateline_reply
+    self.graphd.delay = 0.01
+    gc = conn_tcp.TcpGraphConnector([self.graphd.addr], pool_size=2)
+
+    nthreads = 6
+    nreads = 5
+    seen = {}
+    errors = []
+
+    def run(i):
+      try:
+        gc.reset_cost()
+        datelines = []
+        for _ in xrange(nreads):
+          varenv = {'tid': 't'}
+          gc.read_varenv('(t%d)' % i, varenv)
+          datelines.append((varenv['dateline'], gc.dateline))
+          if i % 2:
+            # a request starting on another thread wipes nothing here
+            gc.reset_cost()
+            gc.read_varenv('(t%d)' % i, {'tid': 't'})
+        seen[i] = (datelines, dict(gc.totalcost))
+      except Exception, e:  # pylint: disable-msg=W0703
+        errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(nthreads)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+
+    self.assertEqual([], errors)
+    for i in range(nthreads):
+      datelines, cost = seen[i]
+      self.assertEqual([(str(i), str(i))] * nreads, datelines)
+      self.assertEqual(1 if i % 2 else nreads, cost['mql_dbreqs'])
+      self.assertEqual(cost['mql_dbreqs'] * 2, cost['te'])
+      self.assertLessEqual(cost['gpu'], 2)
+
+    stats = gc.pool.stats()
+    self.assertEqual(0, stats['in_use'])
+    self.assertLessEqual(stats['connects'], 2)
+    gc.close()
+
+  def TwoGraphs(self, stop_first=False, **kwargs):
+    """A pooled connector to self.graphd and a second fake graphd."""
+    other = fake_graphd.FakeGraphd()
+    self.addCleanup(other.stop)
+    if stop_first:
+      self.graphd.stop()
+    gc = conn_tcp.TcpGraphConnector([self.graphd.addr, other.addr],
+                                    pool_size=2,
+                                    **kwargs)
+    self.addCleanup(gc.close)
+    return gc, self.graphd.addr, other.addr
+
+  def testReplicaScore(self):
+    gc, a, b = self.TwoGraphs()
+
+    gc._replica_begin(a)
+    gc._replica_end(a, time.time(), {'tg': 0.2, 'te': 100}, False)
+    stats = gc.replica_stats()[a]
+    self.assertAlmostEqual(0.2, stats['latency'])
+    self.assertAlmostEqual(0.1, stats['graph_time'])
+    self.assertEqual(1, stats['requests'])
+    self.assertEqual(0, stats['in_flight'])
+
+    # the average moves LATENCY_EWMA_ALPHA of the way to a new sample
+    gc._replica_begin(a)
+    gc._replica_end(a, time.time(), {'tg': 0.1}, False)
+    self.assertAlmostEqual(0.17, gc._replica_score(a))
+
+    # requests in flight make the wait longer
+    gc._replica_begin(a)
+    self.assertAlmostEqual(0.34, gc._replica_score(a))
+    gc._replica_end(a, time.time(), None, True)
+    self.assertEqual(1, gc.replica_stats()[a]['failures'])
+
+    # graphs we know nothing of, or nothing recent, come first
+    self.assertEqual(0.0, gc._replica_score(b))
+    gc.replicas[a]['updated'] -= gc.LATENCY_STALE_TIME + 1
+    self.assertEqual(0.0, gc._replica_score(a))
+
+  def testPickAddr(self):
+    policy = conn_tcp.TcpGraphConnector.BUILTIN_TIMEOUT_POLICIES['default']
+    for mode in ('p2c', 'least_latency'):
+      gc, a, b = self.TwoGraphs(replica_selection=mode)
+      for addr, tg in ((a, 0.5), (b, 0.1)):
+        gc._replica_begin(addr)
+        gc._replica_end(addr, time.time(), {'tg': tg}, False)
+
+      self.assertEqual(set([b]), set(gc._pick_addr(policy) for _ in xrange(20)))
+      self.assertEqual(a, gc._pick_addr(policy, exclude=b))
+
+      # a graph marked down is skipped, however fast it was
+      gc._record_failure(b)
+      self.assertEqual(a, gc._pick_addr(policy))
+      self.assertTrue(gc.replica_stats()[b]['down'])
+      # unless there is nothing else
+      self.assertEqual(b, gc._pick_addr(policy, exclude=a))
+
+  def testReplicaFailover(self):
+    gc, a, b = self.TwoGraphs(stop_first=True)
+
+    for i in xrange(5):
+      self.assertEqual([['r%d' % i]], gc.read_varenv('(r%d)' % i, {'tid': 't'}))
+
+    stats = gc.replica_stats()
+    self.assertTrue(stats[a]['down'])
+    self.assertFalse(stats[b]['down'])
+    self.assertEqual(5, stats[b]['requests'])
+    # te=2 in every reply, in milliseconds
+    self.assertAlmostEqual(0.002, stats[b]['graph_time'])
+
+  def HedgePolicy(self, gc):
+    gc.read_latencies.extend([0.01] * gc.HEDGE_MIN_SAMPLES)
+    return dict(gc.timeout_policies['default'], hedge=50, hedge_min=0.05)
+
+  def testHedgeDelay(self):
+    gc, _, _ = self.TwoGraphs()
+    policy = dict(gc.timeout_policies['default'], hedge=90)
+    self.assertTrue(gc._hedgeable(policy, ['read (a)', 'read (b)']))
+    self.assertFalse(gc._hedgeable(policy, ['read (a)', 'write (b)']))
+    self.assertFalse(gc._hedgeable(gc.timeout_policies['default'],
+                                   ['read (a)']))
+
+    # not until there are HEDGE_MIN_SAMPLES latencies to go by
+    gc.read_latencies.extend([0.1] * (gc.HEDGE_MIN_SAMPLES - 1))
+    self.assertEqual(None, gc._hedge_delay(policy))
+    gc.read_latencies.append(1.0)
+    self.assertEqual(0.1, gc._hedge_delay(policy))
+    policy['hedge'] = 99
+    self.assertEqual(1.0, gc._hedge_delay(policy))
+    policy['hedge_min'] = 2.0
+    self.assertEqual(2.0, gc._hedge_delay(policy))
+
+  def testHedgeWins(self):
+    """a slow graph loses the race, and its query is dropped."""
+    gc, slow, fast = self.TwoGraphs(replica_selection='least_latency')
+    self.graphd.delay = 0.5
+    policy = self.HedgePolicy(gc)
+    # so that the slow graph is picked first
+    for addr, tg in ((slow, 0.001), (fast, 1.0)):
+      gc._replica_begin(addr)
+      gc._replica_end(addr, time.time(), {'tg': tg}, False)
+
+    start = time.time()
+    result = gc.transmit_query('read (a)', policy, None)
+    self.assertLess(time.time() - start, 0.4)
+    self.assertEqual([['a']], result)
+    self.assertEqual(1, gc.totalcost['ghr'])
+    self.assertEqual(1, gc.totalcost['ghw'])
+    self.assertGreater(gc.totalcost['ght'], 0)
+
+    stats = gc.replica_stats()
+    self.assertEqual(1, stats[slow]['failures'])
+    self.assertEqual(0, stats[slow]['in_flight'])
+    self.assertEqual(0, stats[fast]['failures'])
+    self.assertEqual(0, gc.pool.stats()['in_use'])
+
+    # the loser's connection was dropped, not returned to the pool
+    deadline = time.time() + 2.0
+    while self.graphd.connections and time.time() < deadline:
+      time.sleep(0.01)
+    self.assertEqual(set(), self.graphd.connections)
+
+  def testHedgeLoses(self):
+    """a quick first graph is not hedged."""
+    gc, _, _ = self.TwoGraphs()
+    policy = self.HedgePolicy(gc)
+    for i in xrange(5):
+      self.assertEqual([['r%d' % i]],
+                       gc.transmit_query('read (r%d)' % i, policy, None))
+    self.assertEqual(0, gc.totalcost['ghr'])
+    self.assertEqual(gc.HEDGE_MIN_SAMPLES + 5, len(gc.read_latencies))
+
+  def RetryBudget(self, rate, burst):
+    budget = conn_tcp.RetryBudget(rate, burst)
+    old, conn_tcp._retry_budget = conn_tcp._retry_budget, budget
+    self.addCleanup(setattr, conn_tcp, '_retry_budget', old)
+    return budget
+
+  def testRetrySchedule(self):
+    self.RetryBudget(0.0, 100)
+    gc = conn_tcp.TcpGraphConnector([self.graphd.addr])
+    self.addCleanup(gc.close)
+    gc.RETRY_JITTER = 0.0
+    default = gc.timeout_policies['default']
+
+    policy = dict(default, retry=[0.0, 0.5, 0.5])
+    del policy['backoff']
+    self.assertEqual([0.0, 0.5, 0.5], list(gc._retry_schedule(policy, None)))
+
+    # retry only sets the number of attempts, and the first retry
+    policy = dict(default, retry=[0.0] * 6, backoff=0.1, backoff_max=0.5)
+    self.assertEqual([0.0, 0.0, 0.1, 0.2, 0.4, 0.5],
+                     list(gc._retry_schedule(policy, None)))
+    policy = dict(default, retry=[0.0] * 5, backoff=4.0)
+    self.assertEqual([0.0, 0.0, 4.0, 8.0, gc.RETRY_BACKOFF_MAX],
+                     list(gc._retry_schedule(policy, None)))
+    self.assertEqual(11, gc.totalcost['grs'])
+
+    # at most half of the time left, and nothing once it is up
+    schedule = list(gc._retry_schedule(policy, time.time() + 1.0))
+    self.assertEqual(5, len(schedule))
+    self.assertTrue(0.25 < schedule[2] <= 0.5)
+    self.assertEqual([0.0], list(gc._retry_schedule(policy, time.time() - 1)))
+
+    gc.RETRY_JITTER = 0.5
+    for interval in list(gc._retry_schedule(policy, None))[2:]:
+      self.assertTrue(2.0 <= interval <= gc.RETRY_BACKOFF_MAX)
+
+    # the built in policies that retry all back off, after retrying a
+    # stale connection at once where they always did
+    for name, policy in gc.BUILTIN_TIMEOUT_POLICIES.iteritems():
+      if len(policy['retry']) > 1:
+        self.assertTrue(policy.get('backoff') > 0, name)
+        schedule = list(gc._retry_schedule(policy, None))
+        self.assertEqual(policy['retry'][1] == 0.0, schedule[1] == 0.0, name)
+
+  def testRetryBudget(self):
+    budget = self.RetryBudget(2.0, 3)
+    self.assertEqual([True, True, True, False],
+                     [budget.withdraw() for _ in xrange(4)])
+
+    # tokens come back at rate per second, up to burst
+    budget.last -= 1.0
+    self.assertEqual([True, True, False],
+                     [budget.withdraw() for _ in xrange(3)])
+    budget.last -= 60.0
+    self.assertTrue(budget.withdraw())
+    self.assertAlmostEqual(2.0, budget.tokens, places=2)
+
+    # retries stop once the budget is spent
+    gc = conn_tcp.TcpGraphConnector([self.graphd.addr])
+    self.addCleanup(gc.close)
+    budget.tokens = 1.0
+    budget.rate = 0.0
+    policy = dict(gc.timeout_policies['default'], retry=[0.0] * 5)
+    self.assertEqual(2, len(list(gc._retry_schedule(policy, None))))
+    self.assertEqual(1, gc.totalcost['grs'])
+    self.assertEqual(1, gc.totalcost['grb'])
+
+  def testRetryBudgetUnparsedFlags(self):
+    """the budget falls back on the flag defaults before flags are parsed."""
+    self.RetryBudget(0.0, 0)
+    conn_tcp._retry_budget = None
+    conn_tcp.FLAGS.unparse_flags()
+    self.addCleanup(conn_tcp.FLAGS.mark_as_parsed)
+
+    gc = conn_tcp.TcpGraphConnector([self.graphd.addr])
+    self.addCleanup(gc.close)
+    budget = conn_tcp.retry_budget()
+    self.assertEqual(conn_tcp.FLAGS['graphd_retry_budget_rate'].default,
+                     budget.rate)
+    self.assertEqual(conn_tcp.FLAGS['graphd_retry_budget_burst'].default,
+                     budget.burst)
+
+  def ReadAll(self, gc, varenvs, stagger=0.05):
+    """Read (a) with each varenv, in threads started stagger apart.
+
+    Returns a (result or exception, totalcost) per varenv.
+    """
+    outcomes = [None] * len(varenvs)
+
+    def run(i):
+      gc.reset_cost()
+      try:
+        outcome = gc.read_varenv('(a)', varenvs[i])
+      except Exception, e:  # pylint: disable-msg=W0703
+        outcome = e
+      outcomes[i] = (outcome, dict(gc.totalcost))
+
+    threads = []
+    for i in xrange(len(varenvs)):
+      threads.append(threading.Thread(target=run, args=(i,)))
+      threads[-1].start()
+      time.sleep(stagger)
+    for t in threads:
+      t.join()
+    return outcomes
+
+  def testCoalescedReads(self):
+    self.graphd.delay = 0.2
+    gc = conn_tcp.TcpGraphConnector([self.graphd.addr], pool_size=4)
+    self.addCleanup(gc.close)
+    self.assertEqual(None, gc.inflight_reads)
+
+    gc = conn_tcp.TcpGraphConnector([self.graphd.addr],
+                                    pool_size=4,
+                                    coalesce_reads=True)
+    self.addCleanup(gc.close)
+    outcomes = self.ReadAll(gc, [{'tid': 't%d' % i} for i in xrange(4)])
+
+    self.assertEqual(1, len(self.graphd.requests))
+    self.assertEqual([[['a']]] * 4, [result for result, _ in outcomes])
+    self.assertEqual([0, 1, 1, 1], [cost.get('gqc', 0) for _, cost in outcomes])
+    self.assertEqual(1, outcomes[0][1]['mql_dbreqs'])
+    # everyone has their own copy
+    outcomes[1][0][0][0] = 'b'
+    self.assertEqual([['a']], outcomes[2][0])
+
+  def testCoalesceKeys(self):
+    """reads are only coalesced under the same policy and deadline class."""
+    self.graphd.delay = 0.1
+    gc = conn_tcp.TcpGraphConnector([self.graphd.addr],
+                                    pool_size=4,
+                                    coalesce_reads=True)
+    self.addCleanup(gc.close)
+    soon = time.time() + 0.5
+    varenvs = [{'tid': 't'}, {'tid': 't', 'policy': 'fast'},
+               {'tid': 't', 'epoch_deadline': soon},
+               {'tid': 't', 'epoch_deadline': soon}]
+    outcomes = self.ReadAll(gc, varenvs, stagger=0.01)
+
+    self.assertEqual([[['a']]] * 4, [result for result, _ in outcomes])
+    self.assertEqual(3, len(self.graphd.requests))
+    self.assertEqual(1, outcomes[3][1].get('gqc'))
+
+  def testCoalescedReadDeadline(self):
+    """a follower waits no longer than its own deadline."""
+    self.graphd.delay = 0.5
+    gc = conn_tcp.TcpGraphConnector([self.graphd.addr],
+                                    pool_size=4,
+                                    coalesce_reads=True)
+    self.addCleanup(gc.close)
+    now = time.time()
+    varenvs = [{'tid': 't', 'epoch_deadline': now + 0.9},
+               {'tid': 't', 'epoch_deadline': now + 0.3}]
+    outcomes = self.ReadAll(gc, varenvs)
+
+    self.assertEqual([['a']], outcomes[0][0])
+    self.assertTrue(isinstance(outcomes[1][0], MQLTimeoutError))
+    self.assertEqual(1, len(self.graphd.requests))
+
+  def testReplyCache(self):
+    self.graphd.reply = dateline_reply
+    gc = conn_tcp.TcpGraphConnector([self.graphd.addr],
+                                    reply_cache_bytes=1 << 20,
+                                    reply_cache_ttl=0.2)
+    self.addCleanup(gc.close)
+
+    result = gc.read_varenv('(t5)', {'tid': 't'})
+    result[0][0] = 'changed'
+    self.assertEqual([['t5']], gc.read_varenv('(t5)', {'tid': 't'}))
+    self.assertEqual(1, len(self.graphd.requests))
+    self.assertEqual(1, gc.totalcost['gch'])
+
+    # not for a request that wants a newer dateline
+    gc.read_varenv('(t5)', {'tid': 't', 'write_dateline': '6'})
+    self.assertEqual(2, len(self.graphd.requests))
+    gc.read_varenv('(t5)', {'tid': 't', 'write_dateline': '4'})
+    self.assertEqual(2, len(self.graphd.requests))
+
+    # nor once it is older than the ttl
+    time.sleep(0.3)
+    gc.read_varenv('(t5)', {'tid': 't'})
+    self.assertEqual(3, len(self.graphd.requests))
+    self.assertEqual(1, gc.reply_cache.stats()['entries'])
+
+  def testClone(self):
+    """a clone has the same settings, but its own addresses and pool."""
+    gc, a, b = self.TwoGraphs(replica_selection='random', reply_cache_bytes=1)
+    clone = gc.clone([b])
+    self.addCleanup(clone.close)
+
+    self.assertEqual([b], clone.addr_list)
+    self.assertEqual('random', clone.replica_selection)
+    self.assertEqual(2, clone.pool.size)
+    self.assertIsNot(gc.pool, clone.pool)
+    self.assertIsNot(None, clone.reply_cache)
+    self.assertEqual([['c']], clone.read_varenv('(c)', {'tid': 't'}))
+    self.assertEqual(b, clone.addr)
+
+
+if __name__ == '__main__':
+  googletest.main()
@@ -0,0 +1,172 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""ScopedDict and Varenv unittest for pymql."""
+
+import google3
+from pymql.mql.env import PrivateScopedDict
+from pymql.mql.env import ScopedDict
+from pymql.mql.env import Varenv
+
+from google3.testing.pybase import googletest
+
+
+class ScopedDictTest(googletest.TestCase):
+
+  def testReadThrough(self):
+    parent = {'a': 1, 'b': 2}
+    scope = ScopedDict(parent)
+    scope['c'] = 3
+
+    self.assertEqual(1, scope['a'])
+    self.assertEqual(2, scope.get('b'))
+    self.assertEqual(None, scope.get('d'))
+    self.assertIn('a', scope)
+    self.assertNotIn('d', scope)
+    self.assertRaises(KeyError, lambda: scope['d'])
+    self.assertEqual({'a': 1, 'b': 2, 'c': 3}, dict(scope.iteritems()))
+    self.assertEqual(3, len(scope))
+    self.assertEqual({'a': 1, 'b': 2, 'c': 3}, scope.copy())
+
+    # the parent is read through, not copied
+    parent['d'] = 4
+    self.assertEqual(4, scope['d'])
+
+  def testSetStaysLocal(self):
+    parent = {'a': 1}
+    scope = ScopedDict(parent)
+    scope['a'] = 10
+    scope.update(b=20)
+    self.assertEqual(20, scope.setdefault('b', 30))
+    self.assertEqual(40, scope.setdefault('c', 40))
+
+    self.assertEqual({'a': 10, 'b': 20, 'c': 40}, dict(scope.iteritems()))
+    self.assertEqual({'a': 1}, parent)
+
+  def testHide(self):
+    """deleting a key of the parent hides it, until it is set again."""
+    parent = {'a': 1, 'b': 2}
+    scope = ScopedDict(parent)
+    del scope['a']
+    self.assertNotIn('a', scope)
+    self.assertEqual(['b'], scope.keys())
+    self.assertEqual(2, scope.pop('b'))
+    self.assertEqual(None, scope.pop('b', None))
+    self.assertRaises(KeyError, scope.pop, 'b')
+    self.assertEqual(0, len(scope))
+    self.assertEqual({'a': 1, 'b': 2}, parent)
+
+    # a key set here and in the parent is hidden by one delete
+    scope['a'] = 10
+    self.assertEqual(10, scope['a'])
+    del scope['a']
+    self.assertNotIn('a', scope)
+    self.assertRaises(KeyError, scope.__delitem__, 'a')
+
+  def testVisibleKeys(self):
+    scope = ScopedDict({'a': 1, 'b': 2}, keys=['a', 'c'])
+    self.assertEqual({'a': 1}, dict(scope.iteritems()))
+    self.assertNotIn('b', scope)
+    scope['b'] = 3
+    self.assertEqual(3, scope['b'])
+
+  def testChained(self):
+    top = ScopedDict({'a': 1})
+    top['b'] = 2
+    bottom = ScopedDict(top)
+    del bottom['a']
+    top['c'] = 3
+    self.assertEqual({'b': 2, 'c': 3}, dict(bottom.iteritems()))
+    self.assertEqual({'a': 1, 'b': 2, 'c': 3}, dict(top.iteritems()))
+
+
+class PrivateScopedDictTest(googletest.TestCase):
+
+  def testMutableCopied(self):
+    """mutable values are copied once, when first read through."""
+    parent = {'a': 1, 'perms': {'p': True}, 'macro': {'m': [1]}}
+    scope = PrivateScopedDict(parent)
+
+    perms = scope.setdefault('perms', {})
+    perms['q'] = False
+    self.assertIs(perms, scope['perms'])
+    self.assertEqual({'p': True, 'q': False}, scope['perms'])
+    scope.get('macro')['m'].append(2)
+    self.assertEqual({'a': 1, 'perms': {'p': True}, 'macro': {'m': [1]}},
+                     parent)
+
+    # scalars are shared, and only the values read were copied
+    self.assertEqual(['macro', 'perms'], sorted(dict(scope)))
+
+  def testUnderVarenv(self):
+    """a Varenv over a private scope can't change the scope's parent."""
+    parent = {'write_permission': {}}
+    varenv = Varenv(PrivateScopedDict(parent), None)
+    varenv.setdefault('write_permission', {})['/p'] = True
+    self.assertEqual({'write_permission': {}}, parent)
+
+
+class VarenvTest(googletest.TestCase):
+
+  def testDefaults(self):
+    parent = {'tid': 't', '$lang': u'/lang/fr'}
+    varenv = Varenv(parent, None)
+    self.assertEqual('/lang/fr', varenv['$lang'])
+    self.assertIsInstance(varenv['$lang'], str)
+    self.assertEqual('/boot/all_permission', varenv['$permission'])
+    self.assertEqual(set(), varenv['vars_used'])
+    self.assertEqual({'tid': 't', '$lang': u'/lang/fr'}, parent)
+
+  def testExport(self):
+    """only the keys exported are copied back to the parent."""
+    parent = {'tid': 't', 'cursor': True}
+    varenv = Varenv(parent, None)
+    varenv['cursor'] = 'c1'
+    varenv['gr_log_code'] = 'x'
+    varenv.export(['cursor', 'dateline'])
+
+    self.assertEqual({'tid': 't', 'cursor': 'c1'}, parent)
+
+  def testVarUsed(self):
+    parent = Varenv({}, None)
+    varenv = Varenv(parent, None)
+    varenv.var_used('$x')
+    self.assertEqual(set(['$x']), varenv['vars_used'])
+    self.assertEqual(set(['$x']), parent['vars_used'])
+
+  def testChild(self):
+    varenv = Varenv({'tid': 't', 'cursor': True, '$user': '/user/a'}, None)
+    varenv['policy'] = 'fast'
+    child = varenv.child()
+
+    self.assertEqual('t', child['tid'])
+    self.assertEqual('fast', child['policy'])
+    self.assertEqual('/user/a', child['$user'])
+    self.assertNotIn('cursor', child)
+
+    child['policy'] = 'slow'
+    self.assertEqual('fast', varenv['policy'])
+
+  def testCopy(self):
+    parent = {'tid': 't'}
+    varenv = Varenv(parent, None)
+    copy = varenv.copy()
+    copy['tid'] = 'u'
+    copy.export(['tid'])
+
+    self.assertEqual('t', varenv['tid'])
+    self.assertEqual({'tid': 't'}, parent)
+
+
+if __name__ == '__main__':
+  googletest.main()
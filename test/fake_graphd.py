@@ -0,0 +1,119 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A graphd stand in, on a local port, for graph connector tests."""
+
+import re
+import socket
+import SocketServer
+import threading
+import time
+
+# the gql at the end of a request, after its modifiers
+_gql_re = re.compile(r'^\S+(?: \w+=(?:"[^"]*"|\S+))* (.*)$')
+
+
+def request_gql(request):
+  """The gql of a request line, without the envelope the connector adds."""
+  m = _gql_re.match(request)
+  return m and m.group(1)
+
+
+def echo_reply(request, dateline='5'):
+  """Answer with the gql of the request, as the result."""
+  return 'ok cost="tu=1 te=2" dateline="%s" (%s)' % (dateline,
+                                                     request_gql(request))
+
+
+class FakeGraphd(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+  """Answers each request line with reply(request), after delay seconds.
+
+  The requests are kept in self.requests, in the order received.
+  """
+
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, reply=echo_reply, delay=0.0):
+    SocketServer.TCPServer.__init__(self, ('127.0.0.1', 0), _Handler)
+    self.reply = reply
+    self.delay = delay
+    self.requests = []
+    self.lock = threading.Lock()
+    # sockets of the connections being served
+    self.connections = set()
+
+    self.thread = threading.Thread(target=self.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+
+  @property
+  def addr(self):
+    return self.server_address
+
+  def gqls(self):
+    with self.lock:
+      return [request_gql(r) for r in self.requests]
+
+  def stop(self):
+    self.shutdown()
+    self.server_close()
+    with self.lock:
+      for connection in self.connections:
+        try:
+          connection.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+          pass
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+
+  def handle(self):
+    server = self.server
+    with server.lock:
+      server.connections.add(self.connection)
+    try:
+      self.serve()
+    finally:
+      with server.lock:
+        server.connections.discard(self.connection)
+
+  def finish(self):
+    try:
+      SocketServer.StreamRequestHandler.finish(self)
+    except EnvironmentError:
+      # stop() shut the connection down under us
+      pass
+
+  def serve(self):
+    server = self.server
+    while True:
+      try:
+        line = self.rfile.readline()
+      except EnvironmentError:
+        return
+      if not line:
+        return
+
+      request = line.rstrip('\n')
+      with server.lock:
+        server.requests.append(request)
+      if server.delay:
+        time.sleep(server.delay)
+
+      try:
+        self.wfile.write(server.reply(request) + '\n')
+        self.wfile.flush()
+      except EnvironmentError:
+        # the connector gave up on us
+        return
@@ -0,0 +1,125 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""graphd reply parser unittest for pymql."""
+
+import time
+
+import google3
+from pymql.mql import error
+from pymql.mql import grparse
+
+from google3.testing.pybase import googletest
+
+REPLIES = [
+    'ok cost="tu=1 te=2" dateline="5" '
+    '((("a\\"b c" 0123:abc-x.y null -> <- "" "x\\\\") ("q\\ny" true)) ())',
+    'error id="x" EMPTY "nothing \\"here\\""',
+    'ok (' + ' '.join('"%s"' % ('v' * (i % 40)) for i in xrange(2000)) + ')',
+]
+
+
+def ParseWhole(replystr):
+  """The nested lists for a whole reply, the way we always parsed them."""
+  curlist = []
+  stack = []
+  for tok in grparse.graphresult_re.findall(replystr):
+    if tok == '(':
+      stack.append(curlist)
+      curlist = []
+    elif tok == ')':
+      sublist = curlist
+      curlist = stack.pop()
+      curlist.append(sublist)
+    elif tok != ' ':
+      curlist.append(tok)
+  return curlist
+
+
+class ReplyParserTest(googletest.TestCase):
+
+  def testChunks(self):
+    """every way of cutting the input up gives the same replies."""
+    data = '\n'.join(REPLIES) + '\n'
+    expected = [ParseWhole(r) for r in REPLIES]
+
+    for chunk_size in (1, 2, 3, 7, 64, 8192):
+      parser = grparse.ReplyParser()
+      recvbuf = bytearray(chunk_size)
+      for i in xrange(0, len(data), chunk_size):
+        chunk = data[i:i + chunk_size]
+        recvbuf[:len(chunk)] = chunk
+        parser.parsestr(buffer(recvbuf, 0, len(chunk)))
+
+      self.assertEqual(expected,
+                       [parser.get_reply_raw() for r in REPLIES])
+      self.assertFalse(parser.isready())
+      self.assertEqual('', parser.tail)
+
+  def testLongString(self):
+    """a string spread over many chunks, escapes cut in two included."""
+    value = '"' + ('ab\\"c\\\\d\\n ' * 20000) + '"'
+    reply = 'ok dateline="5" ((%s "x") %s)' % (value, value)
+    data = reply + '\n' + REPLIES[1] + '\n'
+
+    for chunk_size in (2, 3, 7, 4096):
+      parser = grparse.ReplyParser()
+      for i in xrange(0, len(data), chunk_size):
+        parser.parsestr(data[i:i + chunk_size])
+
+      self.assertEqual(ParseWhole(reply), parser.get_reply_raw())
+      self.assertEqual(len(reply) + 1, parser.reply_nbytes)
+      self.assertEqual(ParseWhole(REPLIES[1]), parser.get_reply_raw())
+      self.assertEqual('', parser.tail)
+
+  def testLongStringTime(self):
+    """each chunk of a long string is only looked at once."""
+    reply = 'ok ("%s")\n' % ('x' * (2 << 20))
+    parser = grparse.ReplyParser()
+    start = time.time()
+    for i in xrange(0, len(reply), 8192):
+      parser.parsestr(reply[i:i + 8192])
+    # quadratic rescanning takes about a minute
+    self.assertLess(time.time() - start, 5.0)
+    self.assertEqual(len(reply) - 6, len(parser.get_reply_raw()[1][0]))
+
+  def testGetReply(self):
+    parser = grparse.ReplyParser()
+    parser.parse_full_reply(REPLIES[0])
+    result = parser.get_reply()
+    self.assertEqual('tu=1 te=2', result.cost)
+    self.assertEqual('5', result.dateline)
+    self.assertEqual(['"q\\ny"', 'true'], result[0][1])
+
+  def testCopyResult(self):
+    parser = grparse.ReplyParser()
+    parser.parse_full_reply(REPLIES[0])
+    result = parser.get_reply()
+    copy = grparse.copy_result(result)
+    self.assertEqual(result, copy)
+    self.assertEqual(result.dateline, copy.dateline)
+    copy[0][1][0] = None
+    self.assertEqual('"q\\ny"', result[0][1][0])
+
+  def testUnbalanced(self):
+    parser = grparse.ReplyParser()
+    self.assertRaises(error.MQLGraphError, parser.parsestr, 'ok ((a)\n')
+    # the parser is usable again afterwards
+    parser.parsestr('ok (a)\n')
+    self.assertEqual(['ok', ['a']], parser.get_reply_raw())
+
+
+if __name__ == '__main__':
+  googletest.main()
@@ -0,0 +1,417 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""mqlread plan cache unittest for pymql, without a graph or schema."""
+
+import google3
+from pymql.mql import hijson
+from pymql.mql.env import DeferredGuidLookup
+from pymql.mql.env import DeferredGuidOfMidLookup
+from pymql.mql.env import Varenv
+from pymql.mql.error import MQLGraphError
+from pymql.mql.error import MQLParseError
+from pymql.mql.utils import QueryDict
+from pymql.mql.utils import valid_mid
+
+from google3.testing.pybase import googletest
+
+
+class FakeLookup(object):
+
+  def __init__(self):
+    self.guids = {'/en/a': '#aa', '/en/b': '#bb', '/lang/en': '#e1'}
+    # the ids and mids asked for, a list for each lookup
+    self.asked = []
+
+  def lookup_guids(self, ids, varenv):
+    self.asked.append(sorted(ids))
+    return dict((id, self.guids[id]) for id in ids if id in self.guids)
+
+  def lookup_guids_of_mids(self, mids, varenv):
+    self.asked.append(sorted(mids))
+    return dict((mid, '#' + mid[3:]) for mid in mids)
+
+  def lookup_guids_and_mids(self, ids, mids, varenv):
+    self.asked.append(sorted(ids + mids))
+    return (dict((id, self.guids[id]) for id in ids if id in self.guids),
+            dict((mid, '#' + mid[3:]) for mid in mids))
+
+  def lookup_mids_of_guids(self, guids, varenv):
+    return {}
+
+  def lookup_ids(self, guids, varenv):
+    return {}
+
+
+class FakeGraphConnector(object):
+  """Answers each GQL with its reply, or the MQLGraphError in bad."""
+
+  def __init__(self):
+    self.totalcost = {}
+    self.bad = {}
+    # the GQL of each read, a list for each read_varenv_multiple()
+    self.reads = []
+
+  def reply(self, gquery):
+    if gquery in self.bad:
+      raise self.bad[gquery]
+    return 'reply to ' + gquery
+
+  def read_varenv(self, gquery, varenv):
+    self.reads.append(gquery)
+    return self.reply(gquery)
+
+  def read_varenv_multiple(self, gqueries, varenv):
+    self.reads.append(gqueries)
+    return [self.reply(gquery) for gquery in gqueries]
+
+
+class FakeLowQuery(object):
+
+  def __init__(self):
+    self.lookup = FakeLookup()
+    self.gc = FakeGraphConnector()
+
+
+class FakeSchemaFactory(object):
+  generation = 0
+
+
+class FakeType(object):
+
+  def __init__(self, id):
+    self.id = id
+
+  def get_default_property_name(self):
+    return 'value'
+
+
+class FakeLink(object):
+
+  def __init__(self, value):
+    self.value = value
+
+
+class FakeNode(object):
+  """The root of a compiled query: its id looked up, and a link a key."""
+
+  # the type of the value of each key
+  types = {'name': '/type/text', 'key': '/type/key', 'size': '/type/int'}
+
+  def __init__(self, query, varenv):
+    id = query['id'].value
+    if valid_mid(id):
+      self.guid = DeferredGuidOfMidLookup(id, varenv.lookup_manager)
+    else:
+      self.guid = DeferredGuidLookup(id, varenv.lookup_manager)
+    self.cursor = varenv.get('cursor')
+
+    self.links = []
+    for key in sorted(self.types):
+      if key not in query:
+        continue
+      # as resolve_terminal() and add_query_primitive_value() leave it
+      clause = query[key]
+      clause.stype = FakeType(self.types[key])
+      clause.link = FakeLink(clause.value)
+      clause.default = 'value'
+      clause['value'] = QueryDict(
+          terminal='V',
+          value=clause.value,
+          implied=True,
+          key='value',
+          parent_clause=clause)
+      self.links.append((key, clause.link))
+
+  def generate_graph_query(self, qpush):
+    qpush('(guid=%s' % self.guid.graph_guid())
+    for key, link in self.links:
+      qpush(' %s=%r' % (key, link.value))
+    if self.cursor is not None:
+      qpush(' cursor=%s' % self.cursor)
+    qpush(')')
+
+  def parse_result_root(self, result, varenv):
+    return {'result': result}
+
+
+class FakeHighQuery(hijson.HighQuery):
+  """A HighQuery compiling {"id": ..., <key>: ...} queries without a schema."""
+
+  def __init__(self, plan_cache_size=1000):
+    hijson.HighQuery.__init__(
+        self, FakeLowQuery(), plan_cache_size=plan_cache_size)
+    self._schema_factory = FakeSchemaFactory()
+    self.compiles = []
+
+  def compile_graph_query(self, orig_query, varenv):
+    self.compiles.append(orig_query)
+    query = self.make_orig(orig_query, varenv, True)
+    query.node = FakeNode(query, varenv)
+    return query
+
+
+class PlanCacheTest(googletest.TestCase):
+
+  def setUp(self):
+    self.hq = FakeHighQuery()
+
+  def Read(self, query, **env):
+    """planned_graph_query() of query; returns its GQL and query tree."""
+    env.setdefault('$lang', '/lang/en')
+    varenv = Varenv(env, self.hq.querier.lookup)
+    mquery, gquery, plan = self.hq.planned_graph_query(query, varenv, None)
+    if plan is not None:
+      plan.cache.checkin(plan)
+    return gquery, mquery
+
+  def testPlanCacheBindsIdsAndText(self):
+    self.assertEqual("(guid=aa name='x')",
+                     self.Read({'id': '/en/a', 'name': 'x'})[0])
+
+    query = {'name': u'\xe9', 'id': '/en/b'}
+    gquery, mquery = self.Read(query)
+    self.assertEqual("(guid=bb name='\\xc3\\xa9')", gquery)
+    self.assertEqual('/en/b', mquery['id'].value)
+    self.assertEqual(u'\xe9', mquery['name'].original_query)
+
+    self.assertEqual("(guid=0x name='x')",
+                     self.Read({'id': '/m/0x', 'name': 'x'})[0])
+    self.assertEqual("(guid=0y name='y')",
+                     self.Read({'id': '/m/0y', 'name': 'y'})[0])
+
+    # compiled once for ids and once for mids, from copies of the query
+    self.assertEqual(2, len(self.hq.compiles))
+    self.assertEqual({'name': u'\xe9', 'id': '/en/b'}, query)
+    self.assertEqual(2, self.hq.querier.gc.totalcost['mql_plan_hits'])
+    stats = self.hq.plan_cache.stats()
+    self.assertEqual(2, stats['entries'])
+    self.assertEqual(2, stats['hits'])
+
+  def testPlanCacheKeysOtherValues(self):
+    """values that can't be found again in the plan are part of its key."""
+    for key, value in (('key', 'x'), ('size', 'x'), ('name', '/lang/en')):
+      compiles = len(self.hq.compiles)
+      self.Read({'id': '/en/a', key: value})
+      self.Read({'id': '/en/b', key: value})
+      self.assertEqual(compiles + 1, len(self.hq.compiles))
+      self.Read({'id': '/en/b', key: 'y'})
+      self.assertEqual(compiles + 2, len(self.hq.compiles))
+
+    # the same string for both is lifted as one param, that can't be bound
+    self.Read({'id': '/en/a', 'name': '/en/a'})
+    self.assertEqual("(guid=bb name='/en/b')",
+                     self.Read({'id': '/en/b', 'name': '/en/b'})[0])
+    self.assertEqual(8, len(self.hq.compiles))
+
+  def testPlanCacheLongValue(self):
+    """a value make_orig() would refuse is not bound in its place."""
+    self.Read({'id': '/en/a', 'name': 'x'})
+    self.assertRaises(MQLParseError, self.Read, {
+        'id': '/en/a',
+        'name': 'x' * 5000
+    })
+
+  def testPlanCacheCursorAndGeneration(self):
+    self.Read({'id': '/en/a'})
+    self.assertEqual('(guid=aa cursor=c1)',
+                     self.Read({'id': '/en/a'}, cursor='c1')[0])
+    self.assertEqual('(guid=bb cursor=c2)',
+                     self.Read({'id': '/en/b'}, cursor='c2')[0])
+    self.assertEqual(2, len(self.hq.compiles))
+
+    self.hq.querier.lookup.guids['/en/a'] = '#cc'
+    self.assertEqual('(guid=cc)', self.Read({'id': '/en/a'})[0])
+    self.assertEqual(2, len(self.hq.compiles))
+
+    self.hq.schema_factory.generation += 1
+    self.Read({'id': '/en/a'})
+    self.assertEqual(3, len(self.hq.compiles))
+    self.assertGreater(self.hq.plan_cache.stats()['invalidations'], 0)
+
+  def testPlanCacheSkipsMacros(self):
+    self.Read({'id': '/en/a'}, macro={'m': {}})
+    self.Read({'id': '/en/a'}, macro={'m': {}})
+    self.assertEqual(2, len(self.hq.compiles))
+    self.assertEqual(0, self.hq.plan_cache.stats()['entries'])
+
+  def testLiftPlaceholders(self):
+    """strings that look like placeholders are lifted, wherever they are."""
+    template, params = hijson.QueryTemplate.lift(
+        {
+            'id': '/en/a',
+            'name': '$x',
+            'key': '/en/a',
+            'type': '/t',
+            'sort': ['$y']
+        }, None)
+    self.assertEqual({
+        'id': '$v0',
+        'name': '$v1',
+        'key': '$v0',
+        'type': '/t',
+        'sort': ['$v2']
+    }, template.query)
+    self.assertEqual({'v0': '/en/a', 'v1': '$x', 'v2': '$y'}, params)
+    self.assertEqual(None, hijson.QueryTemplate.lift({'id': object()}, None)[0])
+
+
+class CachedAgainstUncachedTest(googletest.TestCase):
+  """reads through the plan cache give what compiling every read gives."""
+
+  # (query, varenv) pairs, repeated with other ids, mids and values
+  READS = [
+      ({'id': '/en/a', 'name': 'x'}, {}),
+      ({'id': '/en/b', 'name': 'y'}, {}),
+      ({'id': '/m/0x', 'name': 'x'}, {}),
+      ({'name': u'\xe9', 'id': '/m/0y'}, {}),
+      ({'id': '/en/a', 'key': 'k1'}, {}),
+      ({'id': '/en/b', 'key': 'k1'}, {}),
+      ({'id': '/en/b', 'key': 'k2'}, {}),
+      ({'id': '/en/a', 'name': '/en/a'}, {}),
+      ({'id': '/en/b', 'name': '/en/b'}, {}),
+      ({'id': '/en/a', 'size': '1'}, {'cursor': 'c1'}),
+      ({'id': '/en/b', 'size': '2'}, {'cursor': 'c2'}),
+      ({'id': '/en/a'}, {'macro': {'m': {}}}),
+  ]
+
+  def ReadAll(self, hq):
+    """hq.read() each of READS twice; returns the results and varenvs."""
+    results = []
+    for _ in xrange(2):
+      for query, env in self.READS:
+        env = dict(env, **{'$lang': '/lang/en'})
+        results.append((hq.read(dict(query), env), env))
+    return results
+
+  def testSameResults(self):
+    cached = FakeHighQuery()
+    uncached = FakeHighQuery(plan_cache_size=0)
+    self.assertEqual(None, uncached.plan_cache)
+
+    self.assertEqual(self.ReadAll(uncached), self.ReadAll(cached))
+    self.assertEqual(uncached.querier.gc.reads, cached.querier.gc.reads)
+
+    self.assertEqual(2 * len(self.READS), len(uncached.compiles))
+    self.assertLess(len(cached.compiles), len(self.READS))
+    self.assertGreater(cached.plan_cache.stats()['hits'], len(self.READS))
+
+
+class PreparedTest(googletest.TestCase):
+
+  def setUp(self):
+    self.hq = FakeHighQuery()
+
+  def Read(self, template, params, **env):
+    """prepared_graph_query() of template; returns its GQL and query tree."""
+    env.setdefault('$lang', '/lang/en')
+    varenv = Varenv(env, self.hq.querier.lookup)
+    mquery, gquery, plan = self.hq.prepared_graph_query(template, params,
+                                                        varenv)
+    if plan is not None:
+      plan.cache.checkin(plan)
+    return gquery, mquery
+
+  def testPreparedBindsParams(self):
+    template = self.hq.prepare({'id': '$id', 'name': '$n', 'key': '$k'})
+    self.assertEqual([(('id',), 'id', 'id'), (('key',), 'k', 'value'),
+                      (('name',), 'n', 'value')], sorted(template.slots))
+
+    for id, name, guid in (('/en/a', 'x', 'aa'), ('/en/b', 'y', 'bb'),
+                           (u'/en/a', u'z', 'aa')):
+      gquery, mquery = self.Read(template, {'id': id, 'n': name, 'k': 'k1'})
+      self.assertEqual("(guid=%s key='k1' name=%r)" % (guid, str(name)),
+                       gquery)
+      # the query the tree points into is kept up to date
+      self.assertEqual(id, mquery.original_query['id'])
+      self.assertEqual(name, mquery['name'].original_query)
+    self.assertEqual(1, len(self.hq.compiles))
+
+    # a /type/key value is resolved once for each value
+    self.Read(template, {'id': '/en/a', 'n': 'x', 'k': 'k2'})
+    self.Read(template, {'id': '/m/0a', 'n': 'x', 'k': 'k2'})
+    self.assertEqual(3, len(self.hq.compiles))
+    self.assertEqual(2, template.plans.stats()['hits'])
+    # the template keeps its plans to itself
+    self.assertEqual(0, self.hq.plan_cache.stats()['entries'])
+
+  def testPreparedSameValueTwice(self):
+    """params that can't be told apart in the tree are keyed, not bound."""
+    template = self.hq.prepare({'id': '$id', 'name': '$n'})
+    self.Read(template, {'id': '/en/a', 'n': '/en/a'})
+    self.assertEqual("(guid=bb name='x')",
+                     self.Read(template, {'id': '/en/b', 'n': 'x'})[0])
+    self.assertEqual(2, len(self.hq.compiles))
+    self.assertEqual("(guid=aa name='/en/a')",
+                     self.Read(template, {'id': '/en/a', 'n': '/en/a'})[0])
+    self.assertEqual(2, len(self.hq.compiles))
+
+  def testPreparedParamErrors(self):
+    template = self.hq.prepare({'id': '$id'})
+    self.assertRaises(MQLParseError, template.substitute, {})
+    self.assertRaises(MQLParseError, template.substitute, {
+        'id': '/en/a',
+        'other': 1
+    })
+
+
+class ReadManyTest(googletest.TestCase):
+
+  def setUp(self):
+    self.hq = FakeHighQuery()
+    self.gc = self.hq.querier.gc
+    self.lookup = self.hq.querier.lookup
+
+  def ReadMany(self, queries):
+    varenvs = dict((key, {'$lang': '/lang/en'}) for key in queries)
+    return self.hq.read_many(queries, varenvs)
+
+  def testReadMany(self):
+    results = self.ReadMany({
+        'a': {'id': '/en/a', 'name': 'x'},
+        'b': {'id': '/m/0b'},
+        'long': {'id': '/en/b', 'name': 'x' * 5000},
+    })
+
+    self.assertEqual({'result': "reply to (guid=aa name='x')"}, results['a'])
+    self.assertEqual({'result': 'reply to (guid=0b)'}, results['b'])
+    self.assertIsInstance(results['long'], MQLParseError)
+
+    # the lookups of the batch, and its reads, each in one go
+    self.assertEqual([['/en/a', '/m/0b']], self.lookup.asked)
+    self.assertEqual([["(guid=aa name='x')", '(guid=0b)']], self.gc.reads)
+
+  def testReadManyGraphError(self):
+    """a query the graph fails only fails its own key."""
+    self.gc.bad['(guid=0b)'] = MQLGraphError(None, 'bad')
+    results = self.ReadMany({'a': {'id': '/en/a'}, 'b': {'id': '/m/0b'}})
+
+    self.assertEqual({'result': 'reply to (guid=aa)'}, results['a'])
+    self.assertIsInstance(results['b'], MQLGraphError)
+    # the batch, then each on its own
+    self.assertEqual(3, len(self.gc.reads))
+
+  def testReadManySharesPlans(self):
+    self.ReadMany({'a': {'id': '/en/a'}})
+    results = self.ReadMany({'a': {'id': '/en/b'}, 'b': {'id': '/en/a'}})
+
+    self.assertEqual({'result': 'reply to (guid=bb)'}, results['a'])
+    self.assertEqual({'result': 'reply to (guid=aa)'}, results['b'])
+    # one plan from the first batch, and one more for the second
+    self.assertEqual(2, len(self.hq.compiles))
+    self.assertEqual(1, self.hq.plan_cache.stats()['hits'])
+    self.assertEqual({}, self.ReadMany({}))
+
+
+if __name__ == '__main__':
+  googletest.main()
@@ -0,0 +1,136 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Schema refresh on MQLTypeError unittest for pymql, without a schema."""
+
+import google3
+from pymql.mql import hijson
+from pymql.mql.error import MQLTypeError
+from pymql.mql.utils import ReadMode
+
+from google3.testing.pybase import googletest
+
+
+class FakeLookup(object):
+
+  def __init__(self):
+    # what was dropped from the cache: ('forget', id, guid) or ('flush',)
+    self.dropped = []
+
+  def forget(self, id, guid=None):
+    self.dropped.append(('forget', id, guid))
+
+  def flush(self):
+    self.dropped.append(('flush',))
+
+
+class FakeLowQuery(object):
+
+  def __init__(self):
+    self.lookup = FakeLookup()
+    self.gc = None
+
+
+class FakeSchemaFactory(object):
+  generation = 0
+
+  def __init__(self):
+    self.dropped = []
+
+  def forget_type(self, typepath):
+    self.dropped.append(('forget_type', typepath))
+    return '#' + typepath
+
+  def flush(self, varenv):
+    self.dropped.append(('flush',))
+
+
+class FakeHighQuery(hijson.HighQuery):
+  """Resolves a query to itself, or raises the next of errors."""
+
+  def __init__(self):
+    hijson.HighQuery.__init__(self, FakeLowQuery(), plan_cache_size=0)
+    self._schema_factory = FakeSchemaFactory()
+    self.errors = []
+    self.resolves = 0
+
+  def reset_cost(self):
+    pass
+
+  def make_orig(self, orig_query, varenv, reject_fakes):
+    return orig_query
+
+  def resolve_names(self, query, varenv, mode):
+    self.resolves += 1
+    if self.errors:
+      error = self.errors.pop(0)
+      if error is not None:
+        raise error
+
+
+def missing_type():
+  return MQLTypeError(
+      None, 'Type %(type)s does not exist', type='/film/film')
+
+
+def unnamed():
+  """An MQLTypeError that names no type or domain to refresh."""
+  return MQLTypeError(
+      None, 'Type %(type)s does not exist', type='/type/film')
+
+
+class ResolveSchemaTest(googletest.TestCase):
+
+  def setUp(self):
+    self.hq = FakeHighQuery()
+
+  def Dropped(self):
+    return self.hq.schema_factory.dropped, self.hq.querier.lookup.dropped
+
+  def testForgetsTypesNamed(self):
+    self.hq.errors = [missing_type()]
+    self.assertEqual('q', self.hq.resolve_schema('q', ReadMode, {}))
+    self.assertEqual(2, self.hq.resolves)
+    self.assertEqual(([('forget_type', '/film/film')],
+                      [('forget', '/film/film', '#/film/film')]),
+                     self.Dropped())
+
+  def testFlushesWhenNoneNamed(self):
+    """an error that names nothing flushes the caches, and retries."""
+    self.hq.errors = [unnamed()]
+    self.assertEqual('q', self.hq.resolve_schema('q', ReadMode, {}))
+    self.assertEqual(2, self.hq.resolves)
+    self.assertEqual(([('flush',)], [('flush',)]), self.Dropped())
+
+  def testConfirmedMissing(self):
+    """an error the refresh didn't fix is raised without another one."""
+    for error in (missing_type, unnamed):
+      self.hq = FakeHighQuery()
+      self.hq.errors = [error(), error()]
+      self.assertRaises(MQLTypeError, self.hq.resolve_schema, 'q', ReadMode,
+                        {'dateline': '5'})
+      dropped = self.Dropped()
+
+      self.hq.errors = [error(), None]
+      self.assertRaises(MQLTypeError, self.hq.resolve_schema, 'q', ReadMode,
+                        {'write_dateline': '4'})
+      self.assertEqual(3, self.hq.resolves)
+      self.assertEqual(dropped, self.Dropped())
+
+      # unless the client has written since
+      self.assertEqual(
+          'q', self.hq.resolve_schema('q', ReadMode, {'write_dateline': '6'}))
+
+
+if __name__ == '__main__':
+  googletest.main()
@@ -0,0 +1,302 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""id and mid lookup unittest for pymql, against a fake graph."""
+
+import google3
+from pymql.mql import lookup
+from pymql.mql import mid
+from pymql.mql.env import DeferredGuidLookup
+from pymql.mql.env import DeferredGuidOfMidLookup
+from pymql.mql.env import DeferredIdLookup
+from pymql.mql.env import DeferredMidOfGuidLookup
+from pymql.mql.env import LookupManager
+from pymql.mql.utils import QueryDict
+
+from google3.testing.pybase import googletest
+
+# what BootNamespace reads: the root namespace, has_key, root user, /boot
+BOOT_RESULT = [[['01', '02', '03', '04'], [], []]]
+
+GUID_B = '#' + mid.to_guid('/m/0b')
+GUID_C = '#' + mid.to_guid('/m/0c')
+
+
+class FakeLookup(object):
+  """Answers every lookup, noting which calls were made."""
+
+  def __init__(self):
+    self.calls = []
+
+  def lookup_guids(self, ids, varenv):
+    self.calls.append('lookup_guids')
+    return dict((id, '#g' + id) for id in ids)
+
+  def lookup_guids_of_mids(self, mids, varenv):
+    self.calls.append('lookup_guids_of_mids')
+    return dict((m, '#g' + m) for m in mids)
+
+  def lookup_guids_and_mids(self, ids, mids, varenv):
+    self.calls.append('lookup_guids_and_mids')
+    return (dict((id, '#g' + id) for id in ids),
+            dict((m, '#g' + m) for m in mids))
+
+  def lookup_ids(self, guids, varenv):
+    self.calls.append('lookup_ids')
+    return dict((guid, '/id' + guid) for guid in guids)
+
+  def lookup_mids_of_guids(self, guids, varenv):
+    self.calls.append('lookup_mids_of_guids')
+    return dict((guid, ['/m' + guid]) for guid in guids)
+
+  def lookup_ids_and_mids(self, id_guids, mid_guids, varenv):
+    self.calls.append('lookup_ids_and_mids')
+    return (dict((guid, '/id' + guid) for guid in id_guids),
+            dict((guid, ['/m' + guid]) for guid in mid_guids))
+
+
+class FakeGraphConnector(object):
+
+  def __init__(self):
+    # the gql of each graph read, a list for each read_varenv_multiple()
+    self.reads = []
+    self.replies = []
+
+  def read_varenv(self, gql, varenv):
+    if not self.reads:
+      # the BootNamespace read
+      self.reads.append(gql)
+      return BOOT_RESULT
+    self.reads.append(gql)
+    return self.replies.pop(0)
+
+  def read_varenv_multiple(self, gqls, varenv):
+    self.reads.append(gqls)
+    return [self.replies.pop(0) for _ in gqls]
+
+
+class FakeNode(object):
+
+  def __init__(self, query):
+    self.query = query
+
+  def generate_graph_query(self, mode):
+    return 'gql(%s)' % sorted(self.query[0])
+
+
+class FakeLowQuery(object):
+  """compile_read() and read_result() of low json, without a schema.
+
+  The graph reply to a low json query is taken to be its result.
+  """
+
+  def __init__(self):
+    self.gc = FakeGraphConnector()
+    self.queries = []
+
+  def compile_read(self, query, varenv):
+    self.queries.append(query)
+    return QueryDict(node=FakeNode(query))
+
+  def read_result(self, query, gresult, varenv):
+    return gresult
+
+  def read(self, query, varenv):
+    low_query = self.compile_read(query, varenv)
+    gresult = self.gc.read_varenv(
+        low_query.node.generate_graph_query(None), varenv)
+    return self.read_result(low_query, gresult, varenv)
+
+
+class LookupManagerTest(googletest.TestCase):
+
+  def setUp(self):
+    self.lookup = FakeLookup()
+    self.manager = LookupManager(self.lookup, {})
+
+  def testMidAndGuidLookups(self):
+    id_defer = DeferredGuidLookup('/en/a', self.manager)
+    mid_defer = DeferredGuidOfMidLookup('/m/0a', self.manager)
+    self.manager.do_mid_and_guid_lookups()
+
+    self.assertEqual(['lookup_guids_and_mids'], self.lookup.calls)
+    self.assertEqual('#g/en/a', id_defer.guid)
+    self.assertEqual('#g/m/0a', mid_defer.guid)
+
+  def testGuidLookupsAlone(self):
+    id_defer = DeferredGuidLookup('/en/a', self.manager)
+    self.manager.do_mid_and_guid_lookups()
+
+    self.assertEqual(['lookup_guids'], self.lookup.calls)
+    self.assertEqual('#g/en/a', id_defer.guid)
+
+  def testMidAndIdLookups(self):
+    id_defer = DeferredIdLookup('#a', self.manager)
+    mid_defer = DeferredMidOfGuidLookup('#b', self.manager)
+    self.manager.do_mid_and_id_lookups()
+
+    self.assertEqual(['lookup_ids_and_mids'], self.lookup.calls)
+    self.assertEqual('/id#a', id_defer.result())
+    self.assertEqual('/m#b', mid_defer.result())
+    self.assertEqual([], self.manager.guid_to_mid_lookups)
+
+  def testMidLookupsAlone(self):
+    mid_defer = DeferredMidOfGuidLookup('#b', self.manager)
+    self.manager.do_mid_and_id_lookups()
+
+    self.assertEqual('/m#b', mid_defer.result())
+    self.assertNotIn('lookup_ids_and_mids', self.lookup.calls)
+
+
+class NamespaceFactoryTest(googletest.TestCase):
+
+  def setUp(self):
+    self.querier = FakeLowQuery()
+    self.gc = self.querier.gc
+    self.factory = lookup.NamespaceFactory(
+        self.querier, id_cache_bytes=1 << 20, namespace_cache_bytes=1 << 20)
+    self.namemap = self.factory.namemap
+
+  def FakeNamespaceWalk(self, guids):
+    """Have the namespace walk find guids, an id -> guid map."""
+
+    def StartLookupMultiple(id_list):
+      return ({}, '(namespace walk)')
+
+    def RecursiveNsResultParse(result, ns_map):
+      self.assertEqual('walk reply', result)
+
+    def FinishLookupMultiple(id_list, varenv):
+      return dict((id, guids[id]) for id in id_list)
+
+    self.namemap.start_lookup_multiple = StartLookupMultiple
+    self.namemap.recursive_ns_result_parse = RecursiveNsResultParse
+    self.namemap.finish_lookup_multiple = FinishLookupMultiple
+
+  def testGuidsAndMidsTogether(self):
+    """the replaced_by query and the namespace walk share one read."""
+    self.FakeNamespaceWalk({'/en/a': '#a1'})
+    self.gc.replies = [[{
+        '@guid': '#' + mid.to_guid('/m/0b'),
+        'replaced_by': {
+            '@guid': '#b2'
+        }
+    }], 'walk reply']
+
+    varenv = {}
+    id_map, mid_map = self.factory.lookup_guids_and_mids(
+        ['/en/a', '#00000000000000000000000000000001'], ['/m/0b', '/m/0c'],
+        varenv)
+
+    self.assertEqual({
+        '/en/a': '#a1',
+        '#00000000000000000000000000000001':
+            '#00000000000000000000000000000001'
+    }, id_map)
+    self.assertEqual({
+        '/m/0b': '#b2',
+        '/m/0c': '#' + mid.to_guid('/m/0c')
+    }, mid_map)
+    self.assertEqual(2, len(self.gc.reads))
+    self.assertEqual(2, len(self.gc.reads[1]))
+    self.assertEqual('(namespace walk)', self.gc.reads[1][1])
+    self.assertNotIn('gr_log_code', varenv)
+
+  def testGuidsWithoutMids(self):
+    self.FakeNamespaceWalk({'/en/a': '#a1'})
+    self.gc.replies = ['walk reply']
+
+    id_map, mid_map = self.factory.lookup_guids_and_mids(['/en/a'], [], {})
+    self.assertEqual({'/en/a': '#a1'}, id_map)
+    self.assertEqual({}, mid_map)
+    self.assertEqual(['(namespace walk)'], self.gc.reads[1:])
+
+
+  def testIdsAndMidsTogether(self):
+    """the best_hrid and replaced_by clauses go in one query."""
+    # as preload() would have found them
+    self.factory.topic_en = '#e1'
+    self.factory.best_hrid_guid = '#h1'
+    self.factory.forbidden_namespaces = ['#f1']
+
+    self.gc.replies = [[{
+        '@guid': GUID_B,
+        'best_hrid': [{
+            ':value': '/en/a'
+        }],
+        'is_instance_of': None,
+        '-has_key': [],
+        '-replaced_by': []
+    }, {
+        '@guid': GUID_C,
+        'best_hrid': [],
+        'is_instance_of': None,
+        '-has_key': [],
+        '-replaced_by': [{
+            '@guid': GUID_B
+        }]
+    }]]
+
+    varenv = {}
+    id_map, mid_map = self.factory.lookup_ids_and_mids([GUID_B], [GUID_C],
+                                                       varenv)
+    self.assertEqual({GUID_B: '/en/a'}, id_map)
+    self.assertEqual({GUID_C: ['/m/0c', '/m/0b']}, mid_map)
+
+    # one read, of the union of the guids
+    self.assertEqual(2, len(self.gc.reads))
+    (query,) = self.querier.queries
+    self.assertEqual(set([GUID_B, GUID_C]), query[0]['@guid'])
+    self.assertIn('best_hrid', query[0])
+    self.assertIn('-replaced_by', query[0])
+    self.assertNotIn('gr_log_code', varenv)
+
+    # and the id found is cached
+    self.assertEqual('/en/a', self.factory.cached_id(GUID_B))
+
+  def testMissingIdCached(self):
+    """a guid with no id is only asked about once."""
+    self.factory.topic_en = '#e1'
+    self.factory.best_hrid_guid = '#h1'
+    self.factory.forbidden_namespaces = ['#f1']
+    self.gc.replies = [[]]
+
+    self.assertEqual('/m/0c', self.factory.lookup_id(GUID_C, {}))
+    self.assertEqual('/m/0c', self.factory.lookup_id(GUID_C, {}))
+    self.assertEqual({GUID_C: '/m/0c'},
+                     self.factory.lookup_ids([GUID_C], {}))
+    self.assertEqual(2, len(self.gc.reads))
+
+    # but not when reading as of a time
+    self.gc.replies = [[]]
+    self.assertEqual('/m/0c', self.factory.lookup_id(GUID_C, {'asof': 'x'}))
+    self.assertEqual(3, len(self.gc.reads))
+
+  def testCacheStats(self):
+    self.factory.guids[GUID_B] = '/en/a'
+    self.assertEqual('/en/a', self.factory.cached_id(GUID_B))
+    self.assertEqual(None, self.factory.cached_id(GUID_C))
+
+    stats = self.factory.cache_stats()
+    self.assertEqual((1, 1, 1), (stats['ids']['entries'], stats['ids']['hits'],
+                                 stats['ids']['misses']))
+    self.assertLessEqual(stats['namespaces']['bytes'], 1 << 20)
+    self.assertEqual(0, stats['namespace_entries']['evictions'])
+    self.assertNotIn('shared', stats)
+
+    self.factory.flush()
+    self.assertEqual(0, self.factory.cache_stats()['ids']['entries'])
+
+
+if __name__ == '__main__':
+  googletest.main()
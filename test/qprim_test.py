@@ -0,0 +1,76 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""QueryPrimitive unittest for pymql."""
+
+import google3
+from pymql.mql.error import MQLInternalParseError
+from pymql.mql.qprim import QueryPrimitive
+from pymql.mql.utils import Missing
+from pymql.mql.utils import QueryDict
+from pymql.mql.utils import ReadMode
+
+from google3.testing.pybase import googletest
+
+GUID = '#9202a8c04000641f8000000000000001'
+
+
+class QueryPrimitiveTest(googletest.TestCase):
+
+  def Primitive(self, fields):
+    qdict = QueryDict()
+    for key, value in sorted(fields.iteritems()):
+      # not a literal, so not already interned
+      qdict[''.join(['@', key])] = value
+    return QueryPrimitive('@', qdict, ReadMode)
+
+  def testFields(self):
+    qp = self.Primitive({
+        'guid': GUID,
+        'value': 'a',
+        'datatype': 'string',
+        'timestamp': None,
+        'value<': 'z'
+    })
+
+    self.assertEqual(['guid', 'datatype', 'timestamp', 'value'], qp.result)
+    self.assertEqual(GUID, qp.guid)
+    self.assertEqual('a', qp.value)
+    self.assertEqual({'value<': 'z'}, qp.valueops)
+    # the fields not given have their defaults
+    self.assertEqual(None, qp.typeguid)
+    self.assertEqual(Missing, qp.left)
+    self.assertEqual(False, qp.access_control_ok)
+
+  def testSlots(self):
+    """a primitive has no __dict__, and shares its field names."""
+    qp = self.Primitive({'value': 'a', 'datatype': 'string'})
+    self.assertFalse(hasattr(qp, '__dict__'))
+    self.assertRaises(AttributeError, setattr, qp, 'colour', 'red')
+    for name in qp.result:
+      self.assertIs(intern(name), name)
+
+  def testOptionalSlots(self):
+    """slots only set on some primitives start out unset."""
+    qp = self.Primitive({'value': 'a'})
+    self.assertFalse(hasattr(qp, 'orig'))
+    qp.orig = qp
+    self.assertIs(qp, qp.orig)
+
+  def testBadField(self):
+    self.assertRaises(MQLInternalParseError, self.Primitive,
+                      {'name': 'a'})
+
+
+if __name__ == '__main__':
+  googletest.main()
@@ -0,0 +1,131 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""ReadQP unittest for pymql, against a fake lookup."""
+
+import google3
+from pymql.mql import readqp
+from pymql.mql.env import DeferredIdLookup
+from pymql.mql.env import DeferredMidOfGuidLookup
+from pymql.mql.env import DeferredMidsOfGuidLookup
+from pymql.mql.env import Varenv
+from pymql.mql.utils import QueryDict
+
+from google3.testing.pybase import googletest
+
+
+class FakeLookup(object):
+  """Finds '/id' + guid and ['/m' + guid, '/m/old' + guid]."""
+
+  def __init__(self):
+    self.calls = []
+
+  def lookup_ids(self, guids, varenv):
+    self.calls.append('lookup_ids')
+    return dict((guid, '/id' + guid) for guid in guids)
+
+  def lookup_mids_of_guids(self, guids, varenv):
+    self.calls.append('lookup_mids_of_guids')
+    return dict((guid, ['/m' + guid, '/m/old' + guid]) for guid in guids)
+
+  def lookup_ids_and_mids(self, id_guids, mid_guids, varenv):
+    self.calls.append('lookup_ids_and_mids')
+    return (dict((guid, '/id' + guid) for guid in id_guids),
+            dict((guid, ['/m' + guid, '/m/old' + guid]) for guid in mid_guids))
+
+
+class ResultSlotsTest(googletest.TestCase):
+
+  def setUp(self):
+    self.lookup = FakeLookup()
+    self.varenv = Varenv({}, self.lookup)
+    self.manager = self.varenv.lookup_manager
+
+  def testFillResultSlots(self):
+    """only the noted slots are filled, in the result as built."""
+    manager = self.manager
+    row = {}
+    readqp.set_result(row, 'id', DeferredIdLookup('#a', manager), self.varenv)
+    readqp.set_result(row, 'mid', DeferredMidOfGuidLookup('#b', manager),
+                      self.varenv)
+    readqp.set_result(row, 'mids', [DeferredMidsOfGuidLookup('#c', manager)],
+                      self.varenv)
+    readqp.set_result(
+        row, 'ids',
+        [DeferredIdLookup('#d', manager),
+         DeferredIdLookup('#e', manager)], self.varenv)
+    readqp.set_result(row, 'name', 'a', self.varenv)
+    readqp.set_result(row, 'names', ['a', 'b'], self.varenv)
+    result = {}
+    readqp.set_result(result, 'rows', [row], self.varenv)
+
+    # one slot for each lookup but the list of mids, which is one
+    self.assertEqual(5, len(manager.result_slots))
+
+    manager.do_mid_and_id_lookups()
+    manager.fill_result_slots()
+
+    self.assertEqual(['lookup_ids_and_mids'], self.lookup.calls)
+    self.assertIs(row, result['rows'][0])
+    self.assertEqual({
+        'id': '/id#a',
+        'mid': '/m#b',
+        'mids': ['/m#c', '/m/old#c'],
+        'ids': ['/id#d', '/id#e'],
+        'name': 'a',
+        'names': ['a', 'b']
+    }, row)
+    self.assertEqual([], manager.result_slots)
+
+  def testSameSlotTwice(self):
+    """a slot set again is filled with the last lookup put there."""
+    row = {}
+    readqp.set_result(row, 'id', DeferredIdLookup('#a', self.manager),
+                      self.varenv)
+    readqp.set_result(row, 'id', DeferredIdLookup('#b', self.manager),
+                      self.varenv)
+    self.manager.do_id_lookups()
+    self.manager.fill_result_slots()
+    self.assertEqual({'id': '/id#b'}, row)
+
+
+class SlotsTest(googletest.TestCase):
+
+  def testSlots(self):
+    """a ReadQP has no __dict__, and each category its defaults."""
+    for category, pagesize in (('node', None), ('link', 100), ('value', 100),
+                               ('index', None), ('attached', None),
+                               ('directlink', 100), ('constraint', 100)):
+      qp = readqp.ReadQP(QueryDict(), category)
+      self.assertFalse(hasattr(qp, '__dict__'))
+      self.assertEqual(category, qp.category)
+      self.assertEqual(pagesize, qp.pagesize)
+      self.assertEqual(None, qp.typeguid)
+      self.assertEqual([], qp.contents)
+      self.assertRaises(AttributeError, setattr, qp, 'colour', 'red')
+
+    # only set on nodes
+    link = readqp.ReadQP(QueryDict(), 'link')
+    self.assertFalse(hasattr(link, 'bang_indexes'))
+    node = readqp.ReadQP(QueryDict(), 'node')
+    self.assertEqual({}, node.bang_indexes)
+
+  def testFinalSlots(self):
+    prop = QueryDict(reverse=True)
+    final = readqp.FinalQP(QueryDict(), prop, '#a')
+    self.assertEqual(('left', '#a'), (final.field, final.guid))
+    self.assertFalse(hasattr(final, '__dict__'))
+
+
+if __name__ == '__main__':
+  googletest.main()
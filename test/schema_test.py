@@ -0,0 +1,196 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""SchemaFactory preload and snapshot unittest for pymql, on a fake graph."""
+
+import google3
+from pymql.mql import schema
+from pymql.mql.error import MQLInternalError
+from pymql.mql.error import MQLParseError
+from pymql.mql.error import MQLTypeError
+
+from google3.testing.pybase import googletest
+
+# a snapshot with nothing loaded, so that no graph is needed to start
+EMPTY_SNAPSHOT = {
+    'dateline': '5',
+    'enumeration_ect_guid': '#e1',
+    'has_key_guid': '#02',
+    'domains': [],
+    'types': []
+}
+
+
+def type_result(guid):
+  """The graph result of a type with no properties."""
+  return {'@guid': guid, 'uses_properties_from': [], 'has_key': []}
+
+
+def domain_result(guid, types):
+  """The graph result of a domain of types, a key -> guid map."""
+  has_key = []
+  for key, type_guid in sorted(types.iteritems()):
+    result = type_result(type_guid)
+    result[':value'] = key
+    has_key.append(result)
+  return {'@guid': guid, 'has_key': has_key}
+
+
+class FakeLookup(object):
+
+  def __init__(self, guids):
+    self.guids = guids
+
+  def lookup_guids(self, ids, varenv):
+    return dict((id, self.guids.get(id, False)) for id in ids)
+
+
+class FakeQuerier(object):
+  """Reads the results of the guids asked for, out of results."""
+
+  def __init__(self, guids, results):
+    self.lookup = FakeLookup(guids)
+    self.results = results
+    # the guids asked for, for each read
+    self.reads = []
+
+  def read(self, query, varenv):
+    asked = sorted(query[0]['@guid'])
+    self.reads.append(asked)
+    return [self.results[guid] for guid in asked if guid in self.results]
+
+
+class PreloadTest(googletest.TestCase):
+
+  def Factory(self, guids, results):
+    factory = schema.SchemaFactory(
+        FakeQuerier(guids, results), {}, EMPTY_SNAPSHOT)
+    # the parent of every type, which loading /type would have added
+    factory.get_or_add_type('/type/object', {})
+    return factory
+
+  def testPreloadTypes(self):
+    factory = self.Factory({
+        '/film/film': '#f1',
+        '/film/actor': '#f2'
+    }, {
+        '#f1': type_result('#f1'),
+        '#f2': type_result('#f2')
+    })
+    factory.preload_types(['/film/film', '/film/actor'], {})
+
+    self.assertEqual([['#f1', '#f2']], factory.querier.reads)
+    for typepath in ('/film/film', '/film/actor'):
+      self.assertTrue(factory.types[typepath].loaded)
+
+    # loaded types aren't read again
+    factory.preload_types(['/film/film'], {})
+    self.assertEqual(1, len(factory.querier.reads))
+
+  def testPreloadTypesMissing(self):
+    """the types found are loaded before a missing one is raised."""
+    factory = self.Factory({'/film/film': '#f1'},
+                           {'#f1': type_result('#f1')})
+    try:
+      factory.preload_types(['/film/missing', '/film/film'], {})
+      self.fail('no MQLTypeError')
+    except MQLTypeError, e:
+      self.assertEqual('/film/missing', e.get_kwd('expected_type'))
+
+    self.assertEqual([['#f1']], factory.querier.reads)
+    self.assertTrue(factory.types['/film/film'].loaded)
+    self.assertFalse(factory.types['/film/missing'].loaded)
+
+  def testPreloadTypesUnread(self):
+    """a type the graph read doesn't give is raised."""
+    factory = self.Factory({'/film/film': '#f1'}, {})
+    self.assertRaises(MQLTypeError, factory.preload_types, ['/film/film'], {})
+
+  def testPreloadDomains(self):
+    factory = self.Factory({
+        '/film': '#d1',
+        '/music': '#d2'
+    }, {
+        '#d1': domain_result('#d1', {'film': '#f1'}),
+        '#d2': domain_result('#d2', {'album': '#m1'})
+    })
+    factory.preload_domains(['/film', '/music'], {})
+
+    self.assertEqual([['#d1', '#d2']], factory.querier.reads)
+    self.assertTrue(factory.types['/film/film'].loaded)
+    self.assertTrue(factory.types['/music/album'].loaded)
+
+  def testPreloadDomainsMissing(self):
+    factory = self.Factory({'/film': '#d1'},
+                           {'#d1': domain_result('#d1', {'film': '#f1'})})
+    self.assertRaises(MQLTypeError, factory.preload_domains,
+                      ['/missing', '/film'], {})
+    self.assertIn('/film', factory.domains)
+    self.assertTrue(factory.types['/film/film'].loaded)
+
+  def testPreloadInvalid(self):
+    factory = self.Factory({}, {})
+    self.assertRaises(MQLParseError, factory.preload_domains, ['film'], {})
+    self.assertRaises(MQLParseError, factory.preload_types, ['film'], {})
+    self.assertEqual([], factory.querier.reads)
+
+
+
+class SnapshotTest(googletest.TestCase):
+
+  GUIDS = {'/type': '#t1', '/film': '#d1', '/music/album': '#m1'}
+  RESULTS = {
+      '#t1': domain_result('#t1', {'object': '#o1'}),
+      '#d1': domain_result('#d1', {'film': '#f1'}),
+      '#m1': type_result('#m1')
+  }
+
+  def Preloaded(self, keep_json):
+    factory = schema.SchemaFactory(
+        FakeQuerier(self.GUIDS, self.RESULTS), {},
+        EMPTY_SNAPSHOT,
+        keep_json=keep_json)
+    factory.preload_domains(['/type'], {})
+    factory.preload_domains(['/film'], {})
+    factory.preload_types(['/music/album'], {})
+    return factory
+
+  def testSnapshot(self):
+    """a snapshot gives back the domains and types loaded."""
+    saved = self.Preloaded(True).snapshot()
+    self.assertEqual(['/film', '/type'],
+                     sorted(domainpath for domainpath, _, _ in
+                            saved['domains']))
+    self.assertEqual(['/music/album'],
+                     [typepath for typepath, _ in saved['types']])
+
+    # /type is restored first, whatever the order saved
+    saved['domains'].sort()
+
+    factory = schema.SchemaFactory(FakeQuerier({}, {}), {}, saved)
+    self.assertTrue(factory.types['/film/film'].loaded)
+    self.assertTrue(factory.types['/music/album'].loaded)
+    self.assertEqual([], factory.querier.reads)
+
+  def testNoJsonKept(self):
+    """without keep_json the graph results are dropped once parsed."""
+    factory = self.Preloaded(False)
+    self.assertEqual(None, factory.domains['/film'].json)
+    for typepath in ('/film/film', '/music/album'):
+      self.assertTrue(factory.types[typepath].loaded)
+      self.assertEqual(None, factory.types[typepath].json)
+    self.assertRaises(MQLInternalError, factory.snapshot)
+
+
+if __name__ == '__main__':
+  googletest.main()
@@ -0,0 +1,330 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""MQLService paged and scanned reads unittest for pymql, against fakes."""
+
+import threading
+import time
+
+import google3
+import pymql
+from pymql import scan
+from pymql.mql.error import MQLInternalError
+from pymql.mql.error import MQLParseError
+from pymql.mql.graph.connector import request_property
+from pymql.mql.graph.connector import RequestState
+from pymql.mql.utils import QueryDict
+
+from google3.testing.pybase import googletest
+
+
+class CostConnector(object):
+  """Only the totalcost of a connector, kept per thread like its own."""
+
+  totalcost = request_property('totalcost')
+
+  def __init__(self):
+    self.request_state = RequestState()
+
+  def reset_cost(self):
+    self.request_state.reset()
+
+
+class PagedService(pymql.MQLService):
+  """An MQLService whose read() serves pages of rows, with no graph.
+
+  The pages are rows_per_page rows each; page n is read with cursor
+  'c%d' % n (True for the first), and an error in errors is raised by
+  the read of that page instead. Each read costs one 'pages', and
+  'rows' for each row.
+  """
+
+  def __init__(self, pages, rows_per_page, errors=None):
+    self.pages = pages
+    self.rows_per_page = rows_per_page
+    self.errors = errors or {}
+    self.reads = []
+    self.gc = CostConnector()
+
+  def read(self, query, **varenv):
+    self.gc.reset_cost()
+    cursor = varenv['cursor']
+    page = 0 if cursor is True else int(cursor[1:])
+    self.reads.append((cursor, query[0]['limit']))
+    if page in self.errors:
+      raise self.errors[page]
+
+    rows = range(page * self.rows_per_page, (page + 1) * self.rows_per_page)
+    if page + 1 < self.pages:
+      next_cursor = 'c%d' % (page + 1)
+    else:
+      next_cursor = False
+    self.gc.totalcost['pages'] += 1
+    self.gc.totalcost['rows'] += len(rows)
+    return QueryDict(result=rows, cursor=next_cursor, cost=self.gc.totalcost)
+
+
+class IterReadTest(googletest.TestCase):
+
+  def testIterRead(self):
+    for prefetch in (0, 1, 2):
+      service = PagedService(3, 2)
+      rows = list(service.iter_read([{'id': None, 'limit': 5}], page_size=2,
+                                    prefetch=prefetch))
+      self.assertEqual(range(6), rows)
+      # the limit is the page size, and each page is read once
+      self.assertEqual([(True, 2), ('c1', 2), ('c2', 2)], service.reads)
+
+  def testIterReadFromCursor(self):
+    service = PagedService(3, 2)
+    rows = list(service.iter_read([{'id': None}], page_size=2, cursor='c1'))
+    self.assertEqual([2, 3, 4, 5], rows)
+
+  def testIterReadPrefetchBound(self):
+    """the pages are read ahead, but no more than prefetch of them."""
+    service = PagedService(10, 1)
+    it = service.iter_read([{'id': None}], page_size=1, prefetch=1)
+    self.assertEqual(0, it.next())
+    time.sleep(0.3)
+    # the page yielded, one waiting, and one read that waits its turn
+    self.assertLessEqual(len(service.reads), 3)
+    self.assertEqual(range(1, 10), list(it))
+
+  def testIterReadError(self):
+    """an error from a page is raised when its place is reached."""
+    for prefetch in (0, 1):
+      service = PagedService(3, 2, errors={1: MQLParseError(None, 'page 1')})
+      it = service.iter_read([{'id': None}], page_size=2, prefetch=prefetch)
+      self.assertEqual([0, 1], [it.next(), it.next()])
+      self.assertRaises(MQLParseError, it.next)
+
+  def testIterReadClose(self):
+    """closing the iterator early leaves no read running."""
+    service = PagedService(100, 1)
+    it = service.iter_read([{'id': None}], page_size=1, prefetch=2)
+    it.next()
+    it.close()
+    reads = len(service.reads)
+    self.assertLessEqual(reads, 4)
+    self.assertNotIn('pymql-prefetch',
+                     [thread.name for thread in threading.enumerate()])
+    time.sleep(0.2)
+    self.assertEqual(reads, len(service.reads))
+
+  def testIterReadCost(self):
+    """the cost of the pages read so far is that of the caller."""
+    for prefetch in (0, 1, 2):
+      service = PagedService(3, 2)
+      it = service.iter_read([{'id': None}], page_size=2, prefetch=prefetch)
+      it.next()
+      self.assertEqual(1, service.get_cost()['pages'])
+      self.assertEqual([1, 2, 3, 4, 5], list(it))
+      self.assertEqual({'pages': 3, 'rows': 6}, service.get_cost())
+
+  def testIterReadNotAList(self):
+    """a query that is not a list is refused at the call."""
+    service = PagedService(1, 1)
+    for query in ({'id': None}, [{'id': None}, {'id': None}], ['/en/a']):
+      self.assertRaises(MQLParseError, service.iter_read, query)
+    self.assertEqual([], service.reads)
+
+
+class WindowService(object):
+  """Reads of rows (id, timestamp), within the timestamp window asked.
+
+  The cursor is the offset of the next page in the window.
+  """
+
+  def __init__(self, rows):
+    self.rows = rows
+    self.reads = []
+    self.closed = False
+
+  def read(self, query, **varenv):
+    clause = query[0]
+    self.reads.append(clause)
+    window = [
+        row for row in self.rows
+        if clause.get('timestamp>=', '') <= row[1] < clause.get(
+            'timestamp<', '~')
+    ]
+
+    cursor = varenv['cursor']
+    offset = 0 if cursor is True else int(cursor)
+    end = offset + clause['limit']
+    return QueryDict(
+        result=window[offset:end],
+        cursor=str(end) if end < len(window) else False)
+
+  def close(self):
+    self.closed = True
+
+
+class FakeConnector(object):
+  """Clones to one address each, with no graph."""
+
+  def __init__(self, addr_list):
+    self.addr_list = addr_list
+    self.clones = []
+    self.closed = False
+
+  def open(self):
+    pass
+
+  def clone(self, addrs):
+    gc = FakeConnector(addrs)
+    self.clones.append(gc)
+    return gc
+
+  def close(self):
+    self.closed = True
+
+
+class FakePlanCache(object):
+
+  def __init__(self, size):
+    self.size = size
+
+
+class FakeHighQuery(object):
+  """Caches of one snapshot, and one shared cache, as HighQuery has."""
+
+  def __init__(self, lowq, plan_cache_size=0, schema_snapshots=False):
+    self.querier = lowq
+    self.schema_snapshots = schema_snapshots
+    self.plan_cache = None
+    if plan_cache_size:
+      self.plan_cache = FakePlanCache(plan_cache_size)
+    self.shared_cache = None
+    self.restored = None
+
+  def snapshot(self):
+    return {'schema': 'from %s' % self.querier.gc.addr_list}
+
+  def attach_shared_cache(self, shared, varenv):
+    self.shared_cache = shared
+    return True
+
+  def restore_snapshot(self, snapshot, varenv):
+    self.restored = snapshot
+
+
+class FakeLowQuery(object):
+
+  def __init__(self, gc):
+    self.gc = gc
+
+
+class ScanTest(googletest.TestCase):
+
+  ROWS = [('r%02d' % i, '20%02d' % i) for i in xrange(20)]
+
+  def testScan(self):
+    """a scan in timestamp windows gives all the results, once."""
+    services = [WindowService(self.ROWS) for _ in xrange(2)]
+    s = scan.Scan(services, [{'id': None}], ['2005', '2012'], page_size=3)
+
+    self.assertEqual(self.ROWS, sorted(s))
+    self.assertEqual([[None, '2005', False], ['2005', '2012', False],
+                      ['2012', None, False]], s.checkpoint())
+    for service in services:
+      self.assertFalse(service.closed)
+      for clause in service.reads:
+        self.assertEqual(3, clause['limit'])
+
+    self.assertRaises(MQLInternalError, list, s)
+
+  def testScanResume(self):
+    """a scan made from a checkpoint carries on where it stopped."""
+    service = WindowService(self.ROWS)
+    checkpoint = [[None, '2005', False], ['2005', '2012', '3'],
+                  ['2012', None, True]]
+    s = scan.Scan([service], [{'id': None}], checkpoint=checkpoint,
+                  close_services=True)
+
+    self.assertEqual(self.ROWS[8:], sorted(s))
+    self.assertTrue(service.closed)
+
+  def testScanErrors(self):
+    for query in ([{'id': None, 'limit': 10}],
+                  [{'id': None, 'timestamp>': '2001'}], {'id': None}):
+      self.assertRaises(MQLParseError, scan.Scan, [WindowService([])], query)
+    self.assertRaises(MQLParseError, scan.Scan, [WindowService([])],
+                      [{'id': None}], ['2005', '2001'])
+    self.assertRaises(MQLParseError, scan.Scan, [], [{'id': None}])
+
+  def testScanTooFewBoundaries(self):
+    """a scan needs a window for each of its workers, unless resumed."""
+    services = [WindowService(self.ROWS) for _ in xrange(3)]
+    self.assertRaises(MQLParseError, scan.Scan, services, [{'id': None}])
+    self.assertRaises(MQLParseError, scan.Scan, services, [{'id': None}],
+                      ['2005'])
+    s = scan.Scan(services, [{'id': None}], checkpoint=[[None, None, True]])
+    self.assertEqual(self.ROWS, sorted(s))
+
+
+class ServiceScanTest(googletest.TestCase):
+
+  def setUp(self):
+    for name, fake in (('HighQuery', FakeHighQuery), ('LowQuery',
+                                                      FakeLowQuery)):
+      self.addCleanup(setattr, pymql, name, getattr(pymql, name))
+      setattr(pymql, name, fake)
+
+    self.gc = FakeConnector([('a', 1), ('b', 2)])
+    self.service = pymql.MQLService(
+        connector=self.gc,
+        schema_snapshot='',
+        shared_schema_cache='',
+        plan_cache_size=10,
+        schema_snapshots=True)
+
+  def testScanWorkers(self):
+    """the workers clone our connector, and start from our caches."""
+    self.service.high_querier.shared_cache = 'shared'
+    s = self.service.scan([{'id': None}], ['2005', '2010'], workers=3)
+
+    self.assertEqual([[('a', 1)], [('b', 2)], [('a', 1)]],
+                     [gc.addr_list for gc in self.gc.clones])
+    for service, gc in zip(s.services, self.gc.clones):
+      self.assertIs(gc, service.gc)
+      self.assertEqual('shared', service.high_querier.shared_cache)
+      self.assertEqual({'schema': 'from %s' % self.gc.addr_list},
+                       service.high_querier.restored)
+      self.assertEqual(10, service.high_querier.plan_cache.size)
+
+    # the workers are closed once the scan has run; we aren't
+    s.partitions = []
+    self.assertEqual([], list(s))
+    self.assertEqual([True] * 3, [gc.closed for gc in self.gc.clones])
+    self.assertFalse(self.gc.closed)
+
+  def testScanWithoutSnapshots(self):
+    """workers of a service that keeps no snapshots start afresh."""
+    self.service.high_querier.schema_snapshots = False
+    s = self.service.scan([{'id': None}], ['2005'], workers=2)
+    self.assertEqual([None, None],
+                     [service.high_querier.restored for service in s.services])
+
+  def testScanBadQuery(self):
+    """workers made for a scan that can't be run are closed."""
+    self.assertRaises(MQLParseError, self.service.scan,
+                      [{'id': None, 'limit': 1}], ['2005'], workers=2)
+    self.assertEqual([True] * 2, [gc.closed for gc in self.gc.clones])
+    self.assertRaises(MQLParseError, self.service.scan, [{'id': None}],
+                      workers=2)
+    self.assertEqual([True] * 4, [gc.closed for gc in self.gc.clones])
+
+
+if __name__ == '__main__':
+  googletest.main()
@@ -0,0 +1,248 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Shared schema cache unittest for pymql."""
+
+import os
+import shutil
+import tempfile
+
+import google3
+from pymql.mql import hijson
+from pymql.mql import sharedcache
+from pymql.mql.error import MQLDatelineInvalidError
+from pymql.mql.utils import SegmentedLRU
+
+from google3.testing.pybase import googletest
+
+NS_A = '#9202a8c04000641f80000000000000aa'
+
+
+class Reply(list):
+  """A graph reply, with the dateline it was read at."""
+
+  def __init__(self, rows, dateline):
+    list.__init__(self, rows)
+    self.dateline = dateline
+
+
+class FakeGraphConnector(object):
+  """Gives the replies in turn, or raises them if exceptions."""
+
+  def __init__(self, replies=()):
+    self.reads = []
+    self.replies = list(replies)
+    self.totalcost = {}
+
+  def read_varenv(self, gql, varenv):
+    self.reads.append(gql)
+    reply = self.replies.pop(0)
+    if isinstance(reply, Exception):
+      raise reply
+    return reply
+
+
+class FakeLookup(object):
+
+  def __init__(self, guids):
+    self.guids = guids
+    self.shared = None
+
+  def attach_shared(self, shared):
+    self.shared = shared
+
+
+class FakeLowQuery(object):
+
+  def __init__(self, guids, gc=None):
+    self.lookup = FakeLookup(guids)
+    self.gc = gc
+
+
+class FakeSchemaFactory(object):
+
+  def type_guids(self):
+    # the properties of /film/film and /film/actor share a typeguid
+    return {
+        '#f1': set(['/film/film']),
+        '#f2': set(['/film/actor']),
+        '#p1': set(['/film/film', '/film/actor']),
+        '#t1': set(['/user/x/t'])
+    }
+
+
+class FakeHighQuery(object):
+  """A HighQuery with a snapshot() of one domain and one type."""
+
+  def __init__(self):
+    self.querier = FakeLowQuery(SegmentedLRU(1 << 20))
+    self.querier.lookup.guids['#a1'] = '/en/a'
+    # a lookup that found nothing
+    self.querier.lookup.guids['#b1'] = False
+    self.schema_factory = FakeSchemaFactory()
+
+  def snapshot(self):
+    film = {
+        'guid': '#f0',
+        'has_key': [{
+            ':value': 'film',
+            'guid': '#f1'
+        }, {
+            ':value': 'actor',
+            'guid': '#f2'
+        }]
+    }
+    return {
+        'schema': {
+            'dateline': '5',
+            'domains': [('/film', '#f0', film)],
+            'types': [('/user/x/t', {
+                'guid': '#t1'
+            })]
+        },
+        'namespaces': [(NS_A, 1, '5', [('a', '#a1'), ('b', '#b1')])]
+    }
+
+
+class SharedCacheTest(googletest.TestCase):
+
+  def setUp(self):
+    tmpdir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, tmpdir)
+    self.path = os.path.join(tmpdir, 'schema.shared')
+
+  def Open(self):
+    cache = sharedcache.open_cache(self.path)
+    self.assertIsNot(None, cache)
+    self.addCleanup(cache.close)
+    return cache
+
+  def testWriteTables(self):
+    tables = {
+        'meta': {
+            'dateline': '5'
+        },
+        'ids': dict(('#%03d' % i, '/en/%d' % i) for i in xrange(100)),
+        'empty': {},
+        'odd': {
+            '': 'empty key',
+            'a\0b': '\0\xff'
+        }
+    }
+    with open(self.path, 'wb') as f:
+      sharedcache.write_tables(f, tables)
+
+    cache = self.Open()
+    for name, table in tables.iteritems():
+      for key, value in table.iteritems():
+        self.assertEqual(value, cache.get(name, key))
+    self.assertEqual(None, cache.get('ids', '#100'))
+    self.assertEqual(None, cache.get('ids', ''))
+    self.assertEqual(None, cache.get('empty', 'a'))
+    self.assertEqual(None, cache.get('missing', 'a'))
+
+    stats = cache.stats()
+    self.assertEqual('5', stats['dateline'])
+    self.assertEqual(100, stats['ids'])
+    self.assertEqual(0, stats['empty'])
+    self.assertEqual(4, stats['misses'])
+
+  def testBuild(self):
+    sharedcache.build(self.path, FakeHighQuery())
+    self.assertEqual(['schema.shared'], os.listdir(os.path.dirname(self.path)))
+
+    cache = self.Open()
+    self.assertEqual('5', cache.dateline)
+    key = sharedcache.namespace_key(NS_A, 'a')
+    self.assertEqual('#a1', cache.get('namespaces', key))
+    self.assertEqual('/en/a', cache.get('ids', '#a1'))
+    # lookups that found nothing aren't shared
+    self.assertEqual(None, cache.get('ids', '#b1'))
+
+    self.assertEqual('#f0', cache.schema('domains', '/film')['guid'])
+    # the types of a domain are kept with it, and on their own
+    self.assertEqual({
+        ':value': 'actor',
+        'guid': '#f2'
+    }, cache.schema('types', '/film/actor'))
+    self.assertEqual({'guid': '#t1'}, cache.schema('types', '/user/x/t'))
+    self.assertEqual(None, cache.schema('types', '/film/director'))
+    typeguids = dict(cache.items('typeguids'))
+    self.assertEqual(['#f1', '#f2', '#p1', '#t1'], sorted(typeguids))
+    self.assertEqual('/film/actor\n/film/film', typeguids['#p1'])
+
+  def testCatchUp(self):
+    """what has changed since the dateline is left out."""
+    sharedcache.build(self.path, FakeHighQuery())
+    cache = self.Open()
+    gc = FakeGraphConnector([Reply([['p1']], '7'), Reply([[NS_A[1:]]], '8')])
+
+    cache.catch_up(gc, {})
+    self.assertIn('dateline>5', gc.reads[0])
+    for guid in ('f1', 'f2', 'p1', 't1', NS_A[1:]):
+      self.assertIn(guid, gc.reads[0])
+    self.assertEqual(None, cache.schema('types', '/film/film'))
+    self.assertEqual(None, cache.schema('types', '/film/actor'))
+    self.assertEqual(None, cache.schema('domains', '/film'))
+    self.assertEqual({'guid': '#t1'}, cache.schema('types', '/user/x/t'))
+    self.assertEqual('#a1', cache.namespace_entry(NS_A, 'a'))
+    self.assertEqual('7', cache.dateline)
+
+    cache.catch_up(gc, {})
+    self.assertIn('dateline>7', gc.reads[1])
+    self.assertEqual(None, cache.namespace_entry(NS_A, 'a'))
+    self.assertEqual({'guid': '#t1'}, cache.schema('types', '/user/x/t'))
+    stats = cache.stats()
+    self.assertEqual((2, 1, 1), (stats['stale_types'], stats['stale_domains'],
+                                 stats['stale_namespaces']))
+
+  def testAttach(self):
+    """a HighQuery catches a shared cache up, or doesn't use it."""
+    sharedcache.build(self.path, FakeHighQuery())
+    replies = [
+        Reply([], '7'),
+        MQLDatelineInvalidError(None, 'from another graph'),
+    ]
+    gc = FakeGraphConnector(replies)
+    hq = hijson.HighQuery(FakeLowQuery(None, gc))
+
+    cache = self.Open()
+    self.assertTrue(hq.attach_shared_cache(cache, {}))
+    self.assertIs(cache, hq.shared_cache)
+    self.assertIs(cache, hq.querier.lookup.shared)
+    self.assertEqual('7', cache.dateline)
+
+    hq = hijson.HighQuery(FakeLowQuery(None, gc))
+    self.assertFalse(hq.attach_shared_cache(self.Open(), {}))
+    self.assertEqual(None, hq.shared_cache)
+    self.assertEqual(None, hq.querier.lookup.shared)
+
+    cache = self.Open()
+    cache.dateline = None
+    self.assertFalse(hq.attach_shared_cache(cache, {}))
+    self.assertEqual(2, len(gc.reads))
+
+  def testUnusable(self):
+    self.assertEqual(None, sharedcache.open_cache(self.path))
+
+    with open(self.path, 'wb') as f:
+      f.write('not a shared schema cache, but long enough')
+    self.assertEqual(None, sharedcache.open_cache(self.path))
+
+    with open(self.path, 'wb') as f:
+      f.write('short')
+    self.assertEqual(None, sharedcache.open_cache(self.path))
+
+
+if __name__ == '__main__':
+  googletest.main()
@@ -0,0 +1,179 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Schema snapshot unittest for pymql, against a fake graph."""
+
+import cPickle as pickle
+import os
+import shutil
+import tempfile
+
+import google3
+from pymql.mql import schema
+from pymql.mql import snapshot
+from pymql.mql.namespace import NameMap
+
+from google3.testing.pybase import googletest
+
+# what BootNamespace reads: the root namespace, has_key, root user, /boot
+BOOT_RESULT = [[['01', '02', '03', '04'], [], []]]
+
+NS_A = '#9202a8c04000641f80000000000000aa'
+NS_B = '#9202a8c04000641f80000000000000bb'
+
+
+class Reply(list):
+  """A graph reply, with the dateline it was read at."""
+
+  def __init__(self, rows, dateline):
+    list.__init__(self, rows)
+    self.dateline = dateline
+
+
+class FakeGraphConnector(object):
+  """Gives the replies in turn, after the boot read if boot."""
+
+  def __init__(self, boot=True):
+    self.reads = []
+    self.replies = []
+    if boot:
+      self.replies.append(BOOT_RESULT)
+
+  def read_varenv(self, gql, varenv):
+    self.reads.append(gql)
+    return self.replies.pop(0)
+
+
+class FakeQuerier(object):
+
+  def __init__(self):
+    self.gc = FakeGraphConnector(boot=False)
+
+
+class FakeSchemaType(object):
+  """A loaded type, with no properties."""
+
+  def __init__(self, id, guid):
+    self.id = id
+    self.guid = guid
+    self.loaded = True
+    self.props = {}
+    self.domain = None
+
+
+class SnapshotFileTest(googletest.TestCase):
+
+  def setUp(self):
+    tmpdir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, tmpdir)
+    self.path = os.path.join(tmpdir, 'schema.snapshot')
+
+  def testRoundTrip(self):
+    saved = {'schema': {'dateline': '5'}, 'namespaces': [(NS_A, 1, '5', [])]}
+    snapshot.write(self.path, saved)
+    self.assertEqual(saved, snapshot.read(self.path))
+
+    # written again in one step, with no temporary file left behind
+    snapshot.write(self.path, {})
+    self.assertEqual({}, snapshot.read(self.path))
+    self.assertEqual(['schema.snapshot'],
+                     os.listdir(os.path.dirname(self.path)))
+
+  def testUnusable(self):
+    self.assertEqual(None, snapshot.read(self.path))
+
+    with open(self.path, 'wb') as f:
+      pickle.dump((snapshot.SNAPSHOT_VERSION + 1, {}), f)
+    self.assertEqual(None, snapshot.read(self.path))
+
+    with open(self.path, 'wb') as f:
+      f.write('not a snapshot')
+    self.assertEqual(None, snapshot.read(self.path))
+
+
+class NameMapSnapshotTest(googletest.TestCase):
+
+  def NameMap(self):
+    gc = FakeGraphConnector()
+    return NameMap(gc, max_bytes=1 << 20), gc
+
+  def testRestoreAndCatchUp(self):
+    namemap, _ = self.NameMap()
+    ns = namemap.get_or_add_namespace(NS_A)
+    ns.complete = 1
+    ns.last_dateline = '5'
+    ns.store('a', '#a1')
+    # not completely cached, so not caught up
+    namemap.get_or_add_namespace(NS_B).store('b', '#b1')
+
+    restored, gc = self.NameMap()
+    restored.restore(namemap.snapshot())
+    self.assertEqual('#a1', restored.cached_entry(NS_A, 'a'))
+    self.assertEqual('#b1', restored.cached_entry(NS_B, 'b'))
+
+    gc.replies.append(Reply([[NS_A[1:], [['"c"', 'c1']]]], '7'))
+    restored.catch_up({})
+
+    self.assertIn('guid=(%s)' % NS_A[1:], gc.reads[1])
+    self.assertIn('dateline>5', gc.reads[1])
+    self.assertEqual('#c1', restored.cached_entry(NS_A, 'c'))
+    self.assertEqual('#a1', restored.cached_entry(NS_A, 'a'))
+    self.assertEqual('7', restored.namespaces.get(NS_A).last_dateline)
+    self.assertEqual(None, restored.namespaces.get(NS_B).last_dateline)
+
+  def testNothingToCatchUp(self):
+    namemap, gc = self.NameMap()
+    namemap.restore([(NS_B, -1, None, [('b', '#b1')])])
+    namemap.catch_up({})
+    self.assertEqual(1, len(gc.reads))
+
+
+class SchemaSnapshotTest(googletest.TestCase):
+
+  def Factory(self):
+    saved = {
+        'dateline': '5',
+        'enumeration_ect_guid': '#e1',
+        'has_key_guid': '#02',
+        'domains': [],
+        'types': []
+    }
+    factory = schema.SchemaFactory(FakeQuerier(), {}, saved)
+    for id, guid in (('/film/film', '#f1'), ('/film/actor', '#f2')):
+      factory.types[id] = FakeSchemaType(id, guid)
+      factory.guids[guid] = factory.types[id]
+    return factory
+
+  def testCatchUp(self):
+    """the types changed since the snapshot's dateline are forgotten."""
+    factory = self.Factory()
+    gc = factory.querier.gc
+    gc.replies = [Reply([['f2']], '7')]
+    factory.catch_up({})
+
+    self.assertIn('dateline>5', gc.reads[0])
+    self.assertEqual(['/film/film'], factory.types.keys())
+    self.assertEqual(['#f1'], factory.guids.keys())
+    self.assertEqual('7', factory.dateline)
+    self.assertEqual(1, factory.generation)
+
+  def testNothingChanged(self):
+    factory = self.Factory()
+    factory.querier.gc.replies = [Reply([], '7')]
+    factory.catch_up({})
+    self.assertEqual(2, len(factory.types))
+    self.assertEqual(0, factory.generation)
+
+
+if __name__ == '__main__':
+  googletest.main()
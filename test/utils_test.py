@@ -0,0 +1,139 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""SegmentedLRU unittest for pymql."""
+
+import google3
+from pymql.mql.utils import SegmentedLRU
+
+from google3.testing.pybase import googletest
+
+ENTRY = SegmentedLRU.ENTRY_BYTES
+
+
+def value_sizeof(key, value):
+  """The values are lists whose first item is their size."""
+  return value[0]
+
+
+class SegmentedLRUTest(googletest.TestCase):
+
+  def Cache(self, entries, protected_entries):
+    """A cache of entries of 50 bytes, and protected_entries of them."""
+    max_bytes = entries * (50 + ENTRY)
+    return SegmentedLRU(
+        max_bytes,
+        sizeof=value_sizeof,
+        protected_share=float(protected_entries) / entries)
+
+  def testGetSet(self):
+    cache = self.Cache(4, 2)
+    cache['a'] = [50]
+    self.assertEqual([50], cache['a'])
+    self.assertEqual([50], cache.get('a'))
+    self.assertEqual(None, cache.get('b'))
+    self.assertRaises(KeyError, lambda: cache['b'])
+    self.assertIn('a', cache)
+    self.assertNotIn('b', cache)
+    self.assertEqual(1, len(cache))
+
+    self.assertEqual([50], cache.pop('a'))
+    self.assertEqual(None, cache.pop('a'))
+    self.assertEqual(0, len(cache))
+
+    stats = cache.stats()
+    self.assertEqual(2, stats['hits'])
+    self.assertEqual(2, stats['misses'])
+    self.assertEqual(0.5, stats['hit_rate'])
+    self.assertEqual(0, stats['bytes'])
+
+  def testEvictsProbationFirst(self):
+    """entries used only once go before the ones used again."""
+    cache = self.Cache(4, 2)
+    for key in 'ab':
+      cache[key] = [50]
+      cache.get(key)
+
+    for key in 'cdefg':
+      cache[key] = [50]
+
+    self.assertEqual(['f', 'g', 'a', 'b'], [key for key, _ in cache.items()])
+    stats = cache.stats()
+    self.assertEqual(3, stats['evictions'])
+    self.assertEqual(2, stats['protected'])
+
+  def testProtectedOverflow(self):
+    """past its share, the protected segment goes back on probation."""
+    cache = self.Cache(4, 2)
+    for key in 'abc':
+      cache[key] = [50]
+    for key in 'abc':
+      cache.get(key)
+
+    self.assertEqual(2, cache.stats()['protected'])
+    # 'a' is least recently used, and first to go
+    cache['d'] = [50]
+    cache['e'] = [50]
+    self.assertNotIn('a', cache)
+    self.assertEqual(['d', 'e', 'b', 'c'], [key for key, _ in cache.items()])
+
+  def testByteAccounting(self):
+    cache = self.Cache(4, 2)
+    cache['a'] = [50]
+    cache['b'] = [10]
+    self.assertEqual(60 + 2 * ENTRY, cache.stats()['bytes'])
+
+    cache['b'] = [20]
+    self.assertEqual(70 + 2 * ENTRY, cache.stats()['bytes'])
+
+    # a value that grows in place is counted once it's resized
+    value = cache['a']
+    value[0] = 120
+    cache.resize('a')
+    self.assertEqual(140 + 2 * ENTRY, cache.stats()['bytes'])
+
+    # and one too big for the cache is dropped
+    value[0] = 1000
+    cache.resize('a')
+    self.assertNotIn('a', cache)
+    self.assertEqual(20 + ENTRY, cache.stats()['bytes'])
+
+    cache.resize('x')
+    self.assertEqual(20 + ENTRY, cache.stats()['bytes'])
+
+  def testTooBig(self):
+    cache = self.Cache(4, 2)
+    cache['a'] = [50]
+    cache['a'] = [1000]
+    self.assertNotIn('a', cache)
+    self.assertEqual(0, cache.stats()['bytes'])
+    self.assertEqual(0, cache.stats()['evictions'])
+
+  def testClear(self):
+    cache = self.Cache(4, 2)
+    for key in 'abc':
+      cache[key] = [50]
+      cache.get(key)
+    cache.clear()
+
+    self.assertEqual(0, len(cache))
+    self.assertEqual([], cache.values())
+    stats = cache.stats()
+    self.assertEqual(0, stats['bytes'])
+    self.assertEqual(0, stats['protected'])
+    cache['a'] = [50]
+    self.assertEqual(50 + ENTRY, cache.stats()['bytes'])
+
+
+if __name__ == '__main__':
+  googletest.main()